@@ -0,0 +1,50 @@
+from __future__ import annotations
+from typing import *
+import numpy as np
+
+#cached values kept at most, more would mean the keys are rebuilt for every scenario
+CACHE_SIZE = 64
+
+class ScratchArena():
+	#buffers reused by the successive simulations of one worker (thread or process), so that once every
+	#buffer has been allocated a scenario doesn't allocate any full length array
+	#a buffer is only valid until the same name is asked again, curves built in it must not outlive the simulation
+	buffers     : Dict[str, np.array]
+	cache       : Dict[Tuple[str, int], Tuple[Any, Any]]
+	allocations : int
+	def __init__(self):
+		self.buffers     = {}
+		self.cache       = {}
+		self.allocations = 0
+
+	def get(self, name : str, length : int, dtype : type = np.float64) -> np.array:
+		#buffer of length values, content undefined
+		buffer = self.buffers.get(name)
+		if buffer is None or len(buffer) < length or buffer.dtype != dtype:
+			buffer = np.empty(length, dtype=dtype)
+			self.buffers[name] = buffer
+			self.allocations += 1
+		return buffer[:length]
+
+	def get_cached(self, name : str, key : Any, compute : Callable[[], Any]) -> Any:
+		#value computed once per key object (a list of dates for instance), key is kept alive so that its id stays valid
+		cached = self.cache.get((name, id(key)))
+		if cached is None or cached[0] is not key:
+			if len(self.cache) >= CACHE_SIZE:
+				self.cache.clear()
+			cached = (key, compute())
+			self.cache[(name, id(key))] = cached
+		return cached[1]
+
+	def get_dates_slice(self, dates : List[Any], begin : int, end : int) -> List[Any]:
+		return self.get_cached(f"slice {begin} {end}", dates, lambda : dates[begin:end])
+
+	def get_size(self) -> int:
+		return sum([b.nbytes for b in self.buffers.values()])
+
+def get_buffer(arena : Optional[ScratchArena], name : str, length : int, dtype : type = np.float64) -> Optional[np.array]:
+	#None without arena, to be given as an out parameter
+	return arena.get(name, length, dtype) if arena is not None else None
+
+def get_cached(arena : Optional[ScratchArena], name : str, key : Any, compute : Callable[[], Any]) -> Any:
+	return arena.get_cached(name, key, compute) if arena is not None else compute()
@@ -0,0 +1,413 @@
+from __future__ import annotations
+from typing import *
+from datetime import datetime, timedelta
+from time import perf_counter
+from sys import argv
+from dataclasses import fields
+from itertools import islice
+import json
+import os
+import platform
+import numpy as np
+if len(__name__.split("."))==1:
+	from calc import *
+	from sim import *
+	from sweep import run_threaded, run_processes, simulate_point, set_point
+	from arena import ScratchArena
+	from profiling import get_total_size
+	from dispatch import WindowLayout, dispatch_in_windows
+	from online import OnlineSimulator, get_measurements, check_online
+else:
+	from .calc import *
+	from .sim import *
+	from .sweep import run_threaded, run_processes, simulate_point, set_point
+	from .arena import ScratchArena
+	from .profiling import get_total_size
+	from .dispatch import WindowLayout, dispatch_in_windows
+	from .online import OnlineSimulator, get_measurements, check_online
+
+#self contained benchmarks : every curve is generated, so they run without ../data/
+#usage : python benchmark.py [--quick] [--only name] [--runs n] [--save baseline.json] [--compare baseline.json]
+#        a baseline only holds for the machine it was measured on : save it there (locally or in a CI job) before comparing
+#        python benchmark.py --precision [--quick]    compares the float32 mode to float64
+#        python benchmark.py --executors [n] [--quick]    threads against processes, 1 to n workers (all the cores by default)
+#        python benchmark.py --check-online [--quick]    the online simulator against the batch simulation
+LATITUDE = 47.65 #Redon
+#(name, years, time step in seconds)
+CONFIGURATIONS = [("1y_hourly", 1, 3600), ("3y_15min", 3, 900)]
+QUICK_CONFIGURATIONS = [("1y_hourly", 1, 3600)]
+SWEEP_POINTS = 32
+#points of --executors, enough to keep every worker of a large machine busy
+EXECUTOR_POINTS = 128
+#measurements pushed through the online simulator, a month of the hourly curves
+ONLINE_STEPS = 720
+#sweep points replayed by --check-online
+CHECK_ONLINE_POINTS = 4
+#a benchmark slower than the baseline by more than this ratio is reported as a regression
+REGRESSION_THRESHOLD = 0.15
+#runs of the whole suite whose median is saved or compared, without --runs
+BASELINE_RUNS = 3
+
+def generate_dates(begin : datetime, years : int, step : int) -> List[datetime]:
+	count = int((datetime(begin.year + years, begin.month, begin.day) - begin).total_seconds()) // step
+	return [begin + timedelta(seconds=i * step) for i in range(count)]
+
+def get_day_and_hour(dates : List[datetime]) -> Tuple[np.array, np.array]:
+	seconds = dates_to_seconds(dates).astype(np.float64)
+	day = np.array([d.timetuple().tm_yday for d in dates], dtype=np.float64)
+	hour = (seconds % 86400) / 3600
+	return (day, hour)
+
+def generate_wind(dates : List[datetime], seed : int = 0) -> PowerData:
+	#ar(1) wind speed, windier in winter, through a turbine power curve (cut in 3m/s, rated 12m/s, cut out 25m/s)
+	rng = np.random.default_rng(seed)
+	(day, hour) = get_day_and_hour(dates)
+	step_hours = (dates[1] - dates[0]).total_seconds() / 3600
+	persistence = 0.97 ** step_hours
+	noise = rng.normal(0.0, 1.0, len(dates)) * np.sqrt(1 - persistence ** 2)
+	anomaly = np.empty(len(dates))
+	anomaly[0] = noise[0]
+	for i in range(1, len(dates)):
+		anomaly[i] = persistence * anomaly[i - 1] + noise[i]
+	speed = np.maximum(0.0, 7.0 + 1.5 * np.cos(2 * np.pi * day / 365) + 3.0 * anomaly)
+	power = np.clip((speed ** 3 - 27.0) / (12.0 ** 3 - 27.0), 0.0, 1.0)
+	power[speed > 25.0] = 0.0
+	return PowerData(dates, power)
+
+def generate_solar(dates : List[datetime], seed : int = 1) -> PowerData:
+	#clear sky irradiance from the sun elevation, reduced by a daily cloudiness
+	rng = np.random.default_rng(seed)
+	(day, hour) = get_day_and_hour(dates)
+	declination = np.radians(23.44) * np.sin(2 * np.pi * (284 + day) / 365)
+	latitude = np.radians(LATITUDE)
+	hour_angle = np.radians(15.0 * (hour - 12.0))
+	elevation = np.sin(latitude) * np.sin(declination) + np.cos(latitude) * np.cos(declination) * np.cos(hour_angle)
+	cloudiness = rng.uniform(0.2, 1.0, int(day.max()) + 1)[day.astype(np.int64)]
+	return PowerData(dates, np.maximum(0.0, elevation) * cloudiness)
+
+def generate_bioenergy(dates : List[datetime], seed : int = 2) -> PowerData:
+	#almost flat, with a few days of maintenance every year
+	rng = np.random.default_rng(seed)
+	(day, hour) = get_day_and_hour(dates)
+	power = 1.0 + rng.normal(0.0, 0.02, len(dates))
+	power[np.isin(day.astype(np.int64), rng.integers(1, 366, 10))] = 0.1
+	return PowerData(dates, power)
+
+def generate_household(dates : List[datetime], seed : int = 3) -> PowerData:
+	#morning and evening peaks, electric heating in winter, more consumption during the weekend
+	rng = np.random.default_rng(seed)
+	(day, hour) = get_day_and_hour(dates)
+	weekend = np.array([d.weekday() >= 5 for d in dates], dtype=np.float64)
+	daily = 0.6 + 0.5 * np.exp(-((hour - 8.0) ** 2) / 2.0) + 0.9 * np.exp(-((hour - 19.5) ** 2) / 4.0)
+	heating = 0.6 * np.maximum(0.0, np.cos(2 * np.pi * day / 365))
+	return PowerData(dates, np.maximum(0.05, daily * (1.0 + heating) * (1.0 + 0.1 * weekend) + rng.normal(0.0, 0.05, len(dates))))
+
+def get_synthetic_params(years : int = 1, step : int = 3600, seed : int = 0, dtype : str = "float64") -> SimParams:
+	#same layout as scenario_base.load_scenario_base, with the same consumer curve for the three consumer types
+	dates = generate_dates(datetime(2021, 1, 1), years, step)
+	household = generate_household(dates, seed + 3)
+	return SimParams(
+		has_solar                     = True,
+		has_wind                      = True,
+		has_bioenergy                 = True,
+		has_piloted_bioenergy         = True,
+		has_battery                   = True,
+		has_flexibility               = True,
+		has_solar_scaling             = True,
+		has_wind_scaling              = True,
+		has_bioenergy_scaling         = True,
+		has_piloted_bioenergy_scaling = True,
+		has_consumer_scaling          = [True, True, True],
+		solar_power                   = 300.0,
+		wind_power                    = 400.0,
+		bioenergy_power               = 100.0,
+		battery_capacity              = 2000.0,
+		piloted_bioenergy_power       = 0.0,
+		flexibility_ratio             = 0.1,
+		consumer_power                = [600.0, 700.0, 150.0],
+		consumer_contrib              = [1.0, 1.0, 1.0],
+		solar_curve                   = generate_solar(dates, seed + 1).get_scaled(1.0),
+		wind_curve                    = generate_wind(dates, seed).get_scaled(1.0),
+		bioenergy_curve               = generate_bioenergy(dates, seed + 2).get_scaled(1.0),
+		consumer_curves               = [household, household.get_copy(), household.get_copy()],
+		begin                         = dates[0],
+		end                           = dates[-1] + timedelta(seconds=step),
+		scale_before_slice            = False,
+		dtype                         = dtype
+	)
+
+def time_call(function : Callable[[], Any], repeat : int = 5, min_time : float = 0.2) -> Dict[str, float]:
+	#function is called in loops lasting at least min_time, seconds per call of the best and median loop
+	number = 1
+	while True:
+		t0 = perf_counter()
+		for i in range(number):
+			function()
+		elapsed = perf_counter() - t0
+		if elapsed >= min_time or number >= 1 << 20:
+			break
+		number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+	times = [elapsed / number]
+	for i in range(repeat - 1):
+		t0 = perf_counter()
+		for j in range(number):
+			function()
+		times.append((perf_counter() - t0) / number)
+	return {"min" : float(np.min(times)), "median" : float(np.median(times)), "calls" : number}
+
+def get_benchmarks(params : SimParams) -> Dict[str, Callable[[], Any]]:
+	params.check_and_convert_params()
+	wind = params.wind_curve
+	solar = params.solar_curve
+	consumption = params.get_consumers_agglomerated_curves()
+	(_, consumers) = params.get_consumers_matrix()
+	production = params.get_wind_curve() + params.get_solar_curve() + params.get_constant_bioenergy_curve()
+	middle = wind.dates[len(wind.dates) // 2]
+	hourly = consumption.resample(timedelta(hours=1))
+	flexed = simulate_flexibility_c(production, consumption, params.flexibility_ratio[0], float(24 * 3600))
+	difference = flexed[0] - flexed[1]
+	deficit = flexed[1].power - flexed[0].power
+	layout = WindowLayout(consumption.dates, "day")
+	result = simulate_senario(params)
+	measurements = list(islice(get_measurements(params), ONLINE_STEPS))
+	def online():
+		simulator = OnlineSimulator(params)
+		for (date, consumptions, production) in measurements:
+			simulator.push(date, consumptions, production)
+		simulator.close()
+	def battery():
+		Battery(params.battery_capacity).from_power_data(difference)
+	model = {"max_charge_power" : 300.0, "max_discharge_power" : 300.0, "charge_efficiency" : 0.95, "discharge_efficiency" : 0.95, "self_discharge" : 0.0001}
+	def model_battery():
+		Battery(params.battery_capacity, **model).from_power_data(difference)
+	return {
+		"PowerData.__add__"              : lambda : wind + solar,
+		"PowerData.__sub__"              : lambda : wind - solar,
+		"PowerData.__mul__"              : lambda : wind * 2.0,
+		"PowerData.get_copy"             : lambda : wind.get_copy(),
+		"PowerData.get_scaled"           : lambda : wind.get_scaled(1.0),
+		"PowerData.get_scaled(month)"    : lambda : wind.get_scaled(1.0, "month"),
+		"PowerData.get_slice_over_period": lambda : wind.get_slice_over_period(wind.dates[0], middle),
+		"PowerData.get_intersect"        : lambda : wind.get_intersect(solar),
+		"PowerData.get_slice"            : lambda : wind.get_slice(solar.dates),
+		"PowerData.get_average"          : lambda : wind.get_average(),
+		"PowerData.get_percentile"       : lambda : wind.get_percentile(95),
+		"PowerData.get_bigger_than"      : lambda : wind.get_bigger_than(0.5),
+		"PowerData.get_rolling_average"  : lambda : wind.get_rolling_average(timedelta(hours=24)),
+		"PowerData.resample"             : lambda : consumption.resample(timedelta(hours=2)),
+		"PowerData.align_to"             : lambda : hourly.align_to(consumption),
+		"SimParams.consumers_curve"      : lambda : params.get_consumers_agglomerated_curves(),
+		"simulate_flexibility_c"         : lambda : simulate_flexibility_c(production, consumption, params.flexibility_ratio[0], float(24 * 3600)),
+		"simulate_class_flexibility"     : lambda : simulate_class_flexibility(production, np.copy(consumers), np.linspace(0.05, 0.15, len(consumers)), float(24 * 3600)),
+		"Battery.from_power_data"        : battery,
+		"Battery.from_power_data(model)" : model_battery,
+		"simulate_batteries(64)"         : lambda : simulate_batteries(difference, [Battery(c, **model) for c in np.linspace(0.0, 5000.0, 64)]),
+		"dispatch_in_windows"            : lambda : dispatch_in_windows(deficit, layout, 40.0, 100.0),
+		"simulate_senario"               : lambda : simulate_senario(params),
+		f"OnlineSimulator({ONLINE_STEPS} steps)" : online,
+		"AgglomeratedSimResults"         : lambda : AgglomeratedSimResults.from_sim_results(result),
+	}
+
+def get_sweep_points(count : int) -> List[Dict[str, float]]:
+	rng = np.random.default_rng(0)
+	piloted_rng = np.random.default_rng(1)
+	return [{
+		"wind_to_sim"    : rng.uniform(0.0, 800.0),
+		"sun_to_sim"     : rng.uniform(0.0, 800.0),
+		"bio_to_sim"     : rng.uniform(0.0, 200.0),
+		"battery_to_sim" : rng.uniform(0.0, 5000.0),
+		"flex_to_sim"    : rng.uniform(0.0, 0.15),
+		#own generator, the other axes keep the points they had before this axis
+		"piloted_to_sim" : piloted_rng.uniform(0.0, 100.0),
+	} for i in range(count)]
+
+def time_sweep(params : SimParams, count : int = SWEEP_POINTS, thread_count : int = None) -> Dict[str, float]:
+	#end to end throughput, simulation and aggregation of every point
+	thread_count = thread_count if thread_count is not None else (os.cpu_count() or 1)
+	points = get_sweep_points(count)
+	t0 = perf_counter()
+	run_threaded(params, points, thread_count)
+	elapsed = perf_counter() - t0
+	return {"min" : elapsed / count, "median" : elapsed / count, "calls" : count, "scenarios_per_second" : count / elapsed, "threads" : thread_count}
+
+def get_worker_counts(max_workers : int) -> List[int]:
+	#1, 2, 4... up to max_workers, which is always measured
+	counts = [1]
+	while counts[-1] * 2 < max_workers:
+		counts.append(counts[-1] * 2)
+	if counts[-1] != max_workers:
+		counts.append(max_workers)
+	return counts
+
+def time_executors(params : SimParams, count : int = EXECUTOR_POINTS, max_workers : int = None, log : bool = True) -> Dict[str, Dict[int, float]]:
+	#{executor : {workers : scenarios/s}}, run_threaded and run_processes on the same points
+	#the process pool is started in the timing, as a sweep pays for it too
+	max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+	points = get_sweep_points(count)
+	executors = {
+		"threads"   : lambda workers : run_threaded(params, points, workers),
+		#a few chunks per process, so the last ones don't leave the others idle
+		"processes" : lambda workers : run_processes(params, points, workers, max(1, count // (workers * 4))),
+	}
+	results = {name : {} for name in executors}
+	for workers in get_worker_counts(max_workers):
+		for (name, executor) in executors.items():
+			t0 = perf_counter()
+			executor(workers)
+			results[name][workers] = count / (perf_counter() - t0)
+		if log:
+			print(f"{workers:3} workers  threads {results['threads'][workers]:10.2f} scenarios/s  processes {results['processes'][workers]:10.2f} scenarios/s")
+	return results
+
+def run_benchmarks(configurations : List[Tuple[str, int, int]] = CONFIGURATIONS, selected : str = None, log : bool = True) -> Dict[str, Dict[str, Dict[str, float]]]:
+	#{configuration : {benchmark : timings}}, selected keeps the benchmarks whose name contains it
+	results = {}
+	for (name, years, step) in configurations:
+		params = get_synthetic_params(years, step)
+		results[name] = {}
+		benchmarks = get_benchmarks(params)
+		for (benchmark, function) in benchmarks.items():
+			if selected is not None and selected not in benchmark:
+				continue
+			results[name][benchmark] = time_call(function)
+			if log:
+				print(f"{name:10} {benchmark:34} {results[name][benchmark]['median'] * 1000:10.3f} ms")
+		if selected is None or selected in "sweep":
+			results[name]["sweep"] = time_sweep(params)
+			if log:
+				print(f"{name:10} {'sweep':34} {results[name]['sweep']['scenarios_per_second']:10.2f} scenarios/s")
+	return results
+
+def run_benchmarks_median(runs : int, configurations : List[Tuple[str, int, int]] = CONFIGURATIONS, selected : str = None, log : bool = True) -> Dict[str, Dict[str, Dict[str, float]]]:
+	#median over several runs of the suite of every timing, a run slowed down by the rest of the machine doesn't move it
+	results = [run_benchmarks(configurations, selected, log=False) for _ in range(runs)]
+	merged = {}
+	for (name, benchmarks) in results[0].items():
+		merged[name] = {}
+		for (benchmark, timings) in benchmarks.items():
+			merged[name][benchmark] = {**timings, "runs" : runs}
+			for key in ["min", "median", "scenarios_per_second"]:
+				if key in timings:
+					merged[name][benchmark][key] = float(np.median([r[name][benchmark][key] for r in results]))
+			if log:
+				print(f"{name:10} {benchmark:34} {merged[name][benchmark]['median'] * 1000:10.3f} ms  median of {runs} runs")
+	return merged
+
+def time_precision(params : SimParams, points : List[Dict[str, float]]) -> Dict[str, Any]:
+	#one worker simulating every point, as a thread of run_threaded does
+	arena = ScratchArena()
+	simulate_point(params, points[0], arena)
+	t0 = perf_counter()
+	results = [simulate_point(params, point, arena) for point in points]
+	elapsed = perf_counter() - t0
+	curves = params.consumer_curves + [params.solar_curve, params.wind_curve, params.bioenergy_curve]
+	return {
+		"results"              : results,
+		"scenarios_per_second" : len(points) / elapsed,
+		#dates are shared by the two modes, only the power arrays are counted
+		"curves_bytes"         : sum([c.power.nbytes for c in curves]),
+		"arena_bytes"          : arena.get_size(),
+	}
+
+def check_online_points(configurations : List[Tuple[str, int, int]] = CONFIGURATIONS, count : int = CHECK_ONLINE_POINTS, log : bool = True) -> Dict[str, float]:
+	#check_online on sweep points of the synthetic curves, largest relative difference of every kpi
+	worst = {}
+	for (name, years, step) in configurations:
+		params = get_synthetic_params(years, step)
+		for point in get_sweep_points(count):
+			set_point(params, point)
+			for (kpi, difference) in check_online(params).items():
+				worst[kpi] = max(worst.get(kpi, 0.0), difference)
+		if log:
+			print(f"{name:10} {count} points, online and batch simulations match")
+	if log:
+		for (kpi, difference) in worst.items():
+			print(f"{kpi:20} {difference:.3e}")
+	return worst
+
+def compare_precision(configurations : List[Tuple[str, int, int]] = CONFIGURATIONS, count : int = SWEEP_POINTS, log : bool = True) -> Dict[str, Dict[str, Any]]:
+	#float32 against float64 on random sweep points : worst relative error of every kpi, memory and throughput
+	#relative errors are taken against max(|float64 value|, 1e-6) so that kpis at 0 don't divide by 0
+	comparison = {}
+	points = get_sweep_points(count)
+	for (name, years, step) in configurations:
+		reference = time_precision(get_synthetic_params(years, step), points)
+		reduced = time_precision(get_synthetic_params(years, step, dtype="float32"), points)
+		errors = {}
+		for field in [f.name for f in fields(AgglomeratedSimResults)]:
+			expected = np.array([getattr(r["agglomerated"], field) for r in reference["results"]])
+			found = np.array([getattr(r["agglomerated"], field) for r in reduced["results"]])
+			errors[field] = float(np.max(np.abs(found - expected) / np.maximum(np.abs(expected), 1e-6)))
+		comparison[name] = {
+			"max_relative_error" : errors,
+			"float64"            : {k : v for (k, v) in reference.items() if k != "results"},
+			"float32"            : {k : v for (k, v) in reduced.items() if k != "results"},
+		}
+		if log:
+			for (field, error) in errors.items():
+				print(f"{name:10} {field:34} {error:10.2e}")
+			for key in ["scenarios_per_second", "curves_bytes", "arena_bytes"]:
+				print(f"{name:10} {key:34} {reference[key]:14.1f} -> {reduced[key]:14.1f}  x{reduced[key] / reference[key]:5.2f}")
+	return comparison
+
+def get_environment() -> Dict[str, Any]:
+	return {
+		"date"      : datetime.now().isoformat(timespec="seconds"),
+		"python"    : platform.python_version(),
+		"numpy"     : np.__version__,
+		"machine"   : platform.machine(),
+		"processor" : platform.processor(),
+		"cpu_count" : os.cpu_count(),
+	}
+
+def save_baseline(path : str, results : Dict[str, Dict[str, Dict[str, float]]]):
+	with open(path, "w") as out_file:
+		json.dump({"environment" : get_environment(), "results" : results}, out_file, indent=1)
+
+def compare(results : Dict[str, Dict[str, Dict[str, float]]], baseline_path : str, threshold : float = REGRESSION_THRESHOLD) -> List[Tuple[str, str, float]]:
+	#prints the ratio of every median to the baseline one, returns the (configuration, benchmark, ratio) slower than threshold
+	with open(baseline_path) as inp:
+		baseline = json.load(inp)
+	if baseline["environment"]["machine"] != platform.machine() or baseline["environment"]["cpu_count"] != os.cpu_count():
+		print("warning : the baseline was measured on another kind of machine", baseline["environment"])
+	regressions = []
+	for (configuration, benchmarks) in results.items():
+		for (benchmark, timings) in benchmarks.items():
+			reference = baseline["results"].get(configuration, {}).get(benchmark)
+			if reference is None:
+				continue
+			ratio = timings["median"] / reference["median"]
+			flag = ""
+			if ratio > 1.0 + threshold:
+				regressions.append((configuration, benchmark, ratio))
+				flag = "REGRESSION"
+			elif ratio < 1.0 / (1.0 + threshold):
+				flag = "faster"
+			print(f"{configuration:10} {benchmark:34} {reference['median'] * 1000:10.3f} ms -> {timings['median'] * 1000:10.3f} ms  x{ratio:5.2f} {flag}")
+	return regressions
+
+if __name__ == "__main__":
+	configurations = QUICK_CONFIGURATIONS if "--quick" in argv else CONFIGURATIONS
+	if "--precision" in argv:
+		compare_precision(configurations)
+		exit(0)
+	if "--check-online" in argv:
+		check_online_points(configurations)
+		exit(0)
+	if "--executors" in argv:
+		index = argv.index("--executors") + 1
+		max_workers = int(argv[index]) if index < len(argv) and argv[index].isdigit() else None
+		for (name, years, step) in configurations:
+			print(name, os.cpu_count(), "cores")
+			time_executors(get_synthetic_params(years, step), max_workers=max_workers)
+		exit(0)
+	selected = argv[argv.index("--only") + 1] if "--only" in argv else None
+	runs = int(argv[argv.index("--runs") + 1]) if "--runs" in argv else BASELINE_RUNS if "--save" in argv or "--compare" in argv else 1
+	results = run_benchmarks(configurations, selected) if runs == 1 else run_benchmarks_median(runs, configurations, selected)
+	if "--save" in argv:
+		save_baseline(argv[argv.index("--save") + 1], results)
+	if "--compare" in argv:
+		regressions = compare(results, argv[argv.index("--compare") + 1])
+		if len(regressions) != 0:
+			print(len(regressions), "regressions")
+			exit(1)
@@ -2,7 +2,14 @@ from __future__ import annotations
 from typing import *
 from datetime import datetime, timedelta
 from math import floor, ceil
+from bisect import bisect_left
 import numpy as np
+if len(__name__.split("."))==1:
+	from rolling import rolling_stats
+	from kernels import battery_kernel, battery_model_kernel, BATTERY_PARAM_COUNT
+else:
+	from .rolling import rolling_stats
+	from .kernels import battery_kernel, battery_model_kernel, BATTERY_PARAM_COUNT
 class Period:
 	beginning : datetime
 	end : datetime
@@ -14,22 +21,111 @@ class Period:
 		self.beginning = beginning
 		self.end = end
 
+RESAMPLE_METHODS = ["sum", "mean", "max", "min"]
+#dtypes the power of a curve can be stored in, see SimParams.dtype
+#float32 halves the memory of the curves and of the simulation buffers, sums and averages are still computed in float64
+POWER_DTYPES = {"float64" : np.float64, "float32" : np.float32}
+
+def get_power_dtype(dtype : Union[str, type, np.dtype]) -> type:
+	name = np.dtype(dtype).name
+	if name not in POWER_DTYPES:
+		raise Exception(f"unsupported power dtype {name}, expected one of {list(POWER_DTYPES.keys())}")
+	return POWER_DTYPES[name]
+
+def as_power_array(power : Any) -> np.array:
+	#float64 and float32 arrays are used as they are, anything else is converted to float64
+	power = np.asarray(power)
+	if power.dtype.name not in POWER_DTYPES:
+		return power.astype(np.float64)
+	return power
+
+def dates_to_seconds(dates : List[datetime]) -> np.array:
+	#naive dates are read as UTC, so that daylight saving time never shifts a bucket
+	return np.array(dates, dtype="datetime64[s]").astype(np.int64)
+
+def seconds_to_dates(seconds : np.array) -> List[datetime]:
+	return np.array(seconds, dtype=np.int64).astype("datetime64[s]").astype(datetime).tolist()
+
+def to_seconds(step : Union[timedelta, float, int]) -> int:
+	if isinstance(step, timedelta):
+		return int(step.total_seconds())
+	return int(step)
+
+CALENDAR_GROUPINGS = ["year", "season", "month", "day", "season_of_year", "month_of_year", "weekday", "hour_of_day"]
+SEASON_NAMES  = ["winter", "spring", "summer", "autumn"]
+WEEKDAY_NAMES = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+def get_calendar_labels(dates : Union[List[datetime], np.array], grouping : str) -> np.array:
+	#one integer label per date, labels grow with time so sorting them keeps the date order
+	#the *_of_year, weekday and hour_of_day groupings are cyclic, they gather the same slot of every year/week/day
+	#dates can also be given as the int64 array of dates_to_seconds, which skips the conversion of every date
+	seconds = dates if isinstance(dates, np.ndarray) else dates_to_seconds(dates)
+	days = seconds.astype("datetime64[s]").astype("datetime64[D]")
+	if grouping == "year":
+		return days.astype("datetime64[Y]").astype(np.int64) + 1970
+	if grouping == "month":
+		return days.astype("datetime64[M]").astype(np.int64)
+	if grouping == "season":
+		#december belongs to the winter of the next year : DJF, MAM, JJA, SON
+		return (days.astype("datetime64[M]").astype(np.int64) + 1) // 3
+	if grouping == "day":
+		return days.astype(np.int64)
+	if grouping == "month_of_year":
+		return days.astype("datetime64[M]").astype(np.int64) % 12
+	if grouping == "season_of_year":
+		return ((days.astype("datetime64[M]").astype(np.int64) + 1) // 3) % 4
+	if grouping == "weekday":
+		#1970-01-01 was a thursday
+		return (days.astype(np.int64) + 3) % 7
+	if grouping == "hour_of_day":
+		return (seconds // 3600) % 24
+	raise Exception(f"unknown calendar grouping {grouping}, expected one of {CALENDAR_GROUPINGS}")
+
+def get_calendar_label_names(labels : np.array, grouping : str) -> List[str]:
+	names = []
+	for label in labels:
+		label = int(label)
+		if grouping == "year":
+			names.append(str(label))
+		elif grouping == "month":
+			names.append(f"{1970 + label // 12}-{label % 12 + 1:02d}")
+		elif grouping == "season":
+			names.append(f"{1970 + label // 4}-{SEASON_NAMES[label % 4]}")
+		elif grouping == "day":
+			names.append(str(np.datetime64(label, "D")))
+		elif grouping == "month_of_year":
+			names.append(f"{label + 1:02d}")
+		elif grouping == "season_of_year":
+			names.append(SEASON_NAMES[label])
+		elif grouping == "weekday":
+			names.append(WEEKDAY_NAMES[label])
+		else:
+			names.append(f"{label:02d}h")
+	return names
+
+def get_period_labels(dates : List[datetime], periods : List[Period]) -> np.array:
+	#index of the period containing each date ([beginning, end[), -1 if none, periods should not overlap
+	seconds = dates_to_seconds(dates)
+	order = np.argsort(dates_to_seconds([p.beginning for p in periods]), kind="stable")
+	beginnings = dates_to_seconds([periods[i].beginning for i in order])
+	ends       = dates_to_seconds([periods[i].end       for i in order])
+	position = np.searchsorted(beginnings, seconds, side="right") - 1
+	inside = (position >= 0) & (seconds < ends[np.maximum(position, 0)])
+	return np.where(inside, order[np.maximum(position, 0)], -1)
+
 class PowerData():
 	power : np.array
 	dates : List[datetime]
 	def check_simalarity(self, p2:PowerData) -> bool:	
 		if (len(self.dates) != len(p2.dates) or len(self.power) != len(p2.power)):
 			return False
-		for i in range(len(self.dates)):
-			if self.dates[i] != p2.dates[i]:
-				return False
-		return True
+		return self.dates is p2.dates or self.dates == p2.dates
 
 	def __add__(self, p2 : Union[PowerData, float, int]) -> PowerData:
 		if p2 is None:
 			return self.get_copy()
 		if (isinstance(p2, float)):
-			return PowerData(self.dates[:], p2 + self.power)
+			return PowerData(self.dates[:], float(p2) + self.power)
 		if (isinstance(p2, int)):
 			return PowerData(self.dates[:], p2 + self.power)
 		if not self.check_simalarity(p2):
@@ -43,7 +139,8 @@ class PowerData():
 
 	def __mul__(self, toMul : Union[np.array, List[float], float, PowerData, int]) -> PowerData:
 		if (isinstance(toMul, float)):
-			return PowerData(self.dates, self.power * toMul)
+			#numpy floats are converted so that they don't promote float32 curves to float64
+			return PowerData(self.dates, self.power * float(toMul))
 		if (isinstance(toMul, int)):
 			return PowerData(self.dates, self.power * toMul)
 		if (isinstance(toMul, PowerData)):
@@ -53,178 +150,277 @@ class PowerData():
 
 	def __truediv__(self, toDivBy : Union[np.array, List[float], float, PowerData]) -> PowerData:
 		if (isinstance(toDivBy, float)):
-			return PowerData(self.dates, self.power / toDivBy)
+			return PowerData(self.dates, self.power / float(toDivBy))
 		if (isinstance(toDivBy, PowerData)):
-			power = []
-			for i in range(len(self.power)):
-				if toDivBy.power[i] == 0:
-					power.append(0)
-				else:
-					power.append(self.power[i]/toDivBy.power[i])
-			return PowerData(self.dates, np.array(power))
+			#division by 0 gives 0
+			power = np.zeros(len(self.power))
+			np.divide(self.power, toDivBy.power, out=power, where=toDivBy.power != 0)
+			return PowerData(self.dates, power)
 		if len(self.power) == len(toDivBy):
 			return PowerData(self.dates, self.power / np.array(toDivBy))
 
-	def __init__(self, dates: List[datetime], power : np.array):
+	#in place operators, same operands as the ones above
+	def __iadd__(self, p2 : Union[PowerData, float, int]) -> PowerData:
+		if p2 is None:
+			return self
+		np.add(self.get_writable_power(), self.get_operand_power(p2), out=self.power)
+		return self
+
+	def __isub__(self, p2 : Union[PowerData, float, int]) -> PowerData:
+		np.subtract(self.get_writable_power(), self.get_operand_power(p2), out=self.power)
+		return self
+
+	def __imul__(self, toMul : Union[np.array, List[float], float, PowerData, int]) -> PowerData:
+		np.multiply(self.get_writable_power(), self.get_operand_power(toMul), out=self.power)
+		return self
+
+	def __itruediv__(self, toDivBy : Union[np.array, List[float], float, PowerData]) -> PowerData:
+		if (isinstance(toDivBy, PowerData)):
+			#division by 0 gives 0
+			divider = self.get_operand_power(toDivBy)
+			np.divide(self.get_writable_power(), divider, out=self.power, where=divider != 0)
+			self.power[divider == 0] = 0.0
+			return self
+		np.divide(self.get_writable_power(), self.get_operand_power(toDivBy), out=self.power)
+		return self
+
+	def get_operand_power(self, operand : Union[PowerData, np.array, List[float], float, int]) -> Union[np.array, float]:
+		if isinstance(operand, (float, int)):
+			return operand
+		if isinstance(operand, PowerData):
+			if not self.check_simalarity(operand):
+				raise Exception("data should be similar to be combined")#expect data to have the same dateTime
+			return operand.power
+		if len(operand) != len(self.power):
+			raise Exception("data should be similar to be combined")
+		return np.asarray(operand)
+
+	def get_writable_power(self) -> np.array:
+		#power as a float64 or float32 array that can be modified in place, converted once if it isn't one
+		if not isinstance(self.power, np.ndarray) or self.power.dtype.name not in POWER_DTYPES or not self.power.flags["WRITEABLE"]:
+			self.power = np.array(as_power_array(self.power))
+		return self.power
+
+	def __init__(self, dates: List[datetime], power : np.array, copy_dates : bool = True):
+		#copy_dates=False shares the list of dates, it is then never to be modified
 		if (len(power) != len(dates)):
 			raise("power and dates should have the same length")
 		self.power = power
-		self.dates = dates[:]
+		self.dates = dates[:] if copy_dates else dates
+
+	def get_as_dtype(self, dtype : Union[str, type, np.dtype]) -> PowerData:
+		#same curve with its power stored as dtype (one of POWER_DTYPES), the dates are shared
+		#the curve itself is returned when it already is stored as dtype
+		dtype = get_power_dtype(dtype)
+		if isinstance(self.power, np.ndarray) and self.power.dtype == dtype:
+			return self
+		return PowerData(self.dates, np.asarray(self.power, dtype=dtype), copy_dates=False)
 
 	def get_dates_as_timestamps(self) -> np.array:
 		return np.array([d.timestamp() for d in self.dates], dtype=float)
-	def get_slice(self, dates: List[datetime]) -> PowerData:
-		power = []
-		i = 0
-		#this function assumes the array is sorted to drop the complexity by one magnitude
-		for d in dates:
-			while(self.dates[i] < d):
-				i += 1
-			power.append(self.power[i])
-		return PowerData(dates, np.array(power))
-	
-	def get_slice_over_period(self, beginning: datetime = None, end : datetime = None) -> PowerData:
+	def get_period_indices(self, beginning: datetime = None, end : datetime = None) -> Tuple[int, int]:
+		#[i, j[ indices of the dates in [beginning, end[, the dates are assumed to be sorted
 		if (beginning == None):
 			beginning = self.dates[0]
 		if (end == None):
 			end = self.dates[-1]
-		i = 0
-		while(i < len(self.dates) and self.dates[i] < beginning):
-			i += 1
-		j = i
-		powerToReturn : List[float] = []
-		dateToReturn : List[datetime] = []
-		while(j < len(self.dates) and self.dates[j] < end):
-			powerToReturn.append(self.power[j])
-			dateToReturn.append(self.dates[j])
-			j += 1
-		return PowerData(dateToReturn, np.array(powerToReturn))
+		i = bisect_left(self.dates, beginning)
+		return (i, max(i, bisect_left(self.dates, end)))
+	def get_slice(self, dates: List[datetime]) -> PowerData:
+		#value of the first date greater or equal to each date, the arrays are assumed to be sorted
+		if dates is self.dates or dates == self.dates:
+			return PowerData(dates, np.copy(self.power))
+		index = np.searchsorted(dates_to_seconds(self.dates), dates_to_seconds(dates), side="left")
+		return PowerData(dates, np.asarray(self.power)[index])
+	
+	def get_slice_over_period(self, beginning: datetime = None, end : datetime = None, out : np.array = None, dates : List[datetime] = None) -> PowerData:
+		#out receives the values when given, dates can be the already sliced dates (shared with the result)
+		(i, j) = self.get_period_indices(beginning, end)
+		if out is None:
+			return PowerData(self.dates[i:j], np.array(self.power[i:j]))
+		np.copyto(out, self.power[i:j])
+		return PowerData(dates if dates is not None else self.dates[i:j], out, copy_dates=False)
 
 	def get_intersect(self, p2 : PowerData) -> List[datetime]:
-		#this function assumes the date arrays are sorted to speed up the process
-		toReturn:List[datetime] = []
-		i = 0
-		j = 0
-		while (i < len(self.dates) and j < len(p2.dates)):
-			if (self.dates[i] == p2.dates[j]):
-				toReturn.append(self.dates[i])
-				i += 1
-				j += 1
-			elif (self.dates[i] < p2.dates[j]):
-				i += 1
-			else:
-				j += 1
-		return toReturn
+		return self.get_multiple_intersect([p2])
 
 	def count_greater_than(self, val:float) -> int:
-		count = 0
-		for power in self.power:
-			if (power > val):
-				count += 1
-		return count
-	def get_percentile(self, percentile : float) -> float :
-		return sorted(self.power)[int(percentile * len(self.power) / 100)]
+		return int(np.count_nonzero(np.asarray(self.power) > val))
+	def get_percentile(self, percentile : float, out : np.array = None) -> float :
+		#out is a scratch buffer of the curve length, used instead of a partitioned copy
+		index = int(percentile * len(self.dates) / 100)
+		if out is None:
+			return np.partition(self.power, index)[index]
+		self.copy_power_to(out)
+		out.partition(index)
+		return out[index]
 
 	def get_multiple_intersect(self, p : List[PowerData]):
-		toReturn : List[datetime] = []
-		index  : List[int]      = [0] * len(p)
-		#dates are still assumed to be in growing order
-		for i in range(len(self.dates)):
-			currentDate = self.dates[i]
-			toBeAdded : bool = True
-			for j in range(len(index)):
-				while(index[j] < len(p[j].dates) and p[j].dates[index[j]] < currentDate):
-					index[j] += 1
-				if (index[j] >= len(p[j].dates)):
-					return toReturn
-				if (p[j].dates[index[j]] != currentDate):
-					toBeAdded = False
-					continue
-			if toBeAdded is True:
-				toReturn.append(currentDate)
-		return toReturn
+		#dates of this curve present in every curve of p
+		if all([c.dates is self.dates or c.dates == self.dates for c in p]):
+			return self.dates[:]
+		seconds = dates_to_seconds(self.dates)
+		common = np.ones(len(seconds), dtype=bool)
+		for curve in p:
+			common &= np.isin(seconds, dates_to_seconds(curve.dates))
+		return [self.dates[i] for i in np.nonzero(common)[0]]
 				
 
-	def get_rolling_average(self, count) -> PowerData:
-		current_sum = 0
-		powerToReturn = []
-		for i in range(floor(count/2) - 1):
-			current_sum += self.power[i]
-		for i in range(len(self.power)):
-			powerToReturn.append(current_sum / count)
-			if (i + floor(count/2) < len(self.power)):
-				current_sum += self.power[i + floor(count/2)]
-			if (i - ceil(count/2) > 0):
-				current_sum -= self.power[i - ceil(count/2)]
-		return PowerData(self.dates, np.array(powerToReturn))
+	def get_rolling_average(self, count : Union[int, timedelta]) -> PowerData:
+		#centered window, cut at the edges of the data
+		return self.get_rolling(count, "mean", True)
+	def get_rolling(self, width : Union[int, timedelta], stat : str = "mean", centered : bool = False) -> PowerData:
+		#stat is one of mean, sum, std, min, max, width is a number of points or a duration
+		return PowerData(self.dates, rolling_stats(self.power, self.dates, width, [stat], centered)[stat][0])
 	def get_cumulated_average(self) -> PowerData:
-		data = 0
-		power = []
-		for i in range(len(self.power)):
-			data += self.power[i]
-			power.append(data/(i+1))
-		return PowerData(self.dates, np.array(power))
-	def get_bigger_than(self, power : Union[int,float]) -> PowerData:
-		toReturn = []
-		for i in range(len(self.power)):
-			if (self.power[i] <= power):
-				toReturn.append(power)
-			else:
-				toReturn.append(self.power[i])
-		return PowerData(self.dates, np.array(toReturn))
-	def get_copy(self) -> PowerData:
-		return PowerData(self.dates, np.copy(self.power))
+		return PowerData(self.dates, np.cumsum(self.power) / np.arange(1, len(self.power) + 1))
+	def get_bigger_than(self, power : Union[int,float], out : np.array = None) -> PowerData:
+		if out is None:
+			return PowerData(self.dates, np.maximum(self.power, power))
+		return PowerData(self.dates, np.maximum(self.power, power, out=out), copy_dates=False)
+	def get_copy(self, out : np.array = None) -> PowerData:
+		if out is None:
+			return PowerData(self.dates, np.copy(self.power))
+		return PowerData(self.dates, self.copy_power_to(out), copy_dates=False)
+	def copy_power_to(self, out : np.array) -> np.array:
+		np.copyto(out, self.power)
+		return out
+	def get_lazy(self) -> LazyPowerData:
+		#same curve, whose operators build an expression evaluated in a single pass when a result is needed
+		return LazyPowerData(self.dates, as_power_array(self.power))
 	def get_average(self, beginning : datetime = None, end : datetime = None) -> float:
-		if (beginning == None):
-			beginning = self.dates[0]
-		if (end == None):
-			end = self.dates[-1]
-		i = 0
-		while(i < len(self.dates) and self.dates[i] < beginning):
-			i += 1
-		j = i
-		summ = 0.0
-		while(j < len(self.dates) and self.dates[j] < end):
-			summ += self.power[j]
-			j += 1
-		return summ / (j - i)
+		#end is excluded, so is the last date when end isn't given
+		(i, j) = self.get_period_indices(beginning, end)
+		return float(np.sum(self.power[i:j], dtype=np.float64)) / (j - i)
 	def get_sum(self, beginning : datetime = None, end : datetime = None) -> float:
-		if (beginning == None):
-			beginning = self.dates[0]
-		if (end == None):
-			end = self.dates[-1]
-		i = 0
-		while(i < len(self.dates) and self.dates[i] < beginning):
-			i += 1
-		j = i
-		summ = 0.0
-		while(j < len(self.dates) and self.dates[j] < end):
-			summ += self.power[j]
-			j += 1
-		return summ
+		(i, j) = self.get_period_indices(beginning, end)
+		return float(np.sum(self.power[i:j], dtype=np.float64))
 	def get_merged_to(self, p2 : PowerData) -> PowerData:
 		if (len(self.dates) == 0):
 			return p2.get_copy()
 		if (self.dates[0] < p2.dates[0]):
 			return PowerData(self.dates + p2.dates,np.concatenate((self.power, p2.power)))
 		else:
-			return PowerData(p2.dates + self.dates, np.concatenate(p2.power, self.power))
-	def get_scaled(self, power : Union[List[float], float], periods : List[Period] = None) -> PowerData:
-		if (isinstance(power, float) or isinstance(power, int)):
+			return PowerData(p2.dates + self.dates, np.concatenate((p2.power, self.power)))
+	def get_group_labels(self, periods : Union[List[Period], str]) -> np.array:
+		#label of the group each date belongs to, -1 when it isn't in any of the periods
+		if isinstance(periods, str):
+			return get_calendar_labels(self.dates, periods)
+		return get_period_labels(self.dates, periods)
+	def get_scaled(self, power : Union[List[float], float], periods : Union[List[Period], str] = None, out : np.array = None) -> PowerData:
+		#periods can be a list of Period (one power per period) or a calendar grouping such as "year", "month" or "season"
+		#with a calendar grouping, power is either a float for every group or one value per group, in date order
+		#out receives the values when given, it can be the power of this curve
+		if out is not None:
+			if periods is None and isinstance(power, (float, int)):
+				np.divide(self.power, self.get_average(), out=out)
+				np.multiply(out, power, out=out)
+				return PowerData(self.dates, out, copy_dates=False)
+			scaled = self.get_scaled(power, periods)
+			np.copyto(out, scaled.power)
+			return PowerData(scaled.dates, out, copy_dates=False)
+		if periods is None:
 			return self/self.get_average() * power
+		labels = self.get_group_labels(periods)
+		kept   = labels >= 0
+		(groups, inverse) = np.unique(labels[kept], return_inverse=True)
+		if isinstance(power, (float, int)):
+			targets = np.full(len(groups), float(power))
+		elif isinstance(periods, str):
+			targets = np.array(power, dtype=np.float64)
+		else:
+			#groups are period indices, periods without any date are simply skipped
+			targets = np.array(power, dtype=np.float64)[groups]
+		if len(targets) != len(groups):
+			raise Exception(f"expected {len(groups)} powers to scale to, got {len(targets)}")
+		values = np.asarray(self.power, dtype=np.float64)[kept]
+		means  = np.bincount(inverse, weights=values, minlength=len(groups)) / np.bincount(inverse, minlength=len(groups))
+		factors = np.divide(targets, means, out=np.zeros(len(groups)), where=means != 0)
+		dates = self.dates if kept.all() else [d for (d, k) in zip(self.dates, kept) if k]
+		return PowerData(dates, values * factors[inverse])
+
+	def get_time_step(self) -> float:
+		#most common delta between two consecutive dates, in seconds
+		deltas = np.diff(dates_to_seconds(self.dates))
+		if len(deltas) == 0:
+			return 0.0
+		(values, counts) = np.unique(deltas, return_counts=True)
+		return float(values[np.argmax(counts)])
+
+	def get_gaps(self, step : Union[timedelta, float, int] = None) -> List[Period]:
+		#periods where two consecutive dates are further apart than step (defaults to the usual time step)
+		if step is None:
+			step = self.get_time_step()
+		seconds = dates_to_seconds(self.dates)
+		holes = np.nonzero(np.diff(seconds) > to_seconds(step))[0]
+		return [Period(self.dates[i], self.dates[i + 1]) for i in holes]
+
+	def resample(self, step : Union[timedelta, float, int], how : str = "mean", fill_gaps : Optional[str] = None) -> PowerData:
+		#buckets are aligned on multiples of step since the epoch, each one is labelled by its beginning
+		#fill_gaps can be None (empty buckets are dropped), "zero" or "interpolate"
+		if how not in RESAMPLE_METHODS:
+			raise Exception(f"unknown resampling method {how}, expected one of {RESAMPLE_METHODS}")
+		if len(self.dates) == 0:
+			return PowerData([], np.array([]))
+		step = to_seconds(step)
+		seconds = dates_to_seconds(self.dates)
+		buckets = seconds // step
+		if np.any(np.diff(buckets) < 0):
+			raise Exception("dates should be sorted to be resampled")
+		#first index of every bucket, the data being sorted each bucket is contiguous
+		starts = np.concatenate(([0], np.nonzero(np.diff(buckets))[0] + 1))
+		power = np.asarray(self.power, dtype=np.float64)
+		if how == "sum":
+			values = np.add.reduceat(power, starts)
+		elif how == "mean":
+			values = np.add.reduceat(power, starts) / np.diff(np.append(starts, len(power)))
+		elif how == "max":
+			values = np.maximum.reduceat(power, starts)
+		else:
+			values = np.minimum.reduceat(power, starts)
+		used_buckets = buckets[starts]
+		if fill_gaps is None:
+			return PowerData(seconds_to_dates(used_buckets * step), values)
+		all_buckets = np.arange(used_buckets[0], used_buckets[-1] + 1)
+		if fill_gaps == "zero":
+			filled = np.zeros(len(all_buckets))
+			filled[used_buckets - used_buckets[0]] = values
+		elif fill_gaps == "interpolate":
+			filled = np.interp(all_buckets, used_buckets, values)
+		else:
+			raise Exception(f"unknown gap filling method {fill_gaps}")
+		return PowerData(seconds_to_dates(all_buckets * step), filled)
 
-		toReturn = PowerData([], np.array([]))
-		for i in range(len(power)):
-			newPowerData = self.get_slice_over_period(periods[i].beginning, periods[i].end)
-			newPowerData = newPowerData / newPowerData.get_average()
-			newPowerData = newPowerData * power[i]
-			toReturn = toReturn.get_merged_to(newPowerData)
-		return toReturn
+	def align_to(self, axis : Union[List[datetime], PowerData], interpolate : bool = True, fill_value : float = 0.0) -> PowerData:
+		#gets the values of this curve on the dates of axis, without dropping any of them
+		#dates outside of this curve take the closest value when interpolating
+		if isinstance(axis, PowerData):
+			axis = axis.dates
+		seconds = dates_to_seconds(self.dates)
+		axis_seconds = dates_to_seconds(axis)
+		if interpolate:
+			return PowerData(axis, np.interp(axis_seconds, seconds, self.power))
+		index = np.minimum(np.searchsorted(seconds, axis_seconds), len(seconds) - 1)
+		found = seconds[index] == axis_seconds
+		return PowerData(axis, np.where(found, np.asarray(self.power)[index], fill_value))
 
 class Battery(PowerData):
 	capacity : float
 	dated_energy : np.array(float)
-	def __init__(self, capacity : float, dates: List[datetime] = None, power: np.array = None,  dated_energy : List[float] = None):
+	#model of the battery, the defaults are an ideal one : powers in W (None for no limit) and efficiencies are on the grid
+	#side, self_discharge is the ratio of the stored energy lost per hour, the state of charge stays in [soc_min, soc_max]
+	#(ratios of the capacity) and starts at initial_soc (soc_min when None)
+	max_charge_power     : float
+	max_discharge_power  : float
+	charge_efficiency    : float
+	discharge_efficiency : float
+	self_discharge       : float
+	soc_min              : float
+	soc_max              : float
+	initial_soc          : float
+	def __init__(self, capacity : float, dates: List[datetime] = None, power: np.array = None,  dated_energy : List[float] = None,
+			max_charge_power : float = None, max_discharge_power : float = None, charge_efficiency : float = 1.0, discharge_efficiency : float = 1.0,
+			self_discharge : float = 0.0, soc_min : float = 0.0, soc_max : float = 1.0, initial_soc : float = None):
 		if dates is None or power is None:
 			dates = []
 			power = np.array([])
@@ -232,40 +428,268 @@ class Battery(PowerData):
 		self.capacity = capacity #capacity is in wh
 		#convention is here power is positive to charge the battery
 		self.dated_energy = dated_energy
-		if dated_energy == None:
+		if dated_energy is None:
 			self.dated_energy = []
-	def from_power_data(self, data : PowerData):
-		self.power = np.copy(data.power)
-		self.dates = data.dates[:]
-		energy = 0.0
-		self.dated_energy = np.zeros(len(self.dates))
-		for i in range(len(self.dates) - 1):
-			time_delta = ((self.dates[i + 1] - self.dates[i]).seconds / 3600)
-			nextEnergy = energy + self.power[i] * time_delta
-			nextEnergy = min(max(nextEnergy, 0), self.capacity)
-			self.power[i] = (nextEnergy - energy) / time_delta
-			energy = nextEnergy
-			self.dated_energy[i+1] = nextEnergy
-		self.power[-1] = 0.0
+		self.max_charge_power     = max_charge_power
+		self.max_discharge_power  = max_discharge_power
+		self.charge_efficiency    = charge_efficiency
+		self.discharge_efficiency = discharge_efficiency
+		self.self_discharge       = self_discharge
+		self.soc_min              = soc_min
+		self.soc_max              = soc_max
+		self.initial_soc          = initial_soc
+	def get_model(self) -> Dict[str, float]:
+		return {
+			"max_charge_power"     : self.max_charge_power,
+			"max_discharge_power"  : self.max_discharge_power,
+			"charge_efficiency"    : self.charge_efficiency,
+			"discharge_efficiency" : self.discharge_efficiency,
+			"self_discharge"       : self.self_discharge,
+			"soc_min"              : self.soc_min,
+			"soc_max"              : self.soc_max,
+			"initial_soc"          : self.initial_soc,
+		}
+	def is_ideal(self) -> bool:
+		#the ideal kernel is used for these batteries, the model gives the same powers
+		return bool((self.get_parameters()[1:] == Battery(self.capacity).get_parameters()[1:]).all())
+	def get_parameters(self) -> np.array:
+		#row of the parameters of battery_model_kernel, in the order of libsim.h
+		return np.array([
+			self.capacity,
+			self.max_charge_power if self.max_charge_power is not None else np.inf,
+			self.max_discharge_power if self.max_discharge_power is not None else np.inf,
+			self.charge_efficiency,
+			self.discharge_efficiency,
+			self.self_discharge,
+			self.soc_min,
+			self.soc_max,
+			self.capacity * (self.initial_soc if self.initial_soc is not None else self.soc_min),
+		], dtype=np.float64)
+	def from_power_data(self, data : PowerData, out : np.array = None, dated_energy : np.array = None, seconds : np.array = None):
+		#out and dated_energy are optional buffers of the data length, seconds the dates as float64 seconds if already known
+		#the battery power has the dtype of out, or of data without it, its dated energy is always float64
+		if out is None:
+			self.dates = data.dates[:]
+			power = np.array(as_power_array(data.power))
+		else:
+			self.dates = data.dates
+			power = data.copy_power_to(out)
+		if seconds is None:
+			seconds = dates_to_seconds(self.dates).astype(np.float64)
+		if self.is_ideal():
+			(self.power, self.dated_energy) = battery_kernel(power, seconds, self.capacity, dated_energy)
+		else:
+			(self.power, self.dated_energy) = battery_model_kernel(power, seconds, self.get_parameters(), power, dated_energy)
 
 	
 
 	def get_slice_over_period(self, beginning: datetime = None, end : datetime = None) -> Battery:
-		if (beginning == None):
-			beginning = self.dates[0]
-		if (end == None):
-			end = self.dates[-1]
-		i = 0
-		while(i < len(self.dates) and self.dates[i] < beginning):
-			i += 1
-		j = i
-		powerToReturn : List[float] = []
-		dateToReturn : List[datetime] = []
-		datedEnergy : List[float] = []
-		while(j < len(self.dates) and self.dates[j] < end):
-			powerToReturn.append(self.power[j])
-			dateToReturn.append(self.dates[j])
-			datedEnergy.append(self.dated_energy[j])
-			j += 1
-		return Battery(self.capacity, dateToReturn, np.array(powerToReturn), datedEnergy)
-	
\ No newline at end of file
+		(i, j) = self.get_period_indices(beginning, end)
+		return Battery(self.capacity, self.dates[i:j], np.array(self.power[i:j]), np.array(self.dated_energy[i:j]), **self.get_model())
+
+def simulate_batteries(data : PowerData, batteries : List[Battery], out : np.array = None, seconds : np.array = None, with_energy : bool = True) -> List[Battery]:
+	#every battery over the same power (production - consumption) in a single kernel call, sweeping the capacity or the
+	#model of the storage for one scenario, out is an optional (batteries, count) buffer of the dtype of data
+	#the batteries share the dates of data, their powers and dated energies are the rows of two matrices
+	if seconds is None:
+		seconds = dates_to_seconds(data.dates).astype(np.float64)
+	parameters = np.array([b.get_parameters() for b in batteries]).reshape((len(batteries), BATTERY_PARAM_COUNT))
+	(power, dated_energy) = battery_model_kernel(as_power_array(data.power), seconds, parameters, out, with_energy=with_energy)
+	power = power.reshape((len(batteries), len(data.dates)))
+	for (i, battery) in enumerate(batteries):
+		battery.dates = data.dates
+		battery.power = power[i]
+		battery.dated_energy = dated_energy.reshape(power.shape)[i] if with_energy else None
+	return batteries
+
+#lazy curves : operators build an expression tree (operation, left, right) whose leaves are float64 or float32 arrays or floats
+#it is evaluated chunk by chunk, every operation writing in a small float64 buffer of its own, so that a chain of operators
+#makes a single pass over its inputs without any full length temporary
+LAZY_CHUNK_SIZE = 1 << 13
+LAZY_OPERATIONS = {
+	"add"         : np.add,
+	"subtract"    : np.subtract,
+	"multiply"    : np.multiply,
+	"divide"      : np.divide,
+	"safe_divide" : np.divide, #division by 0 gives 0
+	"maximum"     : np.maximum,
+}
+Expression = Union[np.array, float, tuple]
+
+class Register():
+	__slots__ = ("index",)
+	def __init__(self, index : int):
+		self.index = index
+
+def compile_expression(expression : Expression) -> Tuple[List[Tuple[str, Any, Any]], Any]:
+	#postfix list of (operation, left, right), each writing in the register of its own index, and the result operand
+	program = []
+	def visit(node : Expression) -> Any:
+		if not isinstance(node, tuple):
+			return node
+		(operation, left, right) = node
+		(left, right) = (visit(left), visit(right))
+		program.append((operation, left, right))
+		return Register(len(program) - 1)
+	return (program, visit(expression))
+
+def slice_expression(expression : Expression, begin : int, end : int) -> Expression:
+	#the same expression over [begin, end[, leaves are sliced without copy
+	if isinstance(expression, tuple):
+		return (expression[0], slice_expression(expression[1], begin, end), slice_expression(expression[2], begin, end))
+	if isinstance(expression, np.ndarray):
+		return expression[begin:end]
+	return expression
+
+def iterate_expression(expression : Expression, begin : int, end : int, out : np.array = None, chunk_size : int = LAZY_CHUNK_SIZE) -> Iterator[np.array]:
+	#values of the expression over [begin, end[, one chunk at a time, chunks are only valid until the next one
+	#when out is given, the values are written in it, out[0] being the value at begin
+	(program, result) = compile_expression(expression)
+	registers = [np.empty(min(chunk_size, end - begin)) for i in range(len(program))]
+	for start in range(begin, end, chunk_size):
+		stop = min(start + chunk_size, end)
+		def value(operand : Any) -> Union[np.array, float]:
+			if isinstance(operand, Register):
+				return registers[operand.index][:stop - start]
+			if isinstance(operand, np.ndarray):
+				return operand[start:stop]
+			return operand
+		for (i, (operation, left, right)) in enumerate(program):
+			target = out[start - begin:stop - begin] if out is not None and i == len(program) - 1 else registers[i][:stop - start]
+			if operation == "safe_divide":
+				target.fill(0.0)
+				np.divide(value(left), value(right), out=target, where=np.asarray(value(right)) != 0)
+			else:
+				LAZY_OPERATIONS[operation](value(left), value(right), out=target)
+		chunk = value(result)
+		if out is not None and len(program) == 0:
+			out[start - begin:stop - begin] = chunk
+		yield chunk
+
+def get_expression_dtype(expression : Expression) -> Optional[type]:
+	#float32 when every array of the expression is float32, float64 when one of them isn't, None without any array
+	if isinstance(expression, np.ndarray):
+		return np.float32 if expression.dtype == np.float32 else np.float64
+	if not isinstance(expression, tuple):
+		return None
+	dtypes = [d for d in [get_expression_dtype(expression[1]), get_expression_dtype(expression[2])] if d is not None]
+	if len(dtypes) == 0:
+		return None
+	return np.float32 if all([d == np.float32 for d in dtypes]) else np.float64
+
+def evaluate_expression(expression : Expression, begin : int, end : int) -> np.array:
+	if isinstance(expression, np.ndarray):
+		return expression[begin:end]
+	out = np.empty(end - begin, dtype=get_expression_dtype(expression) or np.float64)
+	for chunk in iterate_expression(expression, begin, end, out):
+		pass
+	return out
+
+class LazyPowerData(PowerData):
+	#PowerData whose power is only computed when it is read, see PowerData.get_lazy
+	#operators and get_bigger_than return lazy curves, sums, averages and counts are computed chunk by chunk
+	#without ever building the full curve, reading power evaluates the expression once and keeps the result
+	#the dates are shared with the curves the expression was built from, not copied
+	expression : Expression
+	def __init__(self, dates : List[datetime], expression : Expression):
+		self.dates      = dates
+		self.expression = expression
+
+	@property
+	def power(self) -> np.array:
+		if not isinstance(self.expression, np.ndarray):
+			self.expression = evaluate_expression(self.expression, 0, len(self.dates))
+		return self.expression
+
+	@power.setter
+	def power(self, power : np.array):
+		self.expression = power
+
+	def get_operand(self, other : Union[PowerData, np.array, List[float], float, int]) -> Expression:
+		if isinstance(other, LazyPowerData):
+			if not self.check_simalarity(other):
+				raise Exception("data should be similar to be combined")#expect data to have the same dateTime
+			return other.expression
+		if isinstance(other, PowerData):
+			if not self.check_simalarity(other):
+				raise Exception("data should be similar to be combined")
+			return as_power_array(other.power)
+		if isinstance(other, (float, int)):
+			return float(other)
+		if len(other) != len(self.dates):
+			raise Exception("data should be similar to be combined")
+		return np.asarray(other, dtype=np.float64)
+
+	def check_simalarity(self, p2 : PowerData) -> bool:
+		#the length of power isn't compared, reading it would evaluate the expression
+		if len(self.dates) != len(p2.dates):
+			return False
+		return self.dates is p2.dates or self.dates == p2.dates
+
+	def apply(self, operation : str, other : Any) -> LazyPowerData:
+		return LazyPowerData(self.dates, (operation, self.expression, self.get_operand(other)))
+
+	def __add__(self, p2 : Union[PowerData, float, int]) -> PowerData:
+		if p2 is None:
+			return self.get_copy()
+		return self.apply("add", p2)
+
+	def __sub__(self, p2 : Union[PowerData, float, int]) -> PowerData:
+		return self.apply("subtract", p2)
+
+	def __mul__(self, toMul : Union[np.array, List[float], float, PowerData, int]) -> PowerData:
+		return self.apply("multiply", toMul)
+
+	def __truediv__(self, toDivBy : Union[np.array, List[float], float, PowerData]) -> PowerData:
+		return self.apply("safe_divide" if isinstance(toDivBy, PowerData) else "divide", toDivBy)
+
+	#the leaves of an expression are shared with other curves, they are never modified in place
+	__iadd__     = __add__
+	__isub__     = __sub__
+	__imul__     = __mul__
+	__itruediv__ = __truediv__
+
+	def get_bigger_than(self, power : Union[int, float], out : np.array = None) -> PowerData:
+		if out is not None:
+			return PowerData(self.dates, self.copy_power_to(out, ("maximum", self.expression, float(power))), copy_dates=False)
+		return self.apply("maximum", power)
+
+	def copy_power_to(self, out : np.array, expression : Expression = None) -> np.array:
+		#evaluates the expression in out, without keeping the result
+		expression = expression if expression is not None else self.expression
+		if isinstance(expression, np.ndarray):
+			np.copyto(out, expression)
+			return out
+		for chunk in iterate_expression(expression, 0, len(self.dates), out):
+			pass
+		return out
+
+	def get_lazy(self) -> LazyPowerData:
+		return self
+
+	def get_materialized(self) -> PowerData:
+		return PowerData(self.dates, self.power)
+
+	def get_slice_over_period(self, beginning : datetime = None, end : datetime = None, out : np.array = None, dates : List[datetime] = None) -> PowerData:
+		(i, j) = self.get_period_indices(beginning, end)
+		dates = dates if dates is not None else self.dates[i:j]
+		sliced = LazyPowerData(dates, slice_expression(self.expression, i, j))
+		if out is None:
+			return sliced
+		return PowerData(dates, sliced.copy_power_to(out), copy_dates=False)
+
+	def get_sum(self, beginning : datetime = None, end : datetime = None) -> float:
+		(i, j) = self.get_period_indices(beginning, end)
+		if isinstance(self.expression, np.ndarray):
+			return float(np.sum(self.expression[i:j], dtype=np.float64))
+		return float(sum([np.sum(chunk) for chunk in iterate_expression(self.expression, i, j)]))
+
+	def get_average(self, beginning : datetime = None, end : datetime = None) -> float:
+		#end is excluded, so is the last date when end isn't given
+		(i, j) = self.get_period_indices(beginning, end)
+		return self.get_sum(beginning, end) / (j - i)
+
+	def count_greater_than(self, val : float) -> int:
+		if isinstance(self.expression, np.ndarray):
+			return int(np.count_nonzero(self.expression > val))
+		return int(sum([np.count_nonzero(chunk > val) for chunk in iterate_expression(self.expression, 0, len(self.dates))]))
@@ -0,0 +1,153 @@
+#include "libsim.h"
+#include <math.h>
+
+//ideal storage, power is positive to charge the battery and is replaced by the power actually exchanged
+//dates are in seconds, dated_energy[i] is the energy stored at dates[i]
+void sim_battery(double* power, double* dates, size_t count, double capacity, double* dated_energy)
+{
+	double energy = 0.0;
+	if (count == 0)
+		return;
+	dated_energy[0] = 0.0;
+	for (size_t i = 0; i + 1 < count; i++)
+	{
+		double time_delta = (dates[i + 1] - dates[i]) / 3600.0;
+		double next_energy = energy;
+		if (time_delta > 0)
+		{
+			next_energy = MIN(MAX(energy + power[i] * time_delta, 0.0), capacity);
+			power[i] = (next_energy - energy) / time_delta;
+		}
+		else
+			power[i] = 0.0;
+		energy = next_energy;
+		dated_energy[i + 1] = next_energy;
+	}
+	power[count - 1] = 0.0;
+}
+
+//same simulation with float32 power, the stored energy is computed in double
+void sim_battery_f32(float* power, double* dates, size_t count, double capacity, double* dated_energy)
+{
+	double energy = 0.0;
+	if (count == 0)
+		return;
+	dated_energy[0] = 0.0;
+	for (size_t i = 0; i + 1 < count; i++)
+	{
+		double time_delta = (dates[i + 1] - dates[i]) / 3600.0;
+		double next_energy = energy;
+		if (time_delta > 0)
+		{
+			next_energy = MIN(MAX(energy + (double)power[i] * time_delta, 0.0), capacity);
+			power[i] = (float)((next_energy - energy) / time_delta);
+		}
+		else
+			power[i] = 0.0f;
+		energy = next_energy;
+		dated_energy[i + 1] = next_energy;
+	}
+	power[count - 1] = 0.0f;
+}
+
+//one step of dt hours of a battery of the model, energy being already reduced by the self-discharge of the step
+//request is the power offered (> 0) or asked (< 0) by the grid, exchanged gets the power actually drawn from or given to it
+//the power limits and the efficiencies are on the grid side, an ideal battery gives the same values as sim_battery
+static inline double battery_model_step(double energy, double request, double dt, double* parameters, double min_energy, double max_energy, double* exchanged)
+{
+	double next_energy = energy;
+	*exchanged = 0.0;
+	if (request > 0 && energy < max_energy)
+	{
+		next_energy = MIN(energy + MIN(request, parameters[BATTERY_MAX_CHARGE]) * dt * parameters[BATTERY_CHARGE_EFFICIENCY], max_energy);
+		*exchanged = (next_energy - energy) / (dt * parameters[BATTERY_CHARGE_EFFICIENCY]);
+	}
+	else if (request < 0 && energy > min_energy)
+	{
+		next_energy = MAX(energy + MAX(request, -parameters[BATTERY_MAX_DISCHARGE]) * dt / parameters[BATTERY_DISCHARGE_EFFICIENCY], min_energy);
+		*exchanged = (next_energy - energy) * parameters[BATTERY_DISCHARGE_EFFICIENCY] / dt;
+	}
+	return next_energy;
+}
+
+//batteries with power limits, efficiencies, self-discharge and state of charge bounds, parameters being one row of
+//BATTERY_PARAM_COUNT values per battery : battery b reads the requested power at power + b * power_stride (a stride of 0
+//shares one curve between every battery) and writes the exchanged power at exchanged + b * count, which can be power
+//itself, dated_energy (batteries, count) is the energy stored at every date, it can be NULL
+void sim_battery_model(double* power, size_t power_stride, double* dates, size_t count, size_t batteries, double* parameters, double* exchanged, double* dated_energy)
+{
+	if (count == 0)
+		return;
+	for (size_t b = 0; b < batteries; b++)
+	{
+		double* battery = parameters + b * BATTERY_PARAM_COUNT;
+		double* request = power + b * power_stride;
+		double* out = exchanged + b * count;
+		double* energies = dated_energy != NULL ? dated_energy + b * count : NULL;
+		double min_energy = battery[BATTERY_CAPACITY] * battery[BATTERY_SOC_MIN];
+		double max_energy = battery[BATTERY_CAPACITY] * battery[BATTERY_SOC_MAX];
+		double energy = battery[BATTERY_INITIAL_ENERGY];
+		//the retention only changes with the time step
+		double last_delta = 0.0;
+		double retention = 1.0;
+		if (energies != NULL)
+			energies[0] = energy;
+		for (size_t i = 0; i + 1 < count; i++)
+		{
+			double time_delta = (dates[i + 1] - dates[i]) / 3600.0;
+			double exchanged_power = 0.0;
+			if (time_delta > 0)
+			{
+				if (time_delta != last_delta)
+				{
+					retention = pow(1.0 - battery[BATTERY_SELF_DISCHARGE], time_delta);
+					last_delta = time_delta;
+				}
+				energy = battery_model_step(energy * retention, request[i], time_delta, battery, min_energy, max_energy, &exchanged_power);
+			}
+			out[i] = exchanged_power;
+			if (energies != NULL)
+				energies[i + 1] = energy;
+		}
+		out[count - 1] = 0.0;
+	}
+}
+
+//same simulation with float32 powers, the stored energy is computed in double
+void sim_battery_model_f32(float* power, size_t power_stride, double* dates, size_t count, size_t batteries, double* parameters, float* exchanged, double* dated_energy)
+{
+	if (count == 0)
+		return;
+	for (size_t b = 0; b < batteries; b++)
+	{
+		double* battery = parameters + b * BATTERY_PARAM_COUNT;
+		float* request = power + b * power_stride;
+		float* out = exchanged + b * count;
+		double* energies = dated_energy != NULL ? dated_energy + b * count : NULL;
+		double min_energy = battery[BATTERY_CAPACITY] * battery[BATTERY_SOC_MIN];
+		double max_energy = battery[BATTERY_CAPACITY] * battery[BATTERY_SOC_MAX];
+		double energy = battery[BATTERY_INITIAL_ENERGY];
+		double last_delta = 0.0;
+		double retention = 1.0;
+		if (energies != NULL)
+			energies[0] = energy;
+		for (size_t i = 0; i + 1 < count; i++)
+		{
+			double time_delta = (dates[i + 1] - dates[i]) / 3600.0;
+			double exchanged_power = 0.0;
+			if (time_delta > 0)
+			{
+				if (time_delta != last_delta)
+				{
+					retention = pow(1.0 - battery[BATTERY_SELF_DISCHARGE], time_delta);
+					last_delta = time_delta;
+				}
+				energy = battery_model_step(energy * retention, (double)request[i], time_delta, battery, min_energy, max_energy, &exchanged_power);
+			}
+			out[i] = (float)exchanged_power;
+			if (energies != NULL)
+				energies[i + 1] = energy;
+		}
+		out[count - 1] = 0.0f;
+	}
+}
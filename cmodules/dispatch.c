@@ -0,0 +1,157 @@
+#include "libsim.h"
+#include <stdlib.h>
+#include <math.h>
+
+//windows with at most this number of deficits (a day at a 30 minutes time step for instance) are sorted by insertion,
+//the level of longer ones (a year) is selected without sorting them
+#define SORTED_LENGTH 64
+
+static void sort_decreasing(double* values, size_t count)
+{
+	for (size_t i = 1; i < count; i++)
+	{
+		double value = values[i];
+		size_t j = i;
+		while (j > 0 && values[j - 1] < value)
+		{
+			values[j] = values[j - 1];
+			j--;
+		}
+		values[j] = value;
+	}
+}
+
+//level such that the sum of clip(deficit - level, 0, cap) is budget, 0 when the budget covers every deficit
+//sorted holds the deficits in decreasing order, the used energy is piecewise linear in the level, its breakpoints
+//are the deficits (a point starts being used) and the deficits minus the cap (the point is saturated),
+//both visited in decreasing order by a single merge
+static double water_level(double* sorted, size_t count, double budget, double cap)
+{
+	if (count == 0)
+		return 0.0;
+	double level = sorted[0];
+	if (budget <= 0.0)
+		return level;
+	size_t active = 0;
+	size_t saturated = 0;
+	double used = 0.0;
+	while (active < count || saturated < active)
+	{
+		double next_start = active < count ? sorted[active] : -INFINITY;
+		double next_saturation = saturated < active ? sorted[saturated] - cap : -INFINITY;
+		double next = MAX(MAX(next_start, next_saturation), 0.0);
+		//points used between level and next, used only grows so slope is positive once the budget is reached
+		size_t slope = active - saturated;
+		double next_used = used + (double)slope * (level - next);
+		if (next_used >= budget)
+			return level - (budget - used) / (double)slope;
+		if (next == 0.0)
+			return 0.0;
+		used = next_used;
+		level = next;
+		if (next_start >= next_saturation)
+			active++;
+		else
+			saturated++;
+	}
+	return 0.0;
+}
+
+//same level without sorting the deficits (all > 0, reordered), in expected linear time : the level is kept in ]low, high[,
+//the points whose contribution is linear over that interval are summed and dropped, and the interval is cut at a
+//breakpoint of one of the remaining points until none is left
+static double selected_water_level(double* deficits, size_t count, double budget, double cap)
+{
+	double low = 0.0;
+	double high = INFINITY;
+	double constant = 0.0;
+	size_t linear = 0;
+	if (budget <= 0.0)
+	{
+		for (size_t i = 0; i < count; i++)
+			low = MAX(low, deficits[i]);
+		return low;
+	}
+	while (1)
+	{
+		size_t kept = 0;
+		for (size_t i = 0; i < count; i++)
+		{
+			double deficit = deficits[i];
+			if (deficit <= low)
+				continue;
+			if (deficit - cap >= high)
+				constant += cap;
+			else if (deficit >= high && deficit - cap <= low)
+			{
+				constant += deficit;
+				linear++;
+			}
+			else
+			{
+				deficits[kept] = deficit;
+				kept++;
+			}
+		}
+		count = kept;
+		if (count == 0)
+			return linear == 0 ? low : (constant - budget) / (double)linear;
+		double pivot = deficits[count / 2];
+		if (pivot >= high)
+			pivot -= cap;
+		double used = constant - (double)linear * pivot;
+		for (size_t i = 0; i < count; i++)
+			used += MIN(MAX(deficits[i] - pivot, 0.0), cap);
+		if (used >= budget)
+			low = pivot;
+		else
+			high = pivot;
+	}
+}
+
+//dispatch of a piloted source over windows, window k being [starts[k], starts[k + 1][ of the deficits
+//(consumption - production, a surplus being negative is never covered)
+//the source produces at most budgets[k] (in power x points) and caps[k] at every point, INFINITY for no limit
+//dispatch[i] = clip(deficits[i] - level, 0, cap), the highest deficits being covered first
+//windows don't have to be contiguous, so the windows of several scenarios can be given at once
+void sim_dispatch(double* deficits, size_t window_count, int64_t* starts, double* budgets, double* caps, double* dispatch)
+{
+	size_t longest = 0;
+	for (size_t k = 0; k < window_count; k++)
+		longest = MAX(longest, (size_t)(starts[k + 1] - starts[k]));
+	double* positives = malloc(sizeof(double) * (longest + 1));
+	for (size_t k = 0; k < window_count; k++)
+	{
+		double* window = deficits + starts[k];
+		size_t count = starts[k + 1] - starts[k];
+		double level = 0.0;
+		if (!isinf(budgets[k]))
+		{
+			//only the points with a deficit are looked at again, none when the budget covers the whole window
+			double covered = 0.0;
+			size_t positive = 0;
+			for (size_t i = 0; i < count; i++)
+			{
+				if (window[i] > 0.0)
+				{
+					covered += MIN(window[i], caps[k]);
+					positives[positive] = window[i];
+					positive++;
+				}
+			}
+			if (covered > budgets[k])
+			{
+				if (positive > SORTED_LENGTH)
+					level = selected_water_level(positives, positive, budgets[k], caps[k]);
+				else
+				{
+					sort_decreasing(positives, positive);
+					level = water_level(positives, positive, budgets[k], caps[k]);
+				}
+			}
+		}
+		for (size_t i = 0; i < count; i++)
+			dispatch[starts[k] + i] = MIN(MAX(window[i] - level, 0.0), caps[k]);
+	}
+	free(positives);
+}
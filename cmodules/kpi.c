@@ -0,0 +1,71 @@
+#include "libsim.h"
+#include <math.h>
+
+//one pass over a simulation result for the AgglomeratedSimResults values
+//sums skip the last point, as PowerData.get_average does, counts and maximums use every point
+//battery can be NULL
+void sim_kpi(double* production, double* consumption, double* battery, size_t count, double* out)
+{
+	for (int k = 0; k < KPI_COUNT; k++)
+		out[k] = 0.0;
+	for (size_t i = 0; i < count; i++)
+	{
+		double diff = production[i] - consumption[i];
+		double exported = MAX(diff, 0.0);
+		double imported = MAX(-diff, 0.0);
+		if (exported > 0.0)
+			out[KPI_EXPORTED_COUNT] += 1.0;
+		if (imported > 0.0)
+			out[KPI_IMPORTED_COUNT] += 1.0;
+		out[KPI_EXPORTED_MAX] = (i == 0) ? exported : MAX(out[KPI_EXPORTED_MAX], exported);
+		out[KPI_IMPORTED_MAX] = (i == 0) ? imported : MAX(out[KPI_IMPORTED_MAX], imported);
+		if (i + 1 == count)
+			break;
+		out[KPI_PRODUCTION_SUM] += production[i];
+		out[KPI_CONSUMPTION_SUM] += consumption[i];
+		out[KPI_EXPORTED_SUM] += exported;
+		out[KPI_IMPORTED_SUM] += imported;
+		out[KPI_SELF_CONSUMED_SUM] += production[i] - exported;
+		out[KPI_SELF_PRODUCED_SUM] += consumption[i] - imported;
+		if (consumption[i] != 0.0)
+			out[KPI_COVERAGE_SUM] += production[i] / consumption[i];
+		if (battery != NULL)
+			out[KPI_BATTERY_CHARGE_SUM] += MAX(battery[i], 0.0);
+	}
+}
+
+//same pass over float32 curves, every value is converted to double before being summed
+//the float32 production left where the battery covers the difference misses the consumption by a rounding error of
+//either sign, so exchanges below EXCHANGE_TOLERANCE aren't counted
+void sim_kpi_f32(float* production, float* consumption, float* battery, size_t count, double* out)
+{
+	for (int k = 0; k < KPI_COUNT; k++)
+		out[k] = 0.0;
+	for (size_t i = 0; i < count; i++)
+	{
+		double produced = production[i];
+		double consumed = consumption[i];
+		double diff = produced - consumed;
+		double exported = MAX(diff, 0.0);
+		double imported = MAX(-diff, 0.0);
+		double tolerance = EXCHANGE_TOLERANCE * MAX(fabs(produced), fabs(consumed));
+		if (exported > tolerance)
+			out[KPI_EXPORTED_COUNT] += 1.0;
+		if (imported > tolerance)
+			out[KPI_IMPORTED_COUNT] += 1.0;
+		out[KPI_EXPORTED_MAX] = (i == 0) ? exported : MAX(out[KPI_EXPORTED_MAX], exported);
+		out[KPI_IMPORTED_MAX] = (i == 0) ? imported : MAX(out[KPI_IMPORTED_MAX], imported);
+		if (i + 1 == count)
+			break;
+		out[KPI_PRODUCTION_SUM] += produced;
+		out[KPI_CONSUMPTION_SUM] += consumed;
+		out[KPI_EXPORTED_SUM] += exported;
+		out[KPI_IMPORTED_SUM] += imported;
+		out[KPI_SELF_CONSUMED_SUM] += produced - exported;
+		out[KPI_SELF_PRODUCED_SUM] += consumed - imported;
+		if (consumed != 0.0)
+			out[KPI_COVERAGE_SUM] += produced / consumed;
+		if (battery != NULL)
+			out[KPI_BATTERY_CHARGE_SUM] += MAX((double)battery[i], 0.0);
+	}
+}
@@ -1,11 +1,52 @@
 #ifndef LIBSIM_H
 #define LIBSIM_H
 #include <stdlib.h>
+#include <stdint.h>
 #define TOLERATED_ERROR 0.00000001
+//float32 curves : an exchange smaller than this ratio of the production or consumption is rounding left by the battery,
+//it isn't counted
+#define EXCHANGE_TOLERANCE 0.000001
 #define MAX(X, Y) ((X > Y) ? X : Y)
 #define MIN(X, Y) ((X < Y) ? X : Y)
 
+//indices of the values computed by sim_kpi
+#define KPI_PRODUCTION_SUM     0
+#define KPI_CONSUMPTION_SUM    1
+#define KPI_IMPORTED_SUM       2
+#define KPI_EXPORTED_SUM       3
+#define KPI_IMPORTED_COUNT     4
+#define KPI_EXPORTED_COUNT     5
+#define KPI_IMPORTED_MAX       6
+#define KPI_EXPORTED_MAX       7
+#define KPI_SELF_CONSUMED_SUM  8
+#define KPI_SELF_PRODUCED_SUM  9
+#define KPI_COVERAGE_SUM       10
+#define KPI_BATTERY_CHARGE_SUM 11
+#define KPI_COUNT              12
+
+//columns of the parameters of every battery of sim_battery_model
+#define BATTERY_CAPACITY             0 //Wh
+#define BATTERY_MAX_CHARGE           1 //W drawn from the grid, INFINITY for no limit
+#define BATTERY_MAX_DISCHARGE        2 //W given to the grid, INFINITY for no limit
+#define BATTERY_CHARGE_EFFICIENCY    3
+#define BATTERY_DISCHARGE_EFFICIENCY 4
+#define BATTERY_SELF_DISCHARGE       5 //ratio of the stored energy lost per hour
+#define BATTERY_SOC_MIN              6 //ratios of the capacity
+#define BATTERY_SOC_MAX              7
+#define BATTERY_INITIAL_ENERGY       8 //Wh, stored at the first date
+#define BATTERY_PARAM_COUNT          9
+
 void sim_flex(double* production, double* consumption, double* dates, size_t count, double delta_dates, double flex_ratio, double* flex_usage_ratio);
+void sim_flex_classes(double* production, double* consumption, size_t classes, double* dates, size_t count, double delta_dates, double* ratios, double* total, double* flex_usage_ratio, size_t periods, double* class_usage_ratio);
 void sort_indices(size_t* indices, double* diff, int length);
+void sim_battery(double* power, double* dates, size_t count, double capacity, double* dated_energy);
+void sim_battery_model(double* power, size_t power_stride, double* dates, size_t count, size_t batteries, double* parameters, double* exchanged, double* dated_energy);
+void sim_kpi(double* production, double* consumption, double* battery, size_t count, double* out);
+//float32 variants, the energy and the sums are kept in double
+void sim_battery_f32(float* power, double* dates, size_t count, double capacity, double* dated_energy);
+void sim_battery_model_f32(float* power, size_t power_stride, double* dates, size_t count, size_t batteries, double* parameters, float* exchanged, double* dated_energy);
+void sim_kpi_f32(float* production, float* consumption, float* battery, size_t count, double* out);
+void sim_dispatch(double* deficits, size_t window_count, int64_t* starts, double* budgets, double* caps, double* dispatch);
+void rolling_extremum(double* values, size_t rows, size_t count, int64_t* window_begin, int64_t* window_end, size_t out_count, int is_max, double* out);
 
 #endif
\ No newline at end of file
@@ -0,0 +1,34 @@
+#include "libsim.h"
+#include <stdlib.h>
+#include <math.h>
+
+//sliding window minimum or maximum with a monotonic deque, O(count) per row
+//windows are [window_begin[k], window_end[k][, both bounds must be non-decreasing with k
+void rolling_extremum(double* values, size_t rows, size_t count, int64_t* window_begin, int64_t* window_end, size_t out_count, int is_max, double* out)
+{
+	int64_t* deque = malloc(sizeof(int64_t) * (count + 1));
+	for (size_t r = 0; r < rows; r++)
+	{
+		double* row = values + r * count;
+		double* row_out = out + r * out_count;
+		size_t front = 0;
+		size_t back = 0;
+		int64_t next = 0;
+		for (size_t k = 0; k < out_count; k++)
+		{
+			while (next < window_end[k])
+			{
+				//drops every value that can't be the extremum anymore
+				while (back > front && (is_max ? row[deque[back - 1]] <= row[next] : row[deque[back - 1]] >= row[next]))
+					back --;
+				deque[back] = next;
+				back ++;
+				next ++;
+			}
+			while (back > front && deque[front] < window_begin[k])
+				front ++;
+			row_out[k] = (back > front) ? row[deque[front]] : NAN;
+		}
+	}
+	free(deque);
+}
@@ -92,6 +92,73 @@ double* caculate_diff(double* production, double* consumption, size_t count)
 	return diff;
 }
 
+//levels one period of diff (consumption - production), day_indices being its indices sorted by increasing diff :
+//flex is taken from the highest points and the same amount is given to the lowest ones, consumption gets the same changes
+//returns the ratio of the flexibility that was used when every point got levelled, 1.0 when the flexibility ran out before
+static double flex_period(double* diff, double* consumption, size_t* day_indices, int width, double flex)
+{
+	double flex_up = flex;
+	double flex_down = flex_up;
+	double total_flex = flex_up + flex_down;
+	int right_index = width - 1;
+	double diff_with_last;
+	double daily_flex_usage = 1.0;
+	int daily_flex_usage_final = 0;
+	while (flex_down > TOLERATED_ERROR)
+	{
+		diff_with_last = flex_down / (width - right_index);
+		if (right_index > 0)
+		{
+			diff_with_last = diff[day_indices[right_index]] - diff[day_indices[right_index - 1]];
+		}
+		else{
+			if (daily_flex_usage_final == 0)
+			{
+				daily_flex_usage = (total_flex - flex_up - flex_down) / total_flex;
+				daily_flex_usage_final = 1;
+			}
+		}
+
+		diff_with_last = MIN(diff_with_last, flex_down / (width - right_index));
+		for (int i = right_index; i < width; i++)
+		{
+			diff[day_indices[i]] -= diff_with_last;
+			consumption[day_indices[i]] -= diff_with_last;
+			flex_down -= diff_with_last;
+		}
+		if (right_index > 0)
+			right_index --;
+	}
+	
+	int left_index = 0;
+	while (flex_up > TOLERATED_ERROR)
+	{
+		diff_with_last = flex_up / (left_index + 1);
+		if (left_index + 1 < width)
+		{
+			diff_with_last = diff[day_indices[left_index + 1]] - diff[day_indices[left_index]];
+		}
+		else
+		{
+			if (daily_flex_usage_final == 0)
+			{
+				daily_flex_usage = (total_flex - flex_up - flex_down) / total_flex;
+				daily_flex_usage_final = 1;
+			}
+		}
+		diff_with_last = MIN(diff_with_last, flex_up / (left_index + 1));
+		for (int i = 0; i < left_index + 1; i++)
+		{
+			diff[day_indices[i]] += diff_with_last;
+			consumption[day_indices[i]] += diff_with_last;
+			flex_up -= diff_with_last;
+		}
+		if (left_index + 1 < width)
+		left_index ++;
+	}
+	return daily_flex_usage;
+}
+
 void sim_flex(double* production, double* consumption, double* dates, size_t count, double delta_dates, double flex_ratio, double* flex_usage_ratio)
 {
 	double* diff = caculate_diff(production, consumption, count);
@@ -110,74 +177,158 @@ void sim_flex(double* production, double* consumption, double* dates, size_t cou
 			}
 			sort_indices(day_indices, diff, width);
 
-			double flex_up = total_power * flex_ratio;
-			double flex_down = flex_up;
-			double total_flex = flex_up + flex_down;
-			int right_index = width - 1;
-			double diff_with_last;
-			double daily_flex_usage = 1.0;
-			int daily_flex_usage_final = 0;
-			while (flex_down > TOLERATED_ERROR)
+			flex_usage_ratio[current_day_index] = flex_period(diff, consumption, day_indices, width, total_power * flex_ratio);
+			current_day_index ++;
+			//going to next period
+			last_date = dates[i];
+			j = i;
+			total_power = 0;
+			free(day_indices);
+		}
+		total_power += consumption[i];
+	}
+	free(diff);
+}
+
+//takes reduction from the classes at point k, in proportion of their flexible consumption there (ratio times consumption),
+//a class giving at most its consumption at k and what is left of its budget over the period : the classes that would give
+//more give all they can and the others share what is left, moved gets what every class gave, returns what none could give
+static double share_reduction(double* consumption, size_t classes, size_t count, size_t k, double* ratios, double* budget, double* moved, int* full, double reduction)
+{
+	for (size_t c = 0; c < classes; c++)
+		full[c] = ratios[c] <= 0 || consumption[c * count + k] <= 0 || moved[c] >= budget[c];
+	while (reduction > 0)
+	{
+		double weight = 0;
+		for (size_t c = 0; c < classes; c++)
+			if (!full[c])
+				weight += ratios[c] * consumption[c * count + k];
+		if (weight <= 0)
+			break;
+		double shared = reduction;
+		int capped = 0;
+		for (size_t c = 0; c < classes; c++)
+		{
+			if (full[c])
+				continue;
+			double room = MIN(consumption[c * count + k], budget[c] - moved[c]);
+			if (shared * ratios[c] * consumption[c * count + k] / weight >= room)
 			{
-				diff_with_last = flex_down / (width - right_index);
-				if (right_index > 0)
-				{
-					diff_with_last = diff[day_indices[right_index]] - diff[day_indices[right_index - 1]];
-				}
-				else{
-					if (daily_flex_usage_final == 0)
-					{
-						daily_flex_usage = (total_flex - flex_up - flex_down) / total_flex;
-						daily_flex_usage_final = 1;
-					}
-				}
+				consumption[c * count + k] -= room;
+				moved[c] += room;
+				reduction -= room;
+				full[c] = 1;
+				capped = 1;
+			}
+		}
+		if (capped)
+			continue;
+		for (size_t c = 0; c < classes; c++)
+		{
+			if (full[c])
+				continue;
+			double part = shared * ratios[c] * consumption[c * count + k] / weight;
+			consumption[c * count + k] -= part;
+			moved[c] += part;
+		}
+		reduction = 0;
+	}
+	return reduction;
+}
 
-				diff_with_last = MIN(diff_with_last, flex_down / (width - right_index));
-				for (int i = right_index; i < width; i++)
-				{
-					diff[day_indices[i]] -= diff_with_last;
-					consumption[day_indices[i]] -= diff_with_last;
-					flex_down -= diff_with_last;
-				}
-				if (right_index > 0)
-					right_index --;
+//flexibility of several consumer classes, consumption being their (classes, count) matrix : in every period, class c
+//can move ratios[c] of its consumption. The total consumption is levelled as sim_flex would with the flexibility of
+//every class summed, the reductions of the points are then taken from the classes by share_reduction in date order, so
+//that no class goes below 0 or moves more than its ratio, and every increase is shared between the classes in
+//proportion of what they gave over the period, so that each class keeps its energy. A reduction that no class can give
+//stays on its point and the increases are lowered by as much. total gets the flexed total consumption, flex_usage_ratio
+//the usage of every period and class_usage_ratio the one of every (class, period), the ratio of its budget it moved,
+//periods being its row length, 1.0 for a class without flexibility
+void sim_flex_classes(double* production, double* consumption, size_t classes, double* dates, size_t count, double delta_dates, double* ratios, double* total, double* flex_usage_ratio, size_t periods, double* class_usage_ratio)
+{
+	for (size_t i = 0; i < count; i++)
+	{
+		total[i] = consumption[i];
+		for (size_t c = 1; c < classes; c++)
+			total[i] += consumption[c * count + i];
+	}
+	double* diff = caculate_diff(production, total, count);
+	double* before = malloc(count * sizeof(double));
+	double* class_flex = calloc(classes, sizeof(double));
+	double* moved = malloc(classes * sizeof(double));
+	int* full = malloc(classes * sizeof(int));
+	double last_date = dates[0];
+	int j = 0;
+	size_t current_day_index = 0;
+	for (int i = 0; i < count; i++)
+	{
+		if (dates[i] - last_date >= delta_dates || i == count - 1)
+		{
+			int width = i - j;
+			size_t* day_indices = malloc(sizeof(size_t) * width);
+			for (int k = 0; k < width; k++){
+				day_indices[k] = k + j;
 			}
-			
-			int left_index = 0;
-			while (flex_up > TOLERATED_ERROR)
+			sort_indices(day_indices, diff, width);
+			double flex = 0;
+			for (size_t c = 0; c < classes; c++)
+			{
+				class_flex[c] *= ratios[c];
+				flex += class_flex[c];
+				moved[c] = 0;
+			}
+			for (int k = j; k < i; k++)
+				before[k] = total[k];
+			double usage = flex_period(diff, total, day_indices, width, flex);
+			//reductions, then the increases, knowing what the classes gave
+			double down = 0;
+			double up = 0;
+			double given = 0;
+			for (int k = j; k < i; k++)
 			{
-				diff_with_last = flex_up / (left_index + 1);
-				if (left_index + 1 < width)
+				double change = total[k] - before[k];
+				if (change < 0)
 				{
-					diff_with_last = diff[day_indices[left_index + 1]] - diff[day_indices[left_index]];
+					double left = share_reduction(consumption, classes, count, k, ratios, class_flex, moved, full, -change);
+					down -= change;
+					given += -change - left;
+					total[k] = before[k] + change + left;
 				}
 				else
+					up += change;
+			}
+			for (int k = j; k < i; k++)
+			{
+				double change = total[k] - before[k];
+				if (change > 0)
 				{
-					if (daily_flex_usage_final == 0)
-					{
-						daily_flex_usage = (total_flex - flex_up - flex_down) / total_flex;
-						daily_flex_usage_final = 1;
-					}
-				}
-				diff_with_last = MIN(diff_with_last, flex_up / (left_index + 1));
-				for (int i = 0; i < left_index + 1; i++)
-				{
-					diff[day_indices[i]] += diff_with_last;
-					consumption[day_indices[i]] += diff_with_last;
-					flex_up -= diff_with_last;
+					total[k] = before[k] + change * given / up;
+					for (size_t c = 0; c < classes; c++)
+						consumption[c * count + k] += change * moved[c] / up;
 				}
-				if (left_index + 1 < width)
-				left_index ++;
 			}
-			flex_usage_ratio[current_day_index] = daily_flex_usage;
+			if (down > 0)
+				usage *= given / down;
+			for (size_t c = 0; c < classes; c++)
+			{
+				if (current_day_index < periods)
+					class_usage_ratio[c * periods + current_day_index] = class_flex[c] > 0 ? MIN(moved[c] / class_flex[c], 1.0) : 1.0;
+				class_flex[c] = 0;
+			}
+			if (current_day_index < periods)
+				flex_usage_ratio[current_day_index] = usage;
 			current_day_index ++;
 			//going to next period
 			last_date = dates[i];
 			j = i;
-			total_power = 0;
 			free(day_indices);
 		}
-		total_power += consumption[i];
+		for (size_t c = 0; c < classes; c++)
+			class_flex[c] += consumption[c * count + i];
 	}
+	free(full);
+	free(moved);
+	free(class_flex);
+	free(before);
 	free(diff);
-}
\ No newline at end of file
+}
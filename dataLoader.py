@@ -5,8 +5,10 @@ import numpy as np
 
 if len(__name__.split("."))==1:
 	from calc import PowerData, Period
+	from stream_merge import merge_summed, hourly_buckets, read_dated_values, parse_enedis_date
 else:
 	from .calc import PowerData, Period
+	from .stream_merge import merge_summed, hourly_buckets, read_dated_values, parse_enedis_date
 
 class dataloader():
 	def load_prod(self, path : str, startDate : Optional[datetime] = None) -> PowerData:
@@ -47,6 +49,17 @@ class dataloader():
 				dates.append(date)
 				power.append(float(splittedLine[1]))
 		return PowerData(dates, np.array(power))
+	def load_merged_users(self, paths : List[str], startDate : Optional[datetime] = None, intersect : bool = True) -> PowerData:
+		#same format as load_one_user, the files are streamed and summed hour by hour without loading them first
+		dates = []
+		power = []
+		sources = [hourly_buckets(read_dated_values(path, date_parser = lambda d : parse_enedis_date(d, utc = True), skip_header = True)) for path in paths]
+		for (date, value) in merge_summed(sources, intersect):
+			if (startDate != None and date < startDate):
+				continue
+			dates.append(date)
+			power.append(value)
+		return PowerData(dates, np.array(power))
 	def load_solar_panel_prod(self, path : str, startDate : Optional[datetime] = None) -> PowerData:
 		#expecting a csv mm/dd/yyyy hh:mm:ss,"12,34"
 		with open(path) as inp:
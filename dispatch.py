@@ -0,0 +1,58 @@
+from __future__ import annotations
+from typing import *
+from datetime import datetime
+import numpy as np
+if len(__name__.split("."))==1:
+	from calc import get_calendar_labels
+	from kernels import dispatch_kernel
+else:
+	from .calc import get_calendar_labels
+	from .kernels import dispatch_kernel
+
+#dispatch of a piloted (dispatchable) source by water filling : in every window (a day or a year), the source shaves
+#the highest deficits first, down to a level chosen so that it uses its whole energy budget, each point getting
+#at most the power cap. The level of a window is found exactly by walking the breakpoints of the used energy over
+#its sorted deficits (or by selecting them for long windows), instead of simulating the time steps one after the other
+#the native kernel (cmodules/dispatch.c) solves any list of windows, those of several scenarios at once
+DISPATCH_WINDOWS = ["day", "year"]
+
+class WindowLayout():
+	#first point of every window (and the end of the last one) and its number of points, dates can be their
+	#dates_to_seconds
+	starts : np.array
+	counts : np.array
+	def __init__(self, dates : Union[List[datetime], np.array], window : str):
+		if window not in DISPATCH_WINDOWS:
+			raise Exception(f"unknown dispatch window {window}, expected one of {DISPATCH_WINDOWS}")
+		labels = get_calendar_labels(dates, window)
+		#dates are sorted, so every window is contiguous
+		starts = np.concatenate(([0], np.nonzero(np.diff(labels))[0] + 1)) if len(labels) != 0 else np.array([], dtype=np.int64)
+		self.starts = np.append(starts, len(labels)).astype(np.int64)
+		self.counts = np.diff(self.starts)
+
+def dispatch_in_windows(deficits : np.array, layout : WindowLayout, power : Union[float, np.array, None], cap : Union[float, np.array, None], out : np.array = None) -> np.array:
+	#power of the source at every point, for the deficits (consumption - production, a negative surplus is never
+	#covered) of one scenario (n,) or of several ones (scenarios, n) whose windows are then solved by a single kernel
+	#call, power is the average power the source may produce over every window (None for no energy budget) and cap its
+	#maximum power (None for no maximum), both a single value or one per scenario
+	if power is None and cap is None:
+		raise Exception("a piloted source needs an energy budget or a maximum power")
+	scenario_count = 1 if deficits.ndim == 1 else len(deficits)
+	length = deficits.shape[-1]
+	counts = layout.counts
+	starts = layout.starts
+	if scenario_count != 1:
+		counts = np.tile(counts, scenario_count)
+		starts = np.append((starts[:-1] + length * np.arange(scenario_count)[:, None]).ravel(), length * scenario_count)
+	def per_window(value : Union[float, np.array, None]) -> np.array:
+		value = np.asarray(np.inf if value is None else value, dtype=np.float64)
+		return np.full(len(counts), value) if value.ndim == 0 else np.repeat(value, len(layout.counts))
+	budgets = per_window(power) * counts if power is not None else per_window(None)
+	if out is not None and out.dtype == np.float64 and out.flags["C_CONTIGUOUS"]:
+		dispatch_kernel(deficits.ravel(), starts, budgets, per_window(cap), out.reshape(-1))
+		return out
+	dispatch = dispatch_kernel(deficits.ravel(), starts, budgets, per_window(cap)).reshape(deficits.shape)
+	if out is None:
+		return dispatch
+	np.copyto(out, dispatch)
+	return out
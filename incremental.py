@@ -0,0 +1,464 @@
+from __future__ import annotations
+from typing import *
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from dataclasses import asdict, fields
+from datetime import datetime
+from math import ceil, log
+import hashlib
+import json
+import os
+import pickle
+import numpy as np
+if len(__name__.split("."))==1:
+	from calc import PowerData, dates_to_seconds, get_calendar_labels
+	from kernels import *
+	from sim import SimParams, AgglomeratedSimResults, simulate_flexibility_ratios, simulate_class_flexibility
+	from sweep import set_point, simulate_point, AXES, AXIS_KEYS
+	from dispatch import WindowLayout, dispatch_in_windows
+else:
+	from .calc import PowerData, dates_to_seconds, get_calendar_labels
+	from .kernels import *
+	from .sim import SimParams, AgglomeratedSimResults, simulate_flexibility_ratios, simulate_class_flexibility
+	from .sweep import set_point, simulate_point, AXES, AXIS_KEYS
+	from .dispatch import WindowLayout, dispatch_in_windows
+
+#incremental sweep : when new months of data are appended to the curves, every point only simulates the new dates.
+#The state of a point at the end of the simulated data is stored with it, each stage holding the points it can't
+#finish yet, as OnlineSimulator does but chunk by chunk with the native kernels :
+#  flexibility       : the open period (a day from its first date, as in sim_flex) and the usage ratio of every period
+#  piloted bioenergy : the open window (calendar day or year)
+#  battery           : the last point, whose step needs the next date, and the energy stored at its date
+#  kpis              : the sums, counts and maximums of kpi_sums and a percentile sketch of the consumption and import
+#The kpis of a run are those of a copy of the states ended as the end of the curves ends a batch simulation.
+#Scaled curves are scaled by their averages over the current data (the references) : when the new months move them,
+#every point is simulated again from the begin, so only the unscaled curves save the dates already simulated.
+#The kpis are those of sweep.simulate_point (see IncrementalSweep.check), except for the order of the sums (added
+#run by run) and the percentiles (within the accuracy of the sketch)
+DAY = 24 * 3600.0
+#relative accuracy of the percentiles
+SKETCH_ACCURACY = 0.001
+#relative difference of the other kpis tolerated by IncrementalSweep.check
+CHECK_TOLERANCE = 1e-9
+PERCENTILE_KPIS = {"low_conso_peak" : 5, "high_conso_peak" : 95, "low_import_peak" : 5, "high_import_peak" : 95}
+KPI_NAMES = [f.name for f in fields(AgglomeratedSimResults)]
+#kpi_sums values added, counted and maximized by the runs
+SUMMED_KPIS = [KPI_PRODUCTION_SUM, KPI_CONSUMPTION_SUM, KPI_EXPORTED_SUM, KPI_IMPORTED_SUM, KPI_SELF_CONSUMED_SUM, KPI_SELF_PRODUCED_SUM, KPI_COVERAGE_SUM, KPI_BATTERY_CHARGE_SUM]
+COUNTED_KPIS = [KPI_EXPORTED_COUNT, KPI_IMPORTED_COUNT]
+MAXIMIZED_KPIS = [KPI_EXPORTED_MAX, KPI_IMPORTED_MAX]
+META_FILE = "meta.json"
+STATES_FILE = "states.pickle"
+
+class PercentileSketch():
+	#histogram of logarithmic buckets whose percentiles are PowerData.get_percentile within a relative accuracy :
+	#bucket k holds the values of ]gamma^(k-1), gamma^k] (negative values by their opposite), gamma = (1+a)/(1-a)
+	#and gives 2*gamma^k/(gamma+1), so its size only grows with the range of the values, not with their count
+	#the keys of the used buckets are kept sorted with their counts, add replaces the arrays instead of modifying them
+	accuracy        : float
+	count           : int
+	zeros           : int
+	positive_keys   : np.array
+	positive_counts : np.array
+	negative_keys   : np.array
+	negative_counts : np.array
+	def __init__(self, accuracy : float = SKETCH_ACCURACY):
+		self.accuracy = accuracy
+		self.gamma    = (1 + accuracy) / (1 - accuracy)
+		self.count    = 0
+		self.zeros    = 0
+		(self.positive_keys, self.positive_counts) = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+		(self.negative_keys, self.negative_counts) = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+	def add(self, values : np.array):
+		values = np.asarray(values, dtype=np.float64)
+		self.count += len(values)
+		self.zeros += int(np.count_nonzero(values == 0))
+		def merge(keys : np.array, counts : np.array, selected : np.array) -> Tuple[np.array, np.array]:
+			new_keys = np.ceil(np.log(selected) / log(self.gamma)).astype(np.int64)
+			(merged, inverse) = np.unique(np.concatenate((keys, new_keys)), return_inverse=True)
+			weights = np.concatenate((counts, np.ones(len(new_keys), dtype=np.int64)))
+			return (merged, np.bincount(inverse, weights, len(merged)).astype(np.int64))
+		(self.positive_keys, self.positive_counts) = merge(self.positive_keys, self.positive_counts, values[values > 0])
+		(self.negative_keys, self.negative_counts) = merge(self.negative_keys, self.negative_counts, -values[values < 0])
+
+	def get_value(self, key : int) -> float:
+		return 2 * self.gamma ** float(key) / (self.gamma + 1)
+
+	def get(self, percentile : float) -> float:
+		#value of rank int(percentile * count / 100), as get_percentile
+		rank = int(percentile * self.count / 100)
+		#negative buckets from the largest opposite, then the zeros, then the positive buckets
+		negative = np.cumsum(self.negative_counts[::-1])
+		if len(negative) != 0 and rank < negative[-1]:
+			return -self.get_value(self.negative_keys[::-1][np.searchsorted(negative, rank, side="right")])
+		rank -= int(negative[-1]) if len(negative) != 0 else 0
+		if rank < self.zeros:
+			return 0.0
+		positive = np.cumsum(self.positive_counts)
+		rank -= self.zeros
+		if len(positive) == 0 or rank >= positive[-1]:
+			return float("nan")
+		return self.get_value(self.positive_keys[np.searchsorted(positive, rank, side="right")])
+
+class Chunk():
+	#consecutive points held by a stage, consumers is the (classes, count) matrix of the consumer curves weighted by
+	#their contribution, only kept with flexibility by consumer class
+	dates       : List[datetime]
+	timestamps  : np.array
+	seconds     : np.array
+	production  : np.array
+	consumption : np.array
+	consumers   : Optional[np.array]
+	def __init__(self, dates : List[datetime], timestamps : np.array, seconds : np.array, production : np.array, consumption : np.array, consumers : np.array = None):
+		self.dates       = dates
+		self.timestamps  = timestamps
+		self.seconds     = seconds
+		self.production  = production
+		self.consumption = consumption
+		self.consumers   = consumers
+
+	@classmethod
+	def empty(cls, consumer_count : int = None) -> Chunk:
+		return cls([], np.empty(0), np.empty(0), np.empty(0), np.empty(0), np.empty((consumer_count, 0)) if consumer_count is not None else None)
+
+	def __len__(self) -> int:
+		return len(self.dates)
+
+	def get_slice(self, begin : int, end : int) -> Chunk:
+		return Chunk(self.dates[begin:end], self.timestamps[begin:end], self.seconds[begin:end], self.production[begin:end], self.consumption[begin:end],
+			self.consumers[:, begin:end] if self.consumers is not None else None)
+
+	def get_concatenated(self, other : Chunk) -> Chunk:
+		if len(self) == 0:
+			return other
+		if len(other) == 0:
+			return self
+		return Chunk(self.dates + other.dates, *[np.concatenate((a, b)) for (a, b) in [(self.timestamps, other.timestamps), (self.seconds, other.seconds), (self.production, other.production), (self.consumption, other.consumption)]],
+			np.concatenate((self.consumers, other.consumers), axis=1) if self.consumers is not None else None)
+
+class ScenarioState():
+	#what a point needs to go on simulating after the last simulated date
+	period          : Chunk
+	flex_ratios     : List[float]
+	first_timestamp : Optional[float]
+	last_timestamp  : Optional[float]
+	window          : Chunk
+	pending         : Chunk
+	energy          : float
+	sums            : np.array
+	points          : int
+	summed          : int
+	consumption     : PercentileSketch
+	imported        : PercentileSketch
+	def __init__(self, consumer_count : Optional[int], energy : float, accuracy : float = SKETCH_ACCURACY):
+		self.period          = Chunk.empty(consumer_count)
+		self.flex_ratios     = []
+		self.first_timestamp = None
+		self.last_timestamp  = None
+		self.window          = Chunk.empty()
+		self.pending         = Chunk.empty()
+		self.energy          = energy
+		#over the points that went through every stage, in the order of kpi_sums
+		self.sums            = np.zeros(KPI_COUNT)
+		self.points          = 0
+		self.summed          = 0
+		self.consumption     = PercentileSketch(accuracy)
+		self.imported        = PercentileSketch(accuracy)
+
+	def get_copy(self) -> ScenarioState:
+		#the held chunks are never modified in place, they are shared with the copy
+		state = copy(self)
+		state.flex_ratios = self.flex_ratios[:]
+		state.sums        = self.sums.copy()
+		state.consumption = copy(self.consumption)
+		state.imported    = copy(self.imported)
+		return state
+
+def get_period_starts(timestamps : np.array) -> List[int]:
+	#first point of every flexibility period, sim_flex ending a period at the first date a day after its start
+	if len(timestamps) == 0:
+		return []
+	starts = [0]
+	while True:
+		start = int(np.searchsorted(timestamps, timestamps[starts[-1]] + DAY, side="left"))
+		if start >= len(timestamps):
+			return starts
+		starts.append(start)
+
+class IncrementalSweep():
+	#sweep over curves growing at their end, whose states are stored in the directory path : a run over curves extended
+	#by new months only simulates the dates after the last simulated one. The data already simulated must be left
+	#unchanged (checked with a hash), as must the scalars of sim_params, and only float64 curves are supported
+	#points of a run that aren't in the directory yet are simulated from the begin of the params
+	sim_params : SimParams
+	path       : str
+	accuracy   : float
+	def __init__(self, sim_params : SimParams, path : str, accuracy : float = SKETCH_ACCURACY):
+		sim_params.check_and_convert_params()
+		if sim_params.dtype != "float64":
+			raise Exception("an incremental sweep needs float64 curves")
+		self.sim_params = sim_params
+		self.path       = path
+		self.accuracy   = accuracy
+		curve = sim_params.consumer_curves[0]
+		(self.begin_index, self.end_index) = curve.get_period_indices(sim_params.begin, sim_params.end)
+		self.dates = curve.dates[self.begin_index:self.end_index]
+		self.curves = self.get_curves()
+
+	def get_curves(self) -> Dict[str, Tuple[PowerData, bool]]:
+		#(curve, scaling) by name, the consumers first and the productions in the order simulate_senario sums them
+		params = self.sim_params
+		curves = {f"consumer {i}" : (c, s) for (i, (c, s)) in enumerate(zip(params.consumer_curves, params.has_consumer_scaling))}
+		for (name, has_curve, curve, scaling) in [
+				("wind", params.has_wind, params.wind_curve, params.has_wind_scaling),
+				("solar", params.has_solar, params.solar_curve, params.has_solar_scaling),
+				("bioenergy", params.has_bioenergy, params.bioenergy_curve, params.has_bioenergy_scaling)]:
+			if has_curve:
+				curves[name] = (curve, scaling)
+		return curves
+
+	def get_settings(self) -> Dict[str, Any]:
+		#scalars of the params a stored state depends on, the swept ones excepted
+		params = self.sim_params
+		names = ["has_consumer_scaling", "consumer_power", "consumer_contrib", "has_wind", "has_wind_scaling", "has_solar", "has_solar_scaling",
+			"has_bioenergy", "has_bioenergy_scaling", "has_flexibility", "has_battery", "has_piloted_bioenergy", "has_piloted_bioenergy_scaling",
+			"piloted_bioenergy_max_power", "piloted_bioenergy_window", "battery_max_charge_power", "battery_max_discharge_power",
+			"battery_charge_efficiency", "battery_discharge_efficiency", "battery_self_discharge", "battery_soc_min", "battery_soc_max",
+			"scale_before_slice", "time_step"]
+		settings = {name : getattr(params, name) for name in names}
+		settings["begin"] = self.dates[0].isoformat() if len(self.dates) != 0 else None
+		return json.loads(json.dumps(settings, default=str))
+
+	def get_references(self) -> Dict[str, float]:
+		#average each scaled curve is scaled by, as SimParams.get_period_curve does over the current data
+		references = {}
+		for (name, (curve, scaling)) in self.curves.items():
+			if scaling:
+				references[name] = curve.get_average() if self.sim_params.scale_before_slice == True else curve.get_slice_over_period(self.sim_params.begin, self.sim_params.end).get_average()
+		return references
+
+	def get_hashes(self, count : int) -> Dict[str, str]:
+		#of every curve over the count first simulated dates
+		hashes = {}
+		for (name, (curve, _)) in self.curves.items():
+			values = np.ascontiguousarray(curve.power[self.begin_index:self.begin_index + count], dtype=np.float64)
+			hashes[name] = hashlib.sha1(values.tobytes()).hexdigest()
+		return hashes
+
+	def get_scaled_power(self, name : str, power : float, references : Dict[str, float], begin : int, end : int) -> np.array:
+		#same operations as get_scaled, with the stored reference instead of the average
+		(curve, scaling) = self.curves[name]
+		values = np.asarray(curve.power[self.begin_index + begin:self.begin_index + end], dtype=np.float64)
+		if not scaling:
+			return np.array(values)
+		return values / references[name] * float(power)
+
+	def get_chunk(self, params : SimParams, references : Dict[str, float], begin : int, end : int, timestamps : np.array, seconds : np.array) -> Chunk:
+		#points of [begin, end[ (indices of the simulated dates) before any stage, params being set to the point
+		consumers = [self.get_scaled_power(f"consumer {i}", p, references, begin, end) * float(k) for (i, (p, k)) in enumerate(zip(params.consumer_power, params.consumer_contrib))]
+		consumption = consumers[0]
+		for c in consumers[1:]:
+			consumption = consumption + c
+		production = None
+		for (name, power) in [("wind", params.wind_power), ("solar", params.solar_power), ("bioenergy", params.bioenergy_power)]:
+			if name in self.curves:
+				curve = self.get_scaled_power(name, power, references, begin, end)
+				production = curve if production is None else production + curve
+		return Chunk(self.dates[begin:end], timestamps[begin:end], seconds[begin:end], production, consumption,
+			np.array(consumers) if params.has_class_flexibility() else None)
+
+	def advance(self, params : SimParams, state : ScenarioState, chunk : Chunk, final : bool = False):
+		#runs the new points of chunk through the stages, final ends the data : every held point is then finished
+		if len(chunk) != 0:
+			if state.first_timestamp is None:
+				state.first_timestamp = float(chunk.timestamps[0])
+			state.last_timestamp = float(chunk.timestamps[-1])
+		passed = chunk
+		if params.has_flexibility:
+			held = state.period.get_concatenated(chunk)
+			starts = get_period_starts(held.timestamps)
+			#the kernel ends the last period at its last point, which stays unflexed and begins the next period
+			count = len(held) if final else (starts[-1] + 1 if len(starts) != 0 else 0)
+			periods = len([s for s in starts if s < count - 1])
+			consumption = held.consumption[:count]
+			if periods != 0:
+				flexed = held.get_slice(0, count)
+				production = PowerData(flexed.dates, flexed.production, copy_dates=False)
+				if flexed.consumers is not None:
+					(total, ratios, _) = simulate_class_flexibility(production, np.array(flexed.consumers, dtype=np.float64, order="C"), params.flexibility_ratio, DAY, timestamps=flexed.timestamps)
+				else:
+					(_, total, ratios) = simulate_flexibility_ratios(production, PowerData(flexed.dates, flexed.consumption, copy_dates=False), params.flexibility_ratio[0], DAY, timestamps=flexed.timestamps)
+				consumption = total.power
+				state.flex_ratios += ratios[:periods].tolist()
+			if not final:
+				count = max(count - 1, 0)
+			passed = held.get_slice(0, count)
+			passed.consumption = consumption[:count]
+			state.period = held.get_slice(count, len(held))
+		if params.has_piloted_bioenergy and params.piloted_bioenergy_power != 0:
+			held = state.window.get_concatenated(passed)
+			count = len(held)
+			if not final and count != 0:
+				labels = get_calendar_labels(held.seconds.astype(np.int64), params.piloted_bioenergy_window)
+				count = int(np.searchsorted(labels, labels[-1], side="left"))
+			passed = held.get_slice(0, count)
+			if count != 0:
+				(power, cap) = params.get_piloted_bioenergy_limits()
+				piloted = dispatch_in_windows(passed.consumption - passed.production, WindowLayout(passed.seconds.astype(np.int64), params.piloted_bioenergy_window), power, cap)
+				passed.production = passed.production + piloted
+			state.window = held.get_slice(count, len(held))
+		held = state.pending.get_concatenated(passed)
+		count = len(held)
+		if count == 0:
+			return
+		battery = np.zeros(count)
+		if params.has_battery:
+			parameters = params.get_battery().get_parameters()
+			parameters[BATTERY_INITIAL_ENERGY] = state.energy
+			(battery, energy) = battery_model_kernel(held.production - held.consumption, held.seconds, parameters)
+			state.energy = float(energy[-1])
+		production = held.production - battery
+		#the last point is held until the next date (without final), the sums skip it in any case
+		sums = kpi_sums(production, held.consumption, battery)
+		done = count if final else count - 1
+		if not final:
+			counted = kpi_sums(production[:done], held.consumption[:done], battery[:done])
+			sums[COUNTED_KPIS + MAXIMIZED_KPIS] = counted[COUNTED_KPIS + MAXIMIZED_KPIS]
+		if done != 0:
+			state.sums[SUMMED_KPIS] += sums[SUMMED_KPIS]
+			state.sums[COUNTED_KPIS] += sums[COUNTED_KPIS]
+			state.sums[MAXIMIZED_KPIS] = sums[MAXIMIZED_KPIS] if state.points == 0 else np.maximum(state.sums[MAXIMIZED_KPIS], sums[MAXIMIZED_KPIS])
+			state.consumption.add(held.consumption[:done])
+			state.imported.add(np.maximum(held.consumption[:done] - production[:done], 0.0))
+		state.points += done
+		state.summed += count - 1
+		state.pending = held.get_slice(done, count)
+
+	def get_flexibility_use(self, params : SimParams, state : ScenarioState) -> float:
+		#SimResults.get_flexibility_use : one ratio per day of the data, the days without period count as 0
+		if not params.has_flexibility:
+			return 1.0
+		ratios = np.zeros(ceil((state.last_timestamp - state.first_timestamp) / DAY))
+		ratios[:len(state.flex_ratios)] = state.flex_ratios
+		return float(np.sum(ratios[:-1], dtype=np.float64)) / (len(ratios) - 1)
+
+	def get_kpis(self, params : SimParams, state : ScenarioState) -> AgglomeratedSimResults:
+		#of the data simulated by state, ended as the end of the curves
+		state = state.get_copy()
+		self.advance(params, state, Chunk.empty(), True)
+		sums = state.sums
+		has_battery = params.has_battery and params.battery_capacity != 0
+		return AgglomeratedSimResults(
+			storage_use     = (sums[KPI_BATTERY_CHARGE_SUM] / state.summed / params.battery_capacity if has_battery else 1),
+			imported_power  = sums[KPI_IMPORTED_SUM] / state.summed,
+			exported_power  = sums[KPI_EXPORTED_SUM] / state.summed,
+			imported_time   = sums[KPI_IMPORTED_COUNT] / state.points,
+			exported_time   = sums[KPI_EXPORTED_COUNT] / state.points,
+			low_conso_peak  = state.consumption.get(PERCENTILE_KPIS["low_conso_peak"]),
+			high_conso_peak = state.consumption.get(PERCENTILE_KPIS["high_conso_peak"]),
+			low_import_peak = state.imported.get(PERCENTILE_KPIS["low_import_peak"]),
+			high_import_peak= state.imported.get(PERCENTILE_KPIS["high_import_peak"]),
+			flexibility_use = self.get_flexibility_use(params, state),
+			export_max      = sums[KPI_EXPORTED_MAX],
+			import_max      = sums[KPI_IMPORTED_MAX],
+			coverage        = sums[KPI_PRODUCTION_SUM] / sums[KPI_CONSUMPTION_SUM],
+			coverage_avg    = sums[KPI_COVERAGE_SUM] / state.summed,
+			autoconso       = sums[KPI_SELF_CONSUMED_SUM] / sums[KPI_PRODUCTION_SUM],
+			autoprod        = sums[KPI_SELF_PRODUCED_SUM] / sums[KPI_CONSUMPTION_SUM]
+		)
+
+	def get_point_params(self, point : Dict[str, float]) -> SimParams:
+		params = self.sim_params.get_shared_clone()
+		set_point(params, point)
+		params.check_and_convert_params()
+		return params
+
+	def load(self) -> Tuple[Optional[Dict[str, Any]], Dict[Tuple[float, ...], ScenarioState]]:
+		#(meta, states by point key), (None, {}) without any run yet
+		if not os.path.exists(os.path.join(self.path, META_FILE)):
+			return (None, {})
+		with open(os.path.join(self.path, META_FILE)) as meta_file:
+			meta = json.load(meta_file)
+		with open(os.path.join(self.path, STATES_FILE), "rb") as states_file:
+			states = pickle.load(states_file)
+		return (meta, states)
+
+	def save(self, meta : Dict[str, Any], states : Dict[Tuple[float, ...], ScenarioState]):
+		#the states are written first, meta.json (with the count of their dates) is only replaced once they are complete
+		os.makedirs(self.path, exist_ok=True)
+		with open(os.path.join(self.path, STATES_FILE + ".tmp"), "wb") as states_file:
+			pickle.dump(states, states_file, protocol=pickle.HIGHEST_PROTOCOL)
+		with open(os.path.join(self.path, META_FILE + ".tmp"), "w") as meta_file:
+			json.dump(meta, meta_file, indent=1)
+		os.replace(os.path.join(self.path, STATES_FILE + ".tmp"), os.path.join(self.path, STATES_FILE))
+		os.replace(os.path.join(self.path, META_FILE + ".tmp"), os.path.join(self.path, META_FILE))
+
+	def check_meta(self, meta : Dict[str, Any]):
+		settings = self.get_settings()
+		changed = [k for k in settings if settings[k] != meta["settings"].get(k)]
+		if len(changed) != 0:
+			raise Exception(f"the params {changed} changed since the stored runs of {self.path}, the sweep must be started again")
+		if meta["accuracy"] != self.accuracy:
+			raise Exception(f"the states of {self.path} were built with an accuracy of {meta['accuracy']}")
+		if meta["count"] > len(self.dates):
+			raise Exception(f"{self.path} simulated {meta['count']} dates, the curves only have {len(self.dates)}")
+		if meta["count"] != 0 and self.dates[meta["count"] - 1].isoformat() != meta["end"] or self.get_hashes(meta["count"]) != meta["hashes"]:
+			raise Exception(f"the data simulated by the stored runs of {self.path} changed, the sweep must be started again")
+
+	def run(self, points : List[Dict[str, float]], thread_count : int = 1) -> List[Dict[str, Any]]:
+		#results as those of sweep.simulate_point, the states of the points are stored for the next run
+		(meta, states) = self.load()
+		references = self.get_references()
+		if meta is None:
+			meta = {"settings" : self.get_settings(), "accuracy" : self.accuracy, "references" : references, "count" : 0}
+		else:
+			self.check_meta(meta)
+			if meta["references"] != references:
+				#the new dates moved the averages the curves are scaled by, the stored states are scaled by the old ones
+				(meta, states) = ({**meta, "references" : references, "count" : 0}, {})
+		count = len(self.dates)
+		#the dates as timestamps (those of sim_flex) and seconds, only from the first date a point simulates
+		first = meta["count"] if all([get_point_key(p) in states for p in points]) else 0
+		(timestamps, seconds) = (np.zeros(count), np.zeros(count))
+		timestamps[first:] = [d.timestamp() for d in self.dates[first:]]
+		seconds[first:] = dates_to_seconds(self.dates[first:])
+		def simulate(point : Dict[str, float]) -> Tuple[ScenarioState, AgglomeratedSimResults]:
+			params = self.get_point_params(point)
+			state = states.get(get_point_key(point))
+			begin = meta["count"]
+			if state is None:
+				energy = float(params.get_battery().get_parameters()[BATTERY_INITIAL_ENERGY]) if params.has_battery else 0.0
+				state = ScenarioState(len(params.consumer_curves) if params.has_class_flexibility() else None, energy, self.accuracy)
+				begin = 0
+			self.advance(params, state, self.get_chunk(params, meta["references"], begin, count, timestamps, seconds))
+			return (state, self.get_kpis(params, state))
+		with ThreadPoolExecutor(thread_count) as executor:
+			simulated = list(executor.map(simulate, points))
+		#the states of the points left out of this run are dropped, they would end before the stored count of dates
+		states = {get_point_key(p) : s for (p, (s, _)) in zip(points, simulated)}
+		meta = {**meta, "count" : count, "end" : self.dates[-1].isoformat(), "hashes" : self.get_hashes(count)}
+		self.save(meta, states)
+		return [{**point, "agglomerated" : kpis} for (point, (_, kpis)) in zip(points, simulated)]
+
+	def check(self, points : List[Dict[str, float]]) -> Dict[str, float]:
+		#largest relative difference of every kpi between the stored states of points and simulate_point over the current
+		#params, raises when one is above CHECK_TOLERANCE (above the accuracy of the sketch for the percentiles)
+		(meta, states) = self.load()
+		if meta is None or meta["count"] != len(self.dates) or meta["references"] != self.get_references():
+			raise Exception(f"the stored runs of {self.path} don't cover the current data")
+		differences = {name : 0.0 for name in KPI_NAMES}
+		for point in points:
+			params = self.get_point_params(point)
+			stored = asdict(self.get_kpis(params, states[get_point_key(point)]))
+			recomputed = asdict(simulate_point(self.sim_params.get_shared_clone(), point)["agglomerated"])
+			for name in KPI_NAMES:
+				(a, b) = (float(stored[name]), float(recomputed[name]))
+				if a != b and not (np.isnan(a) and np.isnan(b)):
+					differences[name] = max(differences[name], abs(a - b) / max(abs(b), np.finfo(np.float64).tiny))
+		failed = [n for n in KPI_NAMES if differences[n] > (self.accuracy + CHECK_TOLERANCE if n in PERCENTILE_KPIS else CHECK_TOLERANCE)]
+		if len(failed) != 0:
+			raise Exception(f"the incremental kpis {[(n, differences[n]) for n in failed]} differ from a full recompute")
+		return differences
+
+def get_point_key(point : Dict[str, float]) -> Tuple[float, ...]:
+	return tuple([float(point[AXIS_KEYS[axis]]) for axis in AXES])
@@ -0,0 +1,124 @@
+from __future__ import annotations
+from typing import *
+from ctypes import *
+import os
+import numpy as np
+#ctypes releases the GIL during every call of the library, so the kernels can run in parallel threads
+libsim = CDLL(os.path.dirname(os.path.realpath(__file__)) + "/cmodules/libsim.so")
+
+#indices of the values returned by kpi_sums, same as in libsim.h
+KPI_PRODUCTION_SUM     = 0
+KPI_CONSUMPTION_SUM    = 1
+KPI_IMPORTED_SUM       = 2
+KPI_EXPORTED_SUM       = 3
+KPI_IMPORTED_COUNT     = 4
+KPI_EXPORTED_COUNT     = 5
+KPI_IMPORTED_MAX       = 6
+KPI_EXPORTED_MAX       = 7
+KPI_SELF_CONSUMED_SUM  = 8
+KPI_SELF_PRODUCED_SUM  = 9
+KPI_COVERAGE_SUM       = 10
+KPI_BATTERY_CHARGE_SUM = 11
+KPI_COUNT              = 12
+
+#columns of the parameters of every battery of battery_model_kernel, same as in libsim.h
+BATTERY_CAPACITY             = 0
+BATTERY_MAX_CHARGE           = 1
+BATTERY_MAX_DISCHARGE        = 2
+BATTERY_CHARGE_EFFICIENCY    = 3
+BATTERY_DISCHARGE_EFFICIENCY = 4
+BATTERY_SELF_DISCHARGE       = 5
+BATTERY_SOC_MIN              = 6
+BATTERY_SOC_MAX              = 7
+BATTERY_INITIAL_ENERGY       = 8
+BATTERY_PARAM_COUNT          = 9
+
+def as_double_buffer(array : Any) -> np.array:
+	#any buffer of float64 (numpy array, memoryview, array.array...) is used in place, anything else is converted
+	return as_kernel_buffer(array, np.float64)
+
+def as_kernel_buffer(array : Any, dtype : type) -> np.array:
+	array = np.asarray(array, dtype=dtype)
+	if not array.flags["C_CONTIGUOUS"]:
+		array = np.ascontiguousarray(array)
+	return array
+
+def get_kernel_dtype(*arrays : Any) -> type:
+	#the float32 kernels are used when every curve already is float32, the others are converted to float64
+	if all([isinstance(a, np.ndarray) and a.dtype == np.float32 for a in arrays if a is not None]):
+		return np.float32
+	return np.float64
+
+def double_pointer(array : np.array):
+	return array.ctypes.data_as(POINTER(c_double))
+
+def float_pointer(array : np.array):
+	return array.ctypes.data_as(POINTER(c_float))
+
+def battery_kernel(power : Any, seconds : Any, capacity : float, dated_energy : np.array = None) -> Tuple[np.array, np.array]:
+	#power is modified in place when it already is a float64 or float32 buffer
+	#dated_energy is always float64, the energy being accumulated over the whole curve
+	dtype = get_kernel_dtype(power)
+	power = as_kernel_buffer(power, dtype)
+	seconds = as_double_buffer(seconds)
+	if dated_energy is None:
+		dated_energy = np.zeros(len(power))
+	if dtype == np.float32:
+		libsim.sim_battery_f32(float_pointer(power), double_pointer(seconds), c_size_t(len(power)), c_double(capacity), double_pointer(dated_energy))
+	else:
+		libsim.sim_battery(double_pointer(power), double_pointer(seconds), c_size_t(len(power)), c_double(capacity), double_pointer(dated_energy))
+	return (power, dated_energy)
+
+def battery_model_kernel(power : Any, seconds : Any, parameters : Any, out : np.array = None, dated_energy : np.array = None, with_energy : bool = True) -> Tuple[np.array, Optional[np.array]]:
+	#batteries of the realistic model, parameters being one row of BATTERY_PARAM_COUNT values per battery (see libsim.h)
+	#power is one curve shared by every battery or one curve per battery, the exchanged powers are written in out
+	#(batteries, count), a new array by default, out can be power itself to write them in place
+	#a single battery over a single curve works on (count,) arrays, as battery_kernel
+	#dated_energy is float64, it isn't computed without with_energy
+	parameters = as_double_buffer(parameters)
+	battery_count = parameters.size // BATTERY_PARAM_COUNT
+	dtype = get_kernel_dtype(power)
+	power = as_kernel_buffer(power, dtype)
+	count = power.shape[-1]
+	shape = power.shape if power.ndim != 1 or battery_count == 1 else (battery_count, count)
+	if power.ndim != 1 and power.size != battery_count * count:
+		raise Exception(f"{len(power)} power curves for {battery_count} batteries")
+	if out is None:
+		out = np.empty(shape, dtype=dtype)
+	elif out.dtype != dtype or not out.flags["C_CONTIGUOUS"] or out.size != battery_count * count:
+		raise Exception(f"out must be a contiguous {np.dtype(dtype).name} buffer of {battery_count * count} values")
+	seconds = as_double_buffer(seconds)
+	if with_energy and dated_energy is None:
+		dated_energy = np.zeros(shape)
+	energy_pointer = double_pointer(dated_energy) if with_energy else None
+	stride = c_size_t(0 if power.ndim == 1 else count)
+	if dtype == np.float32:
+		libsim.sim_battery_model_f32(float_pointer(power), stride, double_pointer(seconds), c_size_t(count), c_size_t(battery_count), double_pointer(parameters), float_pointer(out), energy_pointer)
+	else:
+		libsim.sim_battery_model(double_pointer(power), stride, double_pointer(seconds), c_size_t(count), c_size_t(battery_count), double_pointer(parameters), double_pointer(out), energy_pointer)
+	return (out, dated_energy if with_energy else None)
+
+def kpi_sums(production : Any, consumption : Any, battery : Any = None) -> np.array:
+	#sums are float64 whatever the dtype of the curves
+	dtype = get_kernel_dtype(production, consumption, battery)
+	(kernel, pointer) = (libsim.sim_kpi_f32, float_pointer) if dtype == np.float32 else (libsim.sim_kpi, double_pointer)
+	production = as_kernel_buffer(production, dtype)
+	consumption = as_kernel_buffer(consumption, dtype)
+	battery_pointer = None
+	if battery is not None:
+		battery = as_kernel_buffer(battery, dtype)
+		battery_pointer = pointer(battery)
+	out = np.zeros(KPI_COUNT)
+	kernel(pointer(production), pointer(consumption), battery_pointer, c_size_t(len(production)), double_pointer(out))
+	return out
+
+def dispatch_kernel(deficits : Any, starts : np.array, budgets : Any, caps : Any, out : np.array = None) -> np.array:
+	#window k is [starts[k], starts[k + 1][ of deficits (flat, float64), budgets and caps are one per window, inf for no limit
+	deficits = as_double_buffer(deficits)
+	starts = as_kernel_buffer(starts, np.int64)
+	budgets = as_double_buffer(budgets)
+	caps = as_double_buffer(caps)
+	if out is None:
+		out = np.empty(len(deficits))
+	libsim.sim_dispatch(double_pointer(deficits), c_size_t(len(starts) - 1), starts.ctypes.data_as(POINTER(c_int64)), double_pointer(budgets), double_pointer(caps), double_pointer(out))
+	return out
@@ -0,0 +1,129 @@
+from __future__ import annotations
+from typing import *
+from dataclasses import fields
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import numpy as np
+if len(__name__.split("."))==1:
+	from calc import PowerData, dates_to_seconds
+	from sim import SimParams, AgglomeratedSimResults
+	from sweep import simulate_point, get_csv_titles, AXES, AXIS_KEYS
+	from arena import ScratchArena
+	from profiling import stage
+else:
+	from .calc import PowerData, dates_to_seconds
+	from .sim import SimParams, AgglomeratedSimResults
+	from .sweep import simulate_point, get_csv_titles, AXES, AXIS_KEYS
+	from .arena import ScratchArena
+	from .profiling import stage
+
+#synthetic weather years : the simulated period is cut in blocks of block_days, and every block is replaced by the
+#block of the same length starting a whole number of weeks away (so that weekdays are kept) and at most window_days
+#from the same day of any year of the data. Every curve (consumers, wind, solar, bioenergy) takes the same block,
+#which keeps their correlation, and blocks only move within their season, which keeps the seasonality
+#the blocks of a realization only depend on (seed, realization), every configuration is simulated over the same
+#synthetic years (common random numbers), so that differences between configurations have a low variance
+#curves are still scaled to the configured averages in every synthetic year, as in a sweep : the spread of the kpis
+#comes from when the energy is produced and consumed, not from how much
+DAY = 86400
+WEEK_DAYS = 7
+#52 weeks, a shift to another year that keeps weekdays
+YEAR_DAYS = 364
+KPI_NAMES = [f.name for f in fields(AgglomeratedSimResults)]
+DISTRIBUTION_STATS = ["mean", "p10", "p90"]
+
+class MonteCarlo():
+	sim_params  : SimParams
+	count       : int
+	block_days  : int
+	window_days : int
+	seed        : int
+	dates       : List[Any]
+	def __init__(self, sim_params : SimParams, count : int = 100, block_days : int = 7, window_days : int = 21, seed : int = 0):
+		sim_params.check_and_convert_params()
+		self.sim_params  = sim_params
+		self.count       = count
+		self.block_days  = block_days
+		self.window_days = window_days
+		self.seed        = seed
+		curve = sim_params.consumer_curves[0]
+		seconds = dates_to_seconds(curve.dates)
+		steps = np.unique(np.diff(seconds))
+		if len(steps) != 1 or DAY % int(steps[0]) != 0:
+			raise Exception("monte carlo needs curves without gaps and with a time step dividing a day, see SimParams.time_step")
+		self.day_length = DAY // int(steps[0])
+		self.length = len(curve.dates)
+		(self.begin_index, self.end_index) = curve.get_period_indices(sim_params.begin, sim_params.end)
+		#every realization shares the dates of the simulated period, the arena caches are then kept between them
+		self.dates = curve.dates[self.begin_index:self.end_index]
+		self.shifts = self.get_block_shifts()
+
+	def get_block_shifts(self) -> List[np.array]:
+		#possible shifts (in points) of every block of the simulated period
+		block = self.block_days * self.day_length
+		week = WEEK_DAYS * self.day_length
+		year = YEAR_DAYS * self.day_length
+		years = self.length // year + 1
+		weeks = self.window_days // WEEK_DAYS
+		candidates = np.array([y * year + w * week for y in range(-years, years + 1) for w in range(-weeks, weeks + 1)])
+		shifts = []
+		for start in range(self.begin_index, self.end_index, block):
+			end = min(start + block, self.end_index)
+			shifts.append(candidates[(start + candidates >= 0) & (end + candidates <= self.length)])
+		return shifts
+
+	def get_indices(self, realization : int) -> np.array:
+		#index in the aligned curves of every simulated date of the realization
+		rng = np.random.default_rng([self.seed, realization])
+		chosen = np.array([shifts[rng.integers(len(shifts))] for shifts in self.shifts])
+		offsets = np.arange(self.end_index - self.begin_index)
+		return self.begin_index + offsets + chosen[offsets // (self.block_days * self.day_length)]
+
+	def get_realization(self, realization : int) -> SimParams:
+		#params sharing the scalars of sim_params, whose curves are the ones of the synthetic year
+		indices = self.get_indices(realization)
+		def resample(curve : PowerData) -> PowerData:
+			return PowerData(self.dates, np.take(curve.power, indices), copy_dates=False)
+		params = self.sim_params.get_shared_clone()
+		params.consumer_curves = [resample(c) for c in params.consumer_curves]
+		for attribute in ["solar_curve", "wind_curve", "bioenergy_curve"]:
+			if getattr(params, attribute) is not None:
+				setattr(params, attribute, resample(getattr(params, attribute)))
+		return params
+
+	def run(self, points : List[Dict[str, float]], thread_count : int = 4) -> np.array:
+		#samples[point, realization, kpi], kpis in the order of KPI_NAMES
+		#a task builds one synthetic year and simulates every point over it, each thread reuses its own arena
+		local = threading.local()
+		def simulate_realization(realization : int) -> List[List[float]]:
+			if not hasattr(local, "arena"):
+				local.arena = ScratchArena()
+			with stage("bootstrap"):
+				params = self.get_realization(realization)
+			results = [simulate_point(params, point, local.arena)["agglomerated"] for point in points]
+			return [[getattr(r, name) for name in KPI_NAMES] for r in results]
+		with ThreadPoolExecutor(thread_count) as executor:
+			rows = list(executor.map(simulate_realization, range(self.count)))
+		return np.array(rows, dtype=np.float64).reshape((self.count, len(points), len(KPI_NAMES))).transpose(1, 0, 2)
+
+def get_distribution(samples : np.array) -> Dict[str, Dict[str, float]]:
+	#samples[realization, kpi] of one point -> kpi -> mean, p10 and p90
+	return {name : {
+		"mean" : float(np.mean(samples[:, i])),
+		"p10"  : float(np.percentile(samples[:, i], 10)),
+		"p90"  : float(np.percentile(samples[:, i], 90)),
+	} for (i, name) in enumerate(KPI_NAMES)}
+
+def get_difference_distribution(reference : np.array, samples : np.array) -> Dict[str, Dict[str, float]]:
+	#distribution of samples - reference, realization by realization, both having been simulated over the same years
+	return get_distribution(samples - reference)
+
+def write_distributions(path : str, points : List[Dict[str, float]], samples : np.array):
+	#one line per point, the axes followed by the mean, p10 and p90 of every kpi
+	with open(path, "w") as out_file:
+		titles = [f"{name} {stat}" for name in KPI_NAMES for stat in DISTRIBUTION_STATS]
+		print(get_csv_titles(), *titles, sep=";", file=out_file)
+		for (point, point_samples) in zip(points, samples):
+			distribution = get_distribution(point_samples)
+			values = [distribution[name][stat] for name in KPI_NAMES for stat in DISTRIBUTION_STATS]
+			print(*[point[AXIS_KEYS[axis]] for axis in AXES], *values, sep=";", file=out_file)
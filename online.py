@@ -0,0 +1,328 @@
+from __future__ import annotations
+from typing import *
+from dataclasses import dataclass, asdict, fields
+from datetime import datetime
+from math import ceil, pow
+import heapq
+import numpy as np
+if len(__name__.split("."))==1:
+	from calc import PowerData, dates_to_seconds, get_calendar_labels
+	from kernels import *
+	from sim import SimParams, AgglomeratedSimResults, simulate_senario, simulate_flexibility_ratios, simulate_class_flexibility
+	from dispatch import WindowLayout, dispatch_in_windows
+else:
+	from .calc import PowerData, dates_to_seconds, get_calendar_labels
+	from .kernels import *
+	from .sim import SimParams, AgglomeratedSimResults, simulate_senario, simulate_flexibility_ratios, simulate_class_flexibility
+	from .dispatch import WindowLayout, dispatch_in_windows
+
+#online simulation for the energy management system : measurements are pushed one date at a time and every point goes
+#through the stages of simulate_senario, each one holding it as long as it needs :
+#  flexibility       : until its period (a day from the first date of the period, as in sim_flex) is complete
+#  piloted bioenergy : until its window (calendar day or year) is complete
+#  battery           : until the next date, which gives the duration of its step
+#so a step costs O(1) amortized, the sorts of the flexibility and of the dispatch being done once per period and window
+#close() ends the data as the end of the curves ends a batch simulation : the last period is flexed without its last
+#point and the last point doesn't use the battery. The points and kpis are then the ones of simulate_senario and
+#AgglomeratedSimResults over the same data (float64 curves), flexibility_use being summed in order instead of pairwise
+DAY = 24 * 3600.0
+#relative difference allowed by check_online on flexibility_use, the other kpis and the points must be equal
+CHECK_TOLERANCE = 1e-12
+
+@dataclass
+class OnlinePoint:
+	date              : datetime
+	consumption       : float #after flexibility
+	production        : float #with the piloted bioenergy, once the battery has charged or discharged
+	piloted_bioenergy : float
+	battery           : float #positive when charging
+	battery_energy    : float #stored at date
+
+class RunningPercentile():
+	#PowerData.get_percentile of every pushed value : the index + 1 smallest values are in a max heap (negated),
+	#the others in a min heap, the index grows by at most one per value so a push costs O(log(n))
+	percentile : float
+	lower      : List[float]
+	upper      : List[float]
+	def __init__(self, percentile : float):
+		self.percentile = percentile
+		self.lower      = []
+		self.upper      = []
+
+	def push(self, value : float):
+		if len(self.lower) != 0 and value <= -self.lower[0]:
+			heapq.heappush(self.lower, -value)
+		else:
+			heapq.heappush(self.upper, value)
+		target = int(self.percentile * (len(self.lower) + len(self.upper)) / 100) + 1
+		while len(self.lower) > target:
+			heapq.heappush(self.upper, -heapq.heappop(self.lower))
+		while len(self.lower) < target:
+			heapq.heappush(self.lower, -heapq.heappop(self.upper))
+
+	def get(self) -> float:
+		return -self.lower[0]
+
+class OnlineSimulator():
+	#the scalars of sim_params are read once, its curves aren't used : consumptions and productions are pushed
+	#a pushed consumption is one value per consumer curve (weighted by consumer_contrib as in simulate_senario) or,
+	#without flexibility by consumer class, the total consumption, production is the total of the non piloted sources
+	sim_params : SimParams
+	points     : int
+	sums       : np.array
+	def __init__(self, sim_params : SimParams):
+		sim_params.check_and_convert_params()
+		self.sim_params = sim_params
+		self.class_flexibility = sim_params.has_class_flexibility()
+		self.has_piloted = sim_params.has_piloted_bioenergy and sim_params.piloted_bioenergy_power != 0
+		(self.piloted_power, self.piloted_cap) = sim_params.get_piloted_bioenergy_limits() if self.has_piloted else (None, None)
+		self.battery = sim_params.get_battery().get_parameters() if sim_params.has_battery else None
+		#flexibility : the pending period, (date, timestamp, production, consumption, consumptions) of every point
+		self.period : List[Tuple[datetime, float, float, float, Optional[List[float]]]] = []
+		self.flex_ratios : List[float] = []
+		self.flex_sum = 0.0
+		self.first_timestamp : float = None
+		self.last_timestamp : float = None
+		#piloted bioenergy : the pending window, (date, production, consumption) of every point, and its label
+		self.window : List[Tuple[datetime, float, float]] = []
+		self.window_label = None
+		#battery : the point waiting for the next date, (date, seconds, production, consumption, piloted)
+		self.pending : Tuple[datetime, float, float, float, float] = None
+		if self.battery is not None:
+			self.energy = self.battery[BATTERY_INITIAL_ENERGY]
+			self.min_energy = self.battery[BATTERY_CAPACITY] * self.battery[BATTERY_SOC_MIN]
+			self.max_energy = self.battery[BATTERY_CAPACITY] * self.battery[BATTERY_SOC_MAX]
+		else:
+			self.energy = 0.0
+		(self.last_delta, self.retention) = (0.0, 1.0)
+		#kpis, in the order of kpi_sums, over the points that went through every stage
+		self.sums = np.zeros(KPI_COUNT)
+		self.points = 0
+		self.summed = 0
+		self.percentiles = {name : RunningPercentile(p) for (name, p) in [("low_conso", 5), ("high_conso", 95), ("low_import", 5), ("high_import", 95)]}
+		self.closed = False
+
+	def push(self, date : datetime, consumption : Union[float, Sequence[float]], production : float) -> List[OnlinePoint]:
+		#points that went through every stage with this measurement, in date order
+		if self.closed:
+			raise Exception("no measurement can be pushed once the simulator is closed")
+		consumptions = None
+		if isinstance(consumption, (float, int)):
+			if self.class_flexibility:
+				raise Exception("flexibility by consumer class needs one consumption per consumer curve")
+			total = float(consumption)
+		else:
+			if len(consumption) != len(self.sim_params.consumer_curves):
+				raise Exception(f"{len(consumption)} consumptions for {len(self.sim_params.consumer_curves)} consumer curves")
+			consumptions = [float(c) * k for (c, k) in zip(consumption, self.sim_params.consumer_contrib)]
+			total = consumptions[0]
+			for c in consumptions[1:]:
+				total += c
+		timestamp = date.timestamp()
+		if self.first_timestamp is None:
+			self.first_timestamp = timestamp
+		self.last_timestamp = timestamp
+		done = []
+		if not self.sim_params.has_flexibility:
+			self.push_flexed(date, float(production), total, done)
+			return done
+		self.period.append((date, timestamp, float(production), total, consumptions))
+		if timestamp - self.period[0][1] >= DAY:
+			self.flex_period(done)
+		return done
+
+	def close(self) -> List[OnlinePoint]:
+		#the points still held by the stages
+		if self.closed:
+			return []
+		self.closed = True
+		done = []
+		if len(self.period) != 0:
+			self.flex_period(done)
+			(date, timestamp, production, consumption, consumptions) = self.period.pop()
+			self.push_flexed(date, production, consumption, done)
+		self.dispatch_window(done)
+		if self.pending is not None:
+			self.finish_pending(None, done)
+		return done
+
+	def flex_period(self, done : List[OnlinePoint]):
+		#flexes every pending point but the last one, which begins the next period (or ends the data)
+		if len(self.period) > 1:
+			dates = [p[0] for p in self.period]
+			timestamps = np.array([p[1] for p in self.period])
+			production = PowerData(dates, np.array([p[2] for p in self.period]), copy_dates=False)
+			if self.class_flexibility:
+				matrix = np.array([p[4] for p in self.period]).T.copy()
+				(consumption, ratios, _) = simulate_class_flexibility(production, matrix, self.sim_params.flexibility_ratio, DAY, timestamps=timestamps)
+			else:
+				consumption = PowerData(dates, np.array([p[3] for p in self.period]), copy_dates=False)
+				(_, consumption, ratios) = simulate_flexibility_ratios(production, consumption, self.sim_params.flexibility_ratio[0], DAY, timestamps=timestamps)
+			self.flex_ratios.append(float(ratios[0]))
+			self.flex_sum += self.flex_ratios[-1]
+			for i in range(len(self.period) - 1):
+				self.push_flexed(self.period[i][0], self.period[i][2], float(consumption.power[i]), done)
+		self.period = self.period[-1:]
+
+	def push_flexed(self, date : datetime, production : float, consumption : float, done : List[OnlinePoint]):
+		if not self.has_piloted:
+			self.push_dispatched(date, production, consumption, 0.0, done)
+			return
+		label = get_calendar_labels([date], self.sim_params.piloted_bioenergy_window)[0]
+		if label != self.window_label:
+			self.dispatch_window(done)
+			self.window_label = label
+		self.window.append((date, production, consumption))
+
+	def dispatch_window(self, done : List[OnlinePoint]):
+		if len(self.window) == 0:
+			return
+		dates = [p[0] for p in self.window]
+		deficits = np.array([p[2] - p[1] for p in self.window])
+		piloted = dispatch_in_windows(deficits, WindowLayout(dates, self.sim_params.piloted_bioenergy_window), self.piloted_power, self.piloted_cap)
+		for (i, (date, production, consumption)) in enumerate(self.window):
+			self.push_dispatched(date, production + float(piloted[i]), consumption, float(piloted[i]), done)
+		self.window = []
+
+	def push_dispatched(self, date : datetime, production : float, consumption : float, piloted : float, done : List[OnlinePoint]):
+		#the step of the pending point lasts until this date
+		seconds = float(dates_to_seconds([date])[0])
+		if self.pending is not None:
+			self.finish_pending(seconds, done)
+		self.pending = (date, seconds, production, consumption, piloted)
+
+	def finish_pending(self, next_seconds : Optional[float], done : List[OnlinePoint]):
+		#battery step of the pending point (none for the last one), same operations as sim_battery_model
+		(date, seconds, production, consumption, piloted) = self.pending
+		energy = self.energy
+		exchanged = 0.0
+		if self.battery is not None and next_seconds is not None:
+			time_delta = (next_seconds - seconds) / 3600.0
+			if time_delta > 0:
+				if time_delta != self.last_delta:
+					self.retention = pow(1.0 - self.battery[BATTERY_SELF_DISCHARGE], time_delta)
+					self.last_delta = time_delta
+				(self.energy, exchanged) = self.step_battery(self.energy * self.retention, production - consumption, time_delta)
+		production -= exchanged
+		self.add_kpis(production, consumption, exchanged, next_seconds is None)
+		done.append(OnlinePoint(date, consumption, production, piloted, exchanged, energy))
+		self.pending = None
+
+	def step_battery(self, energy : float, request : float, time_delta : float) -> Tuple[float, float]:
+		battery = self.battery
+		if request > 0 and energy < self.max_energy:
+			next_energy = min(energy + min(request, battery[BATTERY_MAX_CHARGE]) * time_delta * battery[BATTERY_CHARGE_EFFICIENCY], self.max_energy)
+			return (next_energy, (next_energy - energy) / (time_delta * battery[BATTERY_CHARGE_EFFICIENCY]))
+		if request < 0 and energy > self.min_energy:
+			next_energy = max(energy + max(request, -battery[BATTERY_MAX_DISCHARGE]) * time_delta / battery[BATTERY_DISCHARGE_EFFICIENCY], self.min_energy)
+			return (next_energy, (next_energy - energy) * battery[BATTERY_DISCHARGE_EFFICIENCY] / time_delta)
+		return (energy, 0.0)
+
+	def add_kpis(self, production : float, consumption : float, battery : float, last : bool):
+		#same operations as sim_kpi, the sums skip the last point
+		sums = self.sums
+		diff = production - consumption
+		exported = diff if diff > 0.0 else 0.0
+		imported = -diff if -diff > 0.0 else 0.0
+		if exported > 0.0:
+			sums[KPI_EXPORTED_COUNT] += 1.0
+		if imported > 0.0:
+			sums[KPI_IMPORTED_COUNT] += 1.0
+		sums[KPI_EXPORTED_MAX] = exported if self.points == 0 else max(sums[KPI_EXPORTED_MAX], exported)
+		sums[KPI_IMPORTED_MAX] = imported if self.points == 0 else max(sums[KPI_IMPORTED_MAX], imported)
+		self.points += 1
+		self.percentiles["low_conso"].push(consumption)
+		self.percentiles["high_conso"].push(consumption)
+		self.percentiles["low_import"].push(imported)
+		self.percentiles["high_import"].push(imported)
+		if last:
+			return
+		self.summed += 1
+		sums[KPI_PRODUCTION_SUM] += production
+		sums[KPI_CONSUMPTION_SUM] += consumption
+		sums[KPI_EXPORTED_SUM] += exported
+		sums[KPI_IMPORTED_SUM] += imported
+		sums[KPI_SELF_CONSUMED_SUM] += production - exported
+		sums[KPI_SELF_PRODUCED_SUM] += consumption - imported
+		if consumption != 0.0:
+			sums[KPI_COVERAGE_SUM] += production / consumption
+		sums[KPI_BATTERY_CHARGE_SUM] += battery if battery > 0.0 else 0.0
+
+	def get_flexibility_use(self) -> float:
+		#SimResults.get_flexibility_use : one ratio per day of the data, those of the days still open count as 0
+		if not self.sim_params.has_flexibility:
+			return 1.0
+		days = ceil((self.last_timestamp - self.first_timestamp) / DAY)
+		if days <= 1:
+			return float("nan")
+		skipped = self.flex_ratios[days - 1] if len(self.flex_ratios) >= days else 0.0
+		return (self.flex_sum - skipped) / (days - 1)
+
+	def get_kpis(self) -> Optional[AgglomeratedSimResults]:
+		#over the points that went through every stage, None before two of them
+		if self.summed == 0:
+			return None
+		sums = self.sums
+		has_battery = self.battery is not None and self.battery[BATTERY_CAPACITY] != 0
+		return AgglomeratedSimResults(
+			storage_use     = (sums[KPI_BATTERY_CHARGE_SUM] / self.summed / self.battery[BATTERY_CAPACITY] if has_battery else 1),
+			imported_power  = sums[KPI_IMPORTED_SUM] / self.summed,
+			exported_power  = sums[KPI_EXPORTED_SUM] / self.summed,
+			imported_time   = sums[KPI_IMPORTED_COUNT] / self.points,
+			exported_time   = sums[KPI_EXPORTED_COUNT] / self.points,
+			low_conso_peak  = self.percentiles["low_conso"].get(),
+			high_conso_peak = self.percentiles["high_conso"].get(),
+			low_import_peak = self.percentiles["low_import"].get(),
+			high_import_peak= self.percentiles["high_import"].get(),
+			flexibility_use = self.get_flexibility_use(),
+			export_max      = sums[KPI_EXPORTED_MAX],
+			import_max      = sums[KPI_IMPORTED_MAX],
+			coverage        = sums[KPI_PRODUCTION_SUM] / sums[KPI_CONSUMPTION_SUM],
+			coverage_avg    = sums[KPI_COVERAGE_SUM] / self.summed,
+			autoconso       = sums[KPI_SELF_CONSUMED_SUM] / sums[KPI_PRODUCTION_SUM],
+			autoprod        = sums[KPI_SELF_PRODUCED_SUM] / sums[KPI_CONSUMPTION_SUM]
+		)
+
+def get_measurements(sim_params : SimParams) -> Iterator[Tuple[datetime, List[float], float]]:
+	#(date, consumption of every consumer curve, production) of the curves simulate_senario uses, scaled the same way,
+	#to replay the simulated period through an OnlineSimulator
+	sim_params.check_and_convert_params()
+	consumers = [sim_params.get_period_curve(c, p, s) for (c, p, s) in zip(sim_params.consumer_curves, sim_params.consumer_power, sim_params.has_consumer_scaling)]
+	production : PowerData = None
+	for (has_curve, get_curve) in [(sim_params.has_wind, sim_params.get_wind_curve), (sim_params.has_solar, sim_params.get_solar_curve), (sim_params.has_bioenergy, sim_params.get_constant_bioenergy_curve)]:
+		if has_curve:
+			curve = get_curve()
+			production = curve if production is None else production + curve
+	powers = [c.power.astype(np.float64).tolist() for c in consumers]
+	production_powers = production.power.astype(np.float64).tolist()
+	for (i, date) in enumerate(production.dates):
+		yield (date, [p[i] for p in powers], production_powers[i])
+
+def check_online(sim_params : SimParams) -> Dict[str, float]:
+	#replays get_measurements through an OnlineSimulator and compares its points and kpis to simulate_senario and
+	#AgglomeratedSimResults, returns the largest relative difference of every kpi and raises when they don't match
+	if sim_params.dtype != "float64":
+		raise Exception(f"the online simulation matches the batch one over float64 curves, not {sim_params.dtype}")
+	simulator = OnlineSimulator(sim_params)
+	points = []
+	for (date, consumption, production) in get_measurements(sim_params):
+		points += simulator.push(date, consumption, production)
+	points += simulator.close()
+	results = simulate_senario(sim_params)
+	if len(points) != len(results.total_consumption.dates):
+		raise Exception(f"the online simulation gave {len(points)} points, the batch one {len(results.total_consumption.dates)}")
+	curves = {"consumption" : results.total_consumption.power, "production" : results.total_production.power}
+	if results.battery is not None:
+		curves["battery"] = results.battery.power
+	differing = [name for (name, power) in curves.items() if not np.array_equal(np.array([getattr(p, name) for p in points]), power)]
+	if len(differing) != 0:
+		raise Exception(f"the online {differing} differ from the batch simulation")
+	(online, batch) = (asdict(simulator.get_kpis()), asdict(AgglomeratedSimResults.from_sim_results(results)))
+	differences = {}
+	for name in [f.name for f in fields(AgglomeratedSimResults)]:
+		(a, b) = (float(online[name]), float(batch[name]))
+		differences[name] = 0.0 if a == b or (np.isnan(a) and np.isnan(b)) else abs(a - b) / max(abs(b), np.finfo(np.float64).tiny)
+	failed = [n for n in differences if differences[n] > (CHECK_TOLERANCE if n == "flexibility_use" else 0.0)]
+	if len(failed) != 0:
+		raise Exception(f"the online kpis {[(n, differences[n]) for n in failed]} differ from the batch simulation")
+	return differences
@@ -1,9 +1,18 @@
 from sim import *
+from sweep import *
+from result_store import ResultStore, STORE_EXTENSION
+from shard import ShardCoordinator, run_worker, simulate_grid_range
 from dataLoader import *
+from scenario_base import load_scenario_base
+from monte_carlo import MonteCarlo, write_distributions
+from incremental import IncrementalSweep
+from profiling import enable_profiling, get_profiler, get_total_size
+from arena import ScratchArena
 from configuration import config
-from sys import argv, getsizeof
+from sys import argv
 from time import time
-from multiprocessing import Process, Manager
+from multiprocessing import Process, Manager, Pool
+import atexit
 t0 = time()
 PARAMS = {
     "wind_min"               : 1000 * 90  / (365 * 24), #average wind prod in MW
@@ -21,137 +30,179 @@ PARAMS = {
     "battery_min"            : 0, #battery capacity in MWh
     "battery_max"            : 100,
     "battery_nb_points"      : 2,
+    "battery_model"          : {}, #SimParams battery_ fields without the prefix, {} is an ideal battery, for instance
+                                   #{"max_charge_power" : 1e6, "charge_efficiency" : 0.95, "self_discharge" : 0.0001} (in W/house)
+    "piloted_min"            : 0, #average piloted bioenergy prod in MW, dispatched over the deficits of every window
+    "piloted_max"            : 0,
+    "piloted_nb_points"      : 1,
+    "piloted_window"         : "day", #"day" or "year", see SimParams.piloted_bioenergy_window
     "scaling_factor_for_pop" : 1e6 / (config.CA_REDON_POPULATION + config.CA_PONTCHATEAU_POPULATION),
 	"RES_cons"               : (config.CA_PONTCHATEAU_RES_CONSUMPTION + config.CA_REDON_RES_CONSUMPTION) / (config.CA_REDON_POPULATION + config.CA_PONTCHATEAU_POPULATION),
 	"PRO_cons"               : (config.CA_PONTCHATEAU_PRO_CONSUMPTION + config.CA_REDON_PRO_CONSUMPTION) / (config.CA_REDON_POPULATION + config.CA_PONTCHATEAU_POPULATION),
 	"ENT_cons"               : (config.CA_PONTCHATEAU_ENT_CONSUMPTION + config.CA_REDON_ENT_CONSUMPTION) / (config.CA_REDON_POPULATION + config.CA_PONTCHATEAU_POPULATION),
     "thread_count"           : 15,
+	"executor"               : "process", #"process" forks thread_count processes, "thread" runs thread_count threads over one copy of the data
 	"begin"                  : datetime.strptime("01/01/2021 00:00","%d/%m/%Y %H:%M"),
 	"end"                    : datetime.strptime("01/01/2022 00:00","%d/%m/%Y %H:%M"),
-	"scale_before_slice"     : False
+	"scale_before_slice"     : False,
+	"sweep_mode"             : "grid", #"grid" simulates every point, "adaptive" refines the grid where adaptive_kpi changes,
+	                                   #"monte_carlo" simulates every point over synthetic weather years and writes kpi distributions,
+	                                   #"incremental" only simulates the dates added since its last run, whose states are in out_file.state
+	"adaptive_kpi"           : "autoprod", #any AgglomeratedSimResults field
+	"adaptive_tolerance"     : 0.02,
+	"adaptive_budget"        : 2000, #maximum number of simulations
+	"adaptive_max_depth"     : 6,
+	"monte_carlo_count"      : 100, #synthetic years, the same ones for every point
+	"monte_carlo_block_days" : 7, #days taken together from the data
+	"monte_carlo_window_days": 21, #maximum distance of a block to its date of the year
+	"incremental_check"      : False, #compares the kpis of an incremental run with a full recompute
+	"shard_range_size"       : 64, #grid points handed to a worker at once
+	"shard_lease_timeout"    : 3600, #seconds before the range of a worker that hangs is given to another one, a disconnected worker's ranges are at once
+	"profile"                : None, #None, "time" or "memory" (much slower), writes a summary and out_file.trace.json
+	"dtype"                  : "float64" #"float32" halves the curves, the simulation buffers and the kpi columns of a .store
 }
 if (len(argv) < 2):
 	print("you need to specify the result file location")
+	print("usage :", argv[0], "out_file [coordinator|worker host:port]")
 	exit()
 out_file_path = argv[1]
-dl = dataloader()
-
-print("loading home consumptions data")
-home_consumption = dl.load_one_user("../data/foyer/breton/averageUser0.csv")
-ent_consumption = dl.load_one_user("../data/ENT_MERGED.csv")
-pro_consumption = dl.load_one_user("../data/PRO_MERGED.csv")
-print("loading wind prod data")
-windProd = dl.load_wind_prod("../data/scaled_wind_prod.csv")
-print("loading solar prod data")
-solarProd = dl.load_solar_panel_prod("../data/production_bretagne/Solaire.csv")
-print("loading bioenergy prod data")
-bioenergy_prod = dl.load_solar_panel_prod("../data/production_bretagne/Bioenergie.csv")
-print("getting intersection")
-intersec = home_consumption.get_intersect(windProd)
-print("getting prod slice")
-windProd  = windProd.get_slice(intersec)
-solarProd = solarProd.get_slice(intersec)
-print("getting hom consumption slice")
-home_consumption = home_consumption.get_slice(intersec)
-print("prod set to scale")
-print(windProd.get_average())
-windProd = windProd.get_scaled(1.0)
-print("setting solar prod to scale and adding it to prod")
-solarProd = solarProd.get_scaled(1.0)
-bioenergyProd = bioenergy_prod.get_scaled(1.0)
+#sharded sweep : one coordinator hands out grid ranges to workers started on any host
+shard_mode    = argv[2] if len(argv) > 3 else None
+shard_address = (argv[3].split(":")[0], int(argv[3].split(":")[1])) if len(argv) > 3 else None
+if PARAMS["profile"] is not None:
+	enable_profiling(PARAMS["profile"] == "memory")
+sim_params = load_scenario_base([PARAMS["RES_cons"], PARAMS["ENT_cons"] ,PARAMS["PRO_cons"]], PARAMS["begin"], PARAMS["end"], PARAMS["scale_before_slice"], dtype=PARAMS["dtype"])
+sim_params.piloted_bioenergy_window = PARAMS["piloted_window"]
+for (name, value) in PARAMS["battery_model"].items():
+	setattr(sim_params, "battery_" + name, value)
 t1 = time()
 print(f"loading data finished, took {t1 - t0}s")
-sim_params = SimParams(
-	has_solar                     = True,
-	has_wind                      = True,
-	has_bioenergy                 = True,
-	has_piloted_bioenergy         = False,
-	has_battery                   = True,
-	has_flexibility               = True,
-	has_solar_scaling             = True,
-	has_wind_scaling              = True,
-	has_bioenergy_scaling         = True,
-	has_piloted_bioenergy_scaling = False,
-	has_consumer_scaling          = [True, True, True],
-	solar_power                   = 0.0,
-	wind_power                    = 0.0,
-	bioenergy_power               = 0.0,
-	battery_capacity              = 0.0,
-	piloted_bioenergy_power       = 0.0,
-	flexibility_ratio             = 0.0,
-	consumer_power                = [PARAMS["RES_cons"], PARAMS["ENT_cons"] ,PARAMS["PRO_cons"]],
-	consumer_contrib              = [1.0, 1.0, 1.0],
-	solar_curve                   = solarProd,
-	wind_curve                    = windProd,
-	bioenergy_curve               = bioenergy_prod,
-	consumer_curves               = [home_consumption, ent_consumption, pro_consumption],
-	begin                         = PARAMS["begin"],
-	end                           = PARAMS["end"],
-	scale_before_slice            = PARAMS["scale_before_slice"]
-)
-total_sim_count = PARAMS["wind_nb_points"] * PARAMS["sun_nb_points"] * PARAMS["bio_nb_points"] * PARAMS["battery_nb_points"] * PARAMS["flex_nb_points"] 
-size = 0
-def get_total_size(obj):
-	size = 0
-	for v in vars(obj):
-		var = vars(obj)[v]
-		try:
-			next_vars = vars(var)
-			size += get_total_size(var)
-		except TypeError:
-			size += getsizeof(var)
-	return size
-
+total_sim_count = PARAMS["wind_nb_points"] * PARAMS["sun_nb_points"] * PARAMS["bio_nb_points"] * PARAMS["battery_nb_points"] * PARAMS["flex_nb_points"] * PARAMS["piloted_nb_points"]
 manager = Manager()
 thread_sims_to_do    = [[] for i in range(PARAMS["thread_count"])]
 thread_sim_params    = [sim_params.get_clone() for i in range(PARAMS["thread_count"])]
 thread_results       = manager.list()
+thread_profiles      = manager.list()
 running_thread_count = 0
 print("size", get_total_size(sim_params))
 current_sim_count = 0
+def send_profile():
+	#called at the end of a worker process, its events are merged by the parent
+	if get_profiler() is not None:
+		thread_profiles.append(get_profiler().drain_events())
+
+def write_profile():
+	profiler = get_profiler()
+	if profiler is None:
+		return
+	for events in thread_profiles:
+		profiler.add_events(events)
+	profiler.print_summary()
+	profiler.to_chrome_trace(out_file_path + ".trace.json")
+atexit.register(write_profile)
+
+def write_output(results):
+	#a path ending with .store gets the binary columnar format, anything else the csv
+	if out_file_path.endswith(STORE_EXTENSION):
+		ResultStore.from_results(out_file_path, results, PARAMS["dtype"])
+	else:
+		write_results(out_file_path, results)
+
+def write_output_matrix(matrix):
+	if out_file_path.endswith(STORE_EXTENSION):
+		ResultStore.write(out_file_path, get_result_columns(), matrix, PARAMS["dtype"])
+	else:
+		write_results_matrix(out_file_path, matrix)
+
+if shard_mode == "coordinator":
+	print("waiting for workers on", shard_address)
+	t1 = time()
+	coordinator = ShardCoordinator(total_sim_count, PARAMS["shard_range_size"], PARAMS["shard_lease_timeout"], shard_address)
+	write_output_matrix(coordinator.serve())
+	t2 = time()
+	print(f"sharded sweep finished, took {t2 - t1}s (elapsed {t2 - t0}s)")
+	exit()
+if shard_mode == "worker":
+	def shard_worker_function(i):
+		count = run_worker(shard_address, total_sim_count, lambda begin, end : simulate_grid_range(thread_sim_params[i], PARAMS, begin, end))
+		print("worker", i, "simulated", count, "points")
+		send_profile()
+	workers = [Process(target=shard_worker_function, args=(i,)) for i in range(PARAMS["thread_count"])]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	exit()
+
+if PARAMS["sweep_mode"] == "monte_carlo":
+	print("starting monte carlo simulation over", PARAMS["monte_carlo_count"], "synthetic years")
+	t1 = time()
+	monte_carlo = MonteCarlo(sim_params, PARAMS["monte_carlo_count"], PARAMS["monte_carlo_block_days"], PARAMS["monte_carlo_window_days"])
+	points = get_grid_points(PARAMS)
+	samples = monte_carlo.run(points, PARAMS["thread_count"])
+	t2 = time()
+	print(f"monte carlo finished, {samples.shape[0] * samples.shape[1]} simulations, took {t2 - t1}s (elapsed {t2 - t0}s)")
+	write_distributions(out_file_path, points, samples)
+	exit()
+
+if PARAMS["sweep_mode"] == "incremental":
+	print("starting incremental simulation, states in", out_file_path + ".state")
+	t1 = time()
+	incremental_sweep = IncrementalSweep(sim_params, out_file_path + ".state")
+	points = get_grid_points(PARAMS)
+	results = incremental_sweep.run(points, PARAMS["thread_count"])
+	t2 = time()
+	print(f"incremental sweep finished, took {t2 - t1}s (elapsed {t2 - t0}s)")
+	if PARAMS["incremental_check"]:
+		print("largest relative differences with a full recompute", incremental_sweep.check(points))
+	write_output(results)
+	exit()
+
+if PARAMS["sweep_mode"] == "adaptive":
+	print("starting adaptive simulation")
+	t1 = time()
+	#forked workers inherit sim_params from this process
+	set_process_sim_params(sim_params)
+	with Pool(PARAMS["thread_count"]) as pool:
+		adaptive_sweep = AdaptiveSweep(PARAMS, lambda points : collect_process_outputs(pool.map(simulate_in_process, points)),
+			kpi       = PARAMS["adaptive_kpi"],
+			tolerance = PARAMS["adaptive_tolerance"],
+			budget    = PARAMS["adaptive_budget"],
+			max_depth = PARAMS["adaptive_max_depth"],
+			batch_size= PARAMS["thread_count"])
+		results = adaptive_sweep.run()
+	t2 = time()
+	print(f"adaptive sweep finished, {len(results)} simulations instead of {total_sim_count}, took {t2 - t1}s (elapsed {t2 - t0}s)")
+	write_output(results)
+	exit()
+
+if PARAMS["executor"] == "thread":
+	print("starting all simulations in", PARAMS["thread_count"], "threads")
+	t1 = time()
+	results = run_threaded(sim_params, get_grid_points(PARAMS), PARAMS["thread_count"])
+	t2 = time()
+	print(f"all threads have finished, total time : {t2-t0} ({t2-t1}s in simulation, {len(results) / (t2 - t1)} scenarios/s)")
+	write_output(results)
+	exit()
+
 print("generating data")
 t1 = time()
-for wind in range(PARAMS["wind_nb_points"]):
-		for sun in range(PARAMS["sun_nb_points"]):
-			for bio in range(PARAMS["bio_nb_points"]):
-				for battery in range(PARAMS["battery_nb_points"]):
-					for flex in range(PARAMS["flex_nb_points"]):
-						#print("simulation", current_sim_count, "out of", total_sim_count)
-						wind_to_sim    = (PARAMS["wind_min"]    + (PARAMS["wind_max"]    - PARAMS["wind_min"])    * wind    / max(0, PARAMS["wind_nb_points"]     - 1)) * PARAMS["scaling_factor_for_pop"]
-						bio_to_sim     = (PARAMS["bio_min"]     + (PARAMS["bio_max"]     - PARAMS["bio_min"])     * bio     / max(0, PARAMS["bio_nb_points"]      - 1)) * PARAMS["scaling_factor_for_pop"]
-						sun_to_sim     = (PARAMS["sun_min"]     + (PARAMS["sun_max"]     - PARAMS["sun_min"])     * sun     / max(0, PARAMS["sun_nb_points"]      - 1)) * PARAMS["scaling_factor_for_pop"]
-						battery_to_sim = (PARAMS["battery_min"] + (PARAMS["battery_max"] - PARAMS["battery_min"]) * battery / max(0, PARAMS["battery_nb_points"]  - 1)) * PARAMS["scaling_factor_for_pop"]
-						flex_to_sim    = (PARAMS["flex_min"]    + (PARAMS["flex_max"]    - PARAMS["flex_min"])    * flex    / max(0, PARAMS["flex_nb_points"]     - 1))
-						thread_sims_to_do[current_sim_count%PARAMS["thread_count"]].append({
-							"wind_to_sim"    : wind_to_sim,
-							"bio_to_sim"     : bio_to_sim, 
-							"sun_to_sim"     : sun_to_sim,
-							"battery_to_sim" : battery_to_sim,
-							"flex_to_sim"    : flex_to_sim,
-						})
-						current_sim_count += 1
+for point in get_grid_points(PARAMS):
+	thread_sims_to_do[current_sim_count%PARAMS["thread_count"]].append(point)
+	current_sim_count += 1
 t2 = time()
 print(f"finished, took {t2 - t1}s (elapsed {t2 - t0}s)")
 def sim_process_function(i, params_to_sim, sim_param, sim_results):
 	print("process", i, "has started")
 	results = []
 	sim_param : SimParams = thread_sim_params[i]
+	arena = ScratchArena()
 	for j in range(len(params_to_sim)):
 		if (i == 0):
 			print("thread 0 is simming", j+1, "out of", len(params_to_sim))
-		param = params_to_sim[j]
-		sim_param.solar_power = param["sun_to_sim"]
-		sim_param.wind_power = param["wind_to_sim"]
-		sim_param.bioenergy_power = param["bio_to_sim"]
-		sim_param.battery_capacity = param["battery_to_sim"]
-		sim_param.flexibility_ratio = param["flex_to_sim"]
-		sim_param.check_and_convert_params()
-		result = simulate_senario(sim_param)
-		result = {**param,
-			"agglomerated" : AgglomeratedSimResults.from_sim_results(result)
-		}
-		results.append(result)
+		results.append(simulate_point(sim_param, params_to_sim[j], arena))
 	sim_results.append(results)
+	send_profile()
 
 processes = []
 print("starting all simulations")
@@ -169,18 +220,4 @@ for i in range(len(processes)):
 print(f"all threads have finished, total time : {t2-t0} ({t2-t1}s in simulation)")
 print(thread_results[0][0])
 print(thread_results[0][1])
-with open(out_file_path, "w" ) as out_file:
-	print("wind turbines(W/house)", "solar pannels(W/house)", "bioenergy(W/house)", "battery(Wh/house)", "flexibility (raw ratio)", sep=";", file=out_file, end=";")
-	print(thread_results[0][0]["agglomerated"].get_csv_titles(), file=out_file)
-	for results in thread_results:
-		for result in results:
-			print(result["wind_to_sim"],
-			    result["sun_to_sim"],
-				result["bio_to_sim"],
-				result["battery_to_sim"],
-				result["flex_to_sim"],
-				result["agglomerated"].to_csv_string(),
-				sep=";",
-				file=out_file)
-
-
+write_output([result for results in thread_results for result in results])
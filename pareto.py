@@ -0,0 +1,124 @@
+from __future__ import annotations
+from typing import *
+from bisect import bisect_right
+import numpy as np
+if len(__name__.split("."))==1:
+	from sweep import read_results, results_to_matrix, get_result_columns
+else:
+	from .sweep import read_results, results_to_matrix, get_result_columns
+
+#objectives are (column, "min" or "max"), columns being the ones of sweep.get_result_columns
+Objective = Tuple[str, str]
+
+def get_objective_matrix(columns : List[str], matrix : np.array, objectives : List[Objective]) -> np.array:
+	#every objective is turned into a value to minimize
+	values = np.empty((matrix.shape[0], len(objectives)), dtype=np.float64)
+	for (i, (column, direction)) in enumerate(objectives):
+		if column not in columns:
+			raise Exception(f"unknown column {column}, expected one of {columns}")
+		if direction not in ["min", "max"]:
+			raise Exception(f"objective direction should be min or max, got {direction}")
+		values[:, i] = matrix[:, columns.index(column)] * (1.0 if direction == "min" else -1.0)
+	return values
+
+def pareto_front_2d(values : np.array) -> np.array:
+	#sort on the first objective, then a point is kept if it improves the best second objective seen so far
+	order = np.lexsort((values[:, 1], values[:, 0]))
+	second = values[order, 1]
+	best_before = np.minimum.accumulate(np.concatenate(([np.inf], second[:-1])))
+	return np.sort(order[second < best_before])
+
+def pareto_front_3d(values : np.array) -> np.array:
+	#sort on the first objective and keep a staircase of the non-dominated (second, third) pairs seen so far
+	#the staircase is sorted by growing second objective, its third objective is then decreasing
+	order = np.lexsort((values[:, 2], values[:, 1], values[:, 0]))
+	stair_second : List[float] = []
+	stair_third  : List[float] = []
+	kept = []
+	for index in order:
+		(second, third) = (values[index, 1], values[index, 2])
+		position = bisect_right(stair_second, second)
+		#the closest step on the left has the smallest third objective of all the ones with a smaller second objective
+		if position > 0 and stair_third[position - 1] <= third:
+			continue
+		kept.append(index)
+		end = position
+		while end < len(stair_second) and stair_third[end] >= third:
+			end += 1
+		stair_second[position:end] = [second]
+		stair_third [position:end] = [third]
+	return np.sort(np.array(kept, dtype=np.int64))
+
+def pareto_front_nd(values : np.array, block_size : int = 4096) -> np.array:
+	#sort filter skyline : points sorted by the sum of their normalized objectives can only be dominated by
+	#previous points, each block is compared at once to the front found so far, then within itself
+	span = values.max(axis=0) - values.min(axis=0)
+	normalized = (values - values.min(axis=0)) / np.where(span == 0, 1.0, span)
+	order = np.lexsort(tuple(normalized[:, i] for i in reversed(range(values.shape[1]))) + (normalized.sum(axis=1),))
+	front = np.empty((0, values.shape[1]))
+	kept = []
+	for start in range(0, len(order), block_size):
+		block = order[start:start + block_size]
+		candidates = values[block]
+		#the first front points have the smallest sums and dominate most candidates, so chunks start small
+		chunk_start = 0
+		chunk_size  = 8
+		while chunk_start < len(front) and len(block) != 0:
+			chunk = front[chunk_start:chunk_start + chunk_size]
+			dominated = np.any(np.all(chunk[:, None, :] <= candidates[None, :, :], axis=2), axis=0)
+			block = block[~dominated]
+			candidates = candidates[~dominated]
+			chunk_start += chunk_size
+			chunk_size = min(chunk_size * 2, 512)
+		for (index, candidate) in zip(block, candidates):
+			if len(front) != 0 and np.any(np.all(front <= candidate, axis=1)):
+				continue
+			front = np.vstack((front, candidate))
+			kept.append(index)
+	return np.sort(np.array(kept, dtype=np.int64))
+
+def pareto_front(values : np.array) -> np.array:
+	#indices of the non-dominated rows of values, every column being minimized, duplicates are kept once
+	values = np.atleast_2d(np.asarray(values, dtype=np.float64))
+	if len(values) == 0:
+		return np.array([], dtype=np.int64)
+	if values.shape[1] == 1:
+		return np.array([np.argmin(values[:, 0])], dtype=np.int64)
+	if values.shape[1] == 2:
+		return pareto_front_2d(values)
+	if values.shape[1] == 3:
+		return pareto_front_3d(values)
+	return pareto_front_nd(values)
+
+class ParetoFront():
+	#front over a stream of results, every batch is merged with the current front only
+	objectives : List[Objective]
+	columns    : List[str]
+	rows       : np.array #rows of the front, with every column of the result file
+	def __init__(self, objectives : List[Objective], columns : List[str] = None):
+		self.objectives = objectives
+		self.columns    = columns if columns is not None else get_result_columns()
+		self.rows       = np.empty((0, len(self.columns)))
+
+	def add_rows(self, rows : np.array) -> ParetoFront:
+		candidates = np.vstack((self.rows, np.atleast_2d(rows)))
+		self.rows = candidates[pareto_front(get_objective_matrix(self.columns, candidates, self.objectives))]
+		return self
+
+	def add_results(self, results : Iterable[Dict[str, Any]]) -> ParetoFront:
+		#results as returned by sweep.simulate_point
+		return self.add_rows(results_to_matrix(results))
+
+	@classmethod
+	def from_file(cls, path : str, objectives : List[Objective], chunk_size : int = 1_000_000) -> ParetoFront:
+		(columns, matrix) = read_results(path)
+		front = ParetoFront(objectives, columns)
+		for start in range(0, len(matrix), chunk_size):
+			front.add_rows(matrix[start:start + chunk_size])
+		return front
+
+	def to_csv(self, path : str):
+		with open(path, "w") as out_file:
+			print(*self.columns, sep=";", file=out_file)
+			for row in self.rows:
+				print(*row, sep=";", file=out_file)
@@ -32,15 +32,10 @@ def prod_bretagne(inpath, outpath):
 		#assumes the data is just in decreasing date order, reverses the data
 		dates[key] = [d for d in reversed(dates[key])]
 		prods[key] = [p for p in reversed(prods[key])]
-		hourlyDates : List[datetime] = []
-		hourlyProds : List[float] = []
-		for i in range(len(dates[key])):
-			date = dates[key][i]
-			if len(hourlyDates) != 0 and hourlyDates[-1].hour == date.hour:
-				hourlyProds[-1] += prods[key][i]
-			else:
-				hourlyDates.append(date)
-				hourlyProds.append(prods[key][i])
+		#half-hourly energies are summed into hourly buckets
+		hourly = PowerData(dates[key], np.array(prods[key])).resample(timedelta(hours = 1), how = "sum")
+		hourlyDates : List[datetime] = hourly.dates
+		hourlyProds : List[float] = hourly.power
 		with open(outpath + f"{toTreat[key]}.csv", "w") as outp:
 			for i in range(len(hourlyDates)):
 				print(hourlyDates[i].strftime("%Y-%m-%d:%H"), hourlyProds[i], sep=";", file=outp)
\ No newline at end of file
@@ -0,0 +1,176 @@
+from __future__ import annotations
+from typing import *
+from contextlib import nullcontext
+from time import perf_counter
+from sys import getsizeof
+import json
+import os
+import threading
+import tracemalloc
+import numpy as np
+
+#opt-in instrumentation of the simulation stages :
+#  profiler = enable_profiling()      #or enable_profiling(memory=True) to also count the allocations
+#  ... run simulations or a sweep ...
+#  profiler.print_summary()
+#  profiler.to_chrome_trace("trace.json") #open it in chrome://tracing or https://ui.perfetto.dev
+#when profiling is disabled, stage() returns a shared empty context manager, nothing is timed
+#memory counters come from tracemalloc which is global to the process, they are only exact with a single thread
+
+#(name, start in seconds, duration in seconds, pid, tid, allocated bytes, peak bytes)
+Event = Tuple[str, float, float, int, int, int, int]
+NULL_STAGE = nullcontext()
+PROFILER : Optional[Profiler] = None
+
+class Stage():
+	__slots__ = ("profiler", "name", "start", "memory_start", "peak")
+	def __init__(self, profiler : Profiler, name : str):
+		self.profiler = profiler
+		self.name     = name
+
+	def __enter__(self) -> Stage:
+		if self.profiler.memory:
+			self.profiler.enter_memory_stage(self)
+		self.start = perf_counter()
+		return self
+
+	def __exit__(self, *args):
+		duration = perf_counter() - self.start
+		(allocated, peak) = self.profiler.exit_memory_stage(self) if self.profiler.memory else (0, 0)
+		self.profiler.events.append((self.name, self.start, duration, os.getpid(), threading.get_ident(), allocated, peak))
+
+class Profiler():
+	memory : bool
+	events : List[Event]
+	def __init__(self, memory : bool = False):
+		self.memory = memory
+		self.events = []
+		self.local  = threading.local()
+		if memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+
+	def get_stack(self) -> List[Stage]:
+		if not hasattr(self.local, "stack"):
+			self.local.stack = []
+		return self.local.stack
+
+	def enter_memory_stage(self, stage : Stage):
+		#tracemalloc has a single peak, it is folded into the enclosing stage before being reset for this one
+		stack = self.get_stack()
+		(current, peak) = tracemalloc.get_traced_memory()
+		if len(stack) != 0:
+			stack[-1].peak = max(stack[-1].peak, peak)
+		tracemalloc.reset_peak()
+		stage.memory_start = current
+		stage.peak = current
+		stack.append(stage)
+
+	def exit_memory_stage(self, stage : Stage) -> Tuple[int, int]:
+		stack = self.get_stack()
+		(current, peak) = tracemalloc.get_traced_memory()
+		peak = max(stage.peak, peak)
+		stack.pop()
+		if len(stack) != 0:
+			stack[-1].peak = max(stack[-1].peak, peak)
+		tracemalloc.reset_peak()
+		return (current - stage.memory_start, peak - stage.memory_start)
+
+	def drain_events(self) -> List[Event]:
+		#events recorded since the last call, used to send the events of a worker process to its parent
+		(events, self.events) = (self.events, [])
+		return events
+
+	def add_events(self, events : Iterable[Event]):
+		self.events.extend(events)
+
+	def get_summary(self) -> Dict[str, Dict[str, float]]:
+		#per stage statistics over every thread and process, durations in seconds and memory in bytes
+		grouped : Dict[str, List[Event]] = {}
+		for event in self.events:
+			grouped.setdefault(event[0], []).append(event)
+		summary = {}
+		for (name, events) in grouped.items():
+			durations = np.array([e[2] for e in events])
+			summary[name] = {
+				"count"     : len(events),
+				"total"     : float(durations.sum()),
+				"mean"      : float(durations.mean()),
+				"max"       : float(durations.max()),
+				"workers"   : len(set([(e[3], e[4]) for e in events])),
+				"allocated" : float(np.mean([e[5] for e in events])),
+				"peak"      : float(np.max([e[6] for e in events])),
+			}
+		return summary
+
+	def get_summary_table(self) -> str:
+		lines = [f"{'stage':28} {'calls':>8} {'total(s)':>10} {'mean(ms)':>10} {'max(ms)':>10} {'workers':>8}" + (f" {'alloc(MB)':>10} {'peak(MB)':>10}" if self.memory else "")]
+		for (name, s) in sorted(self.get_summary().items(), key=lambda item : -item[1]["total"]):
+			line = f"{name:28} {s['count']:8} {s['total']:10.3f} {s['mean'] * 1000:10.3f} {s['max'] * 1000:10.3f} {s['workers']:8}"
+			if self.memory:
+				line += f" {s['allocated'] / 1e6:10.3f} {s['peak'] / 1e6:10.3f}"
+			lines.append(line)
+		return "\n".join(lines)
+
+	def print_summary(self):
+		print(self.get_summary_table())
+
+	def to_chrome_trace(self, path : str):
+		#complete events ("ph" : "X"), timestamps in microseconds from the first recorded stage
+		origin = min([e[1] for e in self.events]) if len(self.events) != 0 else 0.0
+		trace = [{
+			"name" : name,
+			"cat"  : "sim",
+			"ph"   : "X",
+			"ts"   : (start - origin) * 1e6,
+			"dur"  : duration * 1e6,
+			"pid"  : pid,
+			"tid"  : tid,
+			"args" : {"allocated" : allocated, "peak" : peak} if self.memory else {},
+		} for (name, start, duration, pid, tid, allocated, peak) in self.events]
+		with open(path, "w") as out_file:
+			json.dump({"traceEvents" : trace, "displayTimeUnit" : "ms"}, out_file)
+
+def enable_profiling(memory : bool = False) -> Profiler:
+	global PROFILER
+	PROFILER = Profiler(memory)
+	return PROFILER
+
+def disable_profiling() -> Optional[Profiler]:
+	#returns the profiler that was running, with its events
+	global PROFILER
+	(profiler, PROFILER) = (PROFILER, None)
+	if profiler is not None and profiler.memory:
+		tracemalloc.stop()
+	return profiler
+
+def get_profiler() -> Optional[Profiler]:
+	return PROFILER
+
+def stage(name : str) -> ContextManager:
+	if PROFILER is None:
+		return NULL_STAGE
+	return Stage(PROFILER, name)
+
+def get_total_size(obj : Any, seen : Set[int] = None) -> int:
+	#bytes used by obj and everything it references, objects shared by several references are counted once
+	#numpy arrays count their data buffer, views count the array they are a view of
+	seen = seen if seen is not None else set()
+	if id(obj) in seen:
+		return 0
+	seen.add(id(obj))
+	if isinstance(obj, np.ndarray):
+		if obj.base is not None:
+			return getsizeof(obj) + get_total_size(obj.base, seen)
+		return max(getsizeof(obj), obj.nbytes)
+	size = getsizeof(obj)
+	if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+		return size
+	if isinstance(obj, dict):
+		return size + sum([get_total_size(k, seen) + get_total_size(v, seen) for (k, v) in obj.items()])
+	if isinstance(obj, (list, tuple, set, frozenset)):
+		return size + sum([get_total_size(v, seen) for v in obj])
+	if hasattr(obj, "__dict__"):
+		size += get_total_size(vars(obj), seen)
+	if hasattr(obj, "__slots__"):
+		size += sum([get_total_size(getattr(obj, s), seen) for s in obj.__slots__ if hasattr(obj, s)])
+	return size
@@ -0,0 +1,149 @@
+from __future__ import annotations
+from typing import *
+import os
+import json
+import numpy as np
+if len(__name__.split("."))==1:
+	from sweep import read_results, results_to_matrix, get_result_columns, write_csv_titles, AXES, AXIS_KEYS
+	from calc import get_power_dtype
+else:
+	from .sweep import read_results, results_to_matrix, get_result_columns, write_csv_titles, AXES, AXIS_KEYS
+	from .calc import get_power_dtype
+
+STORE_EXTENSION = ".store"
+INPUT_COLUMNS = [AXIS_KEYS[axis] for axis in AXES]
+#relative tolerance when looking for a parameter value
+EQUALITY_TOLERANCE = 1e-9
+
+class ResultStore():
+	#sweep results as a directory of one .npy file per column, memory mapped when opened
+	#rows are sorted by the input parameters (wind first, piloted bioenergy last), the same order as the grid,
+	#and every row knows its coordinates on the axes (sorted distinct values of each parameter)
+	#input columns are always float64 so that they can be looked up exactly, kpi columns can be float32
+	path        : str
+	columns     : List[str]
+	data        : Dict[str, np.array]
+	axes        : Dict[str, np.array]
+	coordinates : np.array
+	is_grid     : bool
+	def __init__(self, path : str, columns : List[str], data : Dict[str, np.array], axes : Dict[str, np.array], coordinates : np.array, is_grid : bool):
+		self.path        = path
+		self.columns     = columns
+		self.data        = data
+		self.axes        = axes
+		self.coordinates = coordinates
+		self.is_grid     = is_grid
+
+	@classmethod
+	def write(cls, path : str, columns : List[str], matrix : np.array, dtype : str = "float64") -> ResultStore:
+		#dtype is the one of the kpi columns, "float32" halves the size of the store
+		os.makedirs(path, exist_ok=True)
+		inputs = [columns.index(c) for c in INPUT_COLUMNS]
+		order = np.lexsort(tuple(matrix[:, i] for i in reversed(inputs)))
+		matrix = matrix[order]
+		axes = {c : np.unique(matrix[:, i]) for (c, i) in zip(INPUT_COLUMNS, inputs)}
+		coordinates = np.column_stack([np.searchsorted(axes[c], matrix[:, i]) for (c, i) in zip(INPUT_COLUMNS, inputs)]).astype(np.int32)
+		#rows being sorted, duplicated points are next to each other
+		duplicated = np.any(np.all(np.diff(coordinates, axis=0) == 0, axis=1)) if len(matrix) > 1 else False
+		is_grid = int(np.prod([len(a) for a in axes.values()])) == len(matrix) and not duplicated
+		dtype = get_power_dtype(dtype)
+		for (i, column) in enumerate(columns):
+			np.save(os.path.join(path, column + ".npy"), np.ascontiguousarray(matrix[:, i], dtype=np.float64 if column in INPUT_COLUMNS else dtype))
+		np.save(os.path.join(path, "coordinates.npy"), coordinates)
+		with open(os.path.join(path, "meta.json"), "w") as out_file:
+			json.dump({
+				"columns" : columns,
+				"rows"    : len(matrix),
+				"is_grid" : bool(is_grid),
+				"axes"    : {c : a.tolist() for (c, a) in axes.items()},
+			}, out_file)
+		return cls.open(path)
+
+	@classmethod
+	def from_results(cls, path : str, results : Iterable[Dict[str, Any]], dtype : str = "float64") -> ResultStore:
+		return cls.write(path, get_result_columns(), results_to_matrix(results), dtype)
+
+	@classmethod
+	def from_csv(cls, csv_path : str, path : str, dtype : str = "float64") -> ResultStore:
+		(columns, matrix) = read_results(csv_path)
+		return cls.write(path, columns, matrix, dtype)
+
+	@classmethod
+	def open(cls, path : str) -> ResultStore:
+		with open(os.path.join(path, "meta.json")) as inp:
+			meta = json.load(inp)
+		data = {c : np.load(os.path.join(path, c + ".npy"), mmap_mode="r") for c in meta["columns"]}
+		axes = {c : np.array(a) for (c, a) in meta["axes"].items()}
+		coordinates = np.load(os.path.join(path, "coordinates.npy"), mmap_mode="r")
+		return ResultStore(path, meta["columns"], data, axes, coordinates, meta["is_grid"])
+
+	def __len__(self) -> int:
+		return len(self.coordinates)
+
+	def column(self, name : str) -> np.array:
+		return self.data[name]
+
+	def get_axis_index(self, column : str, value : float) -> int:
+		#index of value on the axis of column, -1 if it isn't one of the simulated values
+		axis = self.axes[column]
+		index = int(np.clip(np.searchsorted(axis, value), 0, len(axis) - 1))
+		for i in [index - 1, index]:
+			if i >= 0 and abs(axis[i] - value) <= EQUALITY_TOLERANCE * max(1.0, abs(value)):
+				return i
+		return -1
+
+	def select(self, **conditions : Union[float, Tuple[float, float]]) -> np.array:
+		#row indices matching every condition, a value means equality and a (low, high) tuple an inclusive range
+		#the rows being sorted by parameters, leading equalities and the first range are binary searched,
+		#only the other conditions are tested row by row on what is left
+		begin = 0
+		end = len(self)
+		remaining = dict(conditions)
+		for (i, column) in enumerate(INPUT_COLUMNS):
+			if column not in remaining:
+				break
+			condition = remaining.pop(column)
+			coordinates = self.coordinates[begin:end, i]
+			if isinstance(condition, tuple):
+				low  = np.searchsorted(self.axes[column], condition[0] - EQUALITY_TOLERANCE * max(1.0, abs(condition[0])), side="left")
+				high = np.searchsorted(self.axes[column], condition[1] + EQUALITY_TOLERANCE * max(1.0, abs(condition[1])), side="right")
+				(begin, end) = (begin + np.searchsorted(coordinates, low, side="left"), begin + np.searchsorted(coordinates, high, side="left"))
+				break
+			index = self.get_axis_index(column, condition)
+			if index == -1:
+				return np.array([], dtype=np.int64)
+			(begin, end) = (begin + np.searchsorted(coordinates, index, side="left"), begin + np.searchsorted(coordinates, index, side="right"))
+		mask = np.ones(end - begin, dtype=bool)
+		for (column, condition) in remaining.items():
+			values = self.data[column][begin:end]
+			if isinstance(condition, tuple):
+				mask &= (values >= condition[0]) & (values <= condition[1])
+			else:
+				mask &= np.abs(values - condition) <= EQUALITY_TOLERANCE * max(1.0, abs(condition))
+		return begin + np.nonzero(mask)[0]
+
+	def get_rows(self, indices : np.array, columns : List[str] = None) -> np.array:
+		columns = columns if columns is not None else self.columns
+		return np.column_stack([self.data[c][indices] for c in columns])
+
+	def get_plane(self, x : str, y : str, kpi : str, **fixed : float) -> Tuple[np.array, np.array, np.array]:
+		#(X, Y, Z) 2D arrays ready for plot_surface, every other parameter is fixed to a simulated value
+		#missing points are nan
+		x_axis = self.axes[x]
+		y_axis = self.axes[y]
+		rows = self.select(**fixed)
+		x_index = self.coordinates[rows, INPUT_COLUMNS.index(x)]
+		y_index = self.coordinates[rows, INPUT_COLUMNS.index(y)]
+		z = np.full((len(x_axis), len(y_axis)), np.nan)
+		z[x_index, y_index] = self.data[kpi][rows]
+		(X, Y) = np.meshgrid(x_axis, y_axis, indexing="ij")
+		return (X, Y, z)
+
+	def to_csv(self, path : str, chunk_size : int = 100_000):
+		#same layout as the files written by the sweep
+		with open(path, "w") as out_file:
+			write_csv_titles(out_file)
+			for start in range(0, len(self), chunk_size):
+				rows = self.get_rows(np.arange(start, min(start + chunk_size, len(self))))
+				for row in rows:
+					print(*[str(v) for v in row], sep=";", file=out_file)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+from typing import *
+from datetime import datetime, timedelta
+from ctypes import *
+import numpy as np
+if len(__name__.split("."))==1:
+	from kernels import libsim
+else:
+	from .kernels import libsim
+
+ROLLING_STATS = ["mean", "sum", "std", "min", "max"]
+
+def get_window_bounds(dates : List[datetime], width : Union[int, timedelta], centered : bool = False) -> Tuple[np.array, np.array]:
+	#window of each point as [begin, end[ indices, an int width counts points, a timedelta width is a duration
+	#trailing windows end on the point, centered windows are around it, both are cut at the edges of the data
+	count = len(dates)
+	index = np.arange(count, dtype=np.int64)
+	if isinstance(width, timedelta):
+		seconds = np.array(dates, dtype="datetime64[s]").astype(np.int64)
+		duration = int(width.total_seconds())
+		if centered:
+			begin = np.searchsorted(seconds, seconds - duration // 2, side="left")
+			end   = np.searchsorted(seconds, seconds + (duration - duration // 2), side="left")
+		else:
+			begin = np.searchsorted(seconds, seconds - duration, side="right")
+			end   = index + 1
+	else:
+		if centered:
+			begin = index - width // 2
+			end   = begin + width
+		else:
+			begin = index - width + 1
+			end   = index + 1
+	return (np.clip(begin, 0, count).astype(np.int64), np.clip(end, 0, count).astype(np.int64))
+
+def rolling_extremum(matrix : np.array, begin : np.array, end : np.array, is_max : bool) -> np.array:
+	matrix = np.ascontiguousarray(matrix, dtype=np.float64)
+	out = np.empty((matrix.shape[0], len(begin)), dtype=np.float64)
+	libsim.rolling_extremum(
+		matrix.ctypes.data_as(POINTER(c_double)),
+		c_size_t(matrix.shape[0]),
+		c_size_t(matrix.shape[1]),
+		begin.ctypes.data_as(POINTER(c_int64)),
+		end.ctypes.data_as(POINTER(c_int64)),
+		c_size_t(len(begin)),
+		c_int(1 if is_max else 0),
+		out.ctypes.data_as(POINTER(c_double))
+	)
+	return out
+
+def rolling_stats(matrix : np.array, dates : List[datetime], width : Union[int, timedelta], stats : List[str] = ["mean"], centered : bool = False) -> Dict[str, np.array]:
+	#every row of matrix is a curve on dates, all of them are processed at once
+	for stat in stats:
+		if stat not in ROLLING_STATS:
+			raise Exception(f"unknown rolling statistic {stat}, expected one of {ROLLING_STATS}")
+	matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+	(begin, end) = get_window_bounds(dates, width, centered)
+	counts = np.maximum(end - begin, 1)
+	toReturn = {}
+	if "mean" in stats or "sum" in stats or "std" in stats:
+		#running sums, the row mean is removed first so the squares don't lose precision
+		offset = matrix.mean(axis=1, keepdims=True) if matrix.shape[1] != 0 else np.zeros((matrix.shape[0], 1))
+		centered_matrix = matrix - offset
+		cumsum = np.zeros((matrix.shape[0], matrix.shape[1] + 1))
+		np.cumsum(centered_matrix, axis=1, out=cumsum[:, 1:])
+		sums = cumsum[:, end] - cumsum[:, begin]
+		if "sum" in stats:
+			toReturn["sum"] = sums + offset * (end - begin)
+		if "mean" in stats:
+			toReturn["mean"] = sums / counts + offset
+		if "std" in stats:
+			squares = np.zeros((matrix.shape[0], matrix.shape[1] + 1))
+			np.cumsum(centered_matrix * centered_matrix, axis=1, out=squares[:, 1:])
+			variance = (squares[:, end] - squares[:, begin]) / counts - (sums / counts) ** 2
+			toReturn["std"] = np.sqrt(np.maximum(variance, 0.0))
+	if "min" in stats:
+		toReturn["min"] = rolling_extremum(matrix, begin, end, False)
+	if "max" in stats:
+		toReturn["max"] = rolling_extremum(matrix, begin, end, True)
+	return toReturn
@@ -0,0 +1,76 @@
+from __future__ import annotations
+from typing import *
+from datetime import datetime
+if len(__name__.split("."))==1:
+	from sim import SimParams
+	from dataLoader import dataloader
+	from configuration import config
+else:
+	from .sim import SimParams
+	from .dataLoader import dataloader
+	from .configuration import config
+
+def get_consumer_powers() -> List[float]:
+	#average residential, enterprise and professional consumption per inhabitant of the two communities, in W
+	population = config.CA_REDON_POPULATION + config.CA_PONTCHATEAU_POPULATION
+	return [
+		(config.CA_PONTCHATEAU_RES_CONSUMPTION + config.CA_REDON_RES_CONSUMPTION) / population,
+		(config.CA_PONTCHATEAU_ENT_CONSUMPTION + config.CA_REDON_ENT_CONSUMPTION) / population,
+		(config.CA_PONTCHATEAU_PRO_CONSUMPTION + config.CA_REDON_PRO_CONSUMPTION) / population,
+	]
+
+def load_scenario_base(consumer_power : List[float], begin : datetime, end : datetime, scale_before_slice : bool = False, data_folder : str = "../data/", dtype : str = "float64") -> SimParams:
+	#loads every curve, aligns the productions on the home consumption and normalizes them, then stores them as dtype
+	#the returned params have every power set to 0, simulate_point sets them for each scenario
+	dl = dataloader()
+	print("loading home consumptions data")
+	home_consumption = dl.load_one_user(data_folder + "foyer/breton/averageUser0.csv")
+	ent_consumption = dl.load_one_user(data_folder + "ENT_MERGED.csv")
+	pro_consumption = dl.load_one_user(data_folder + "PRO_MERGED.csv")
+	print("loading wind prod data")
+	windProd = dl.load_wind_prod(data_folder + "scaled_wind_prod.csv")
+	print("loading solar prod data")
+	solarProd = dl.load_solar_panel_prod(data_folder + "production_bretagne/Solaire.csv")
+	print("loading bioenergy prod data")
+	bioenergy_prod = dl.load_solar_panel_prod(data_folder + "production_bretagne/Bioenergie.csv")
+	print("getting intersection")
+	intersec = home_consumption.get_intersect(windProd)
+	print("getting prod slice")
+	windProd  = windProd.get_slice(intersec)
+	solarProd = solarProd.get_slice(intersec)
+	print("getting hom consumption slice")
+	home_consumption = home_consumption.get_slice(intersec)
+	print("prod set to scale")
+	print(windProd.get_average())
+	windProd = windProd.get_scaled(1.0)
+	print("setting solar prod to scale and adding it to prod")
+	solarProd = solarProd.get_scaled(1.0)
+	return SimParams(
+		has_solar                     = True,
+		has_wind                      = True,
+		has_bioenergy                 = True,
+		has_piloted_bioenergy         = True,
+		has_battery                   = True,
+		has_flexibility               = True,
+		has_solar_scaling             = True,
+		has_wind_scaling              = True,
+		has_bioenergy_scaling         = True,
+		has_piloted_bioenergy_scaling = True,
+		has_consumer_scaling          = [True, True, True],
+		solar_power                   = 0.0,
+		wind_power                    = 0.0,
+		bioenergy_power               = 0.0,
+		battery_capacity              = 0.0,
+		piloted_bioenergy_power       = 0.0,
+		flexibility_ratio             = 0.0,
+		consumer_power                = consumer_power,
+		consumer_contrib              = [1.0, 1.0, 1.0],
+		solar_curve                   = solarProd,
+		wind_curve                    = windProd,
+		bioenergy_curve               = bioenergy_prod,
+		consumer_curves               = [home_consumption, ent_consumption, pro_consumption],
+		begin                         = begin,
+		end                           = end,
+		scale_before_slice            = scale_before_slice,
+		dtype                         = dtype
+	)
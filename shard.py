@@ -0,0 +1,152 @@
+from __future__ import annotations
+from typing import *
+from collections import deque
+from time import time, sleep
+import json
+import socket
+import socketserver
+import threading
+import numpy as np
+if len(__name__.split("."))==1:
+	from sweep import get_grid_point, simulate_point, results_to_matrix
+	from sim import SimParams
+	from arena import ScratchArena
+else:
+	from .sweep import get_grid_point, simulate_point, results_to_matrix
+	from .sim import SimParams
+	from .arena import ScratchArena
+
+#the coordinator and the workers exchange one json object per line over tcp :
+#  worker -> {"type" : "get", "total" : n}                            coordinator -> {"type" : "range", "begin" : b, "end" : e}, "wait" or "done"
+#  worker -> {"type" : "result", "begin" : b, "end" : e, "rows" : []} coordinator -> {"type" : "ok"}
+#ranges are grid indices [begin, end[, the ranges of a worker whose connection closes are given to another worker at once,
+#and a range that isn't returned before lease_timeout (a worker that hangs) too
+
+class ShardCoordinator():
+	total         : int
+	range_size    : int
+	lease_timeout : float
+	pending       : deque
+	leases        : Dict[int, Tuple[int, float, Hashable]]
+	shards        : Dict[int, np.array]
+	def __init__(self, total : int, range_size : int = 64, lease_timeout : float = 600.0, address : Tuple[str, int] = ("0.0.0.0", 5555)):
+		self.total         = total
+		self.range_size    = range_size
+		self.lease_timeout = lease_timeout
+		self.address       = address
+		self.pending       = deque([(b, min(b + range_size, total)) for b in range(0, total, range_size)])
+		self.leases        = {}
+		self.shards        = {}
+		self.lock          = threading.Lock()
+		self.finished      = threading.Event()
+		if total == 0:
+			self.finished.set()
+
+	def get_range(self, owner : Hashable = None) -> Dict[str, Any]:
+		with self.lock:
+			if self.finished.is_set():
+				return {"type" : "done"}
+			now = time()
+			if len(self.pending) == 0:
+				#ranges of lost (or too slow) workers are issued again
+				for (begin, (end, deadline, _)) in list(self.leases.items()):
+					if deadline < now:
+						self.pending.append((begin, end))
+						del self.leases[begin]
+			if len(self.pending) == 0:
+				return {"type" : "wait"}
+			(begin, end) = self.pending.popleft()
+			self.leases[begin] = (end, now + self.lease_timeout, owner)
+			return {"type" : "range", "begin" : begin, "end" : end}
+
+	def release(self, owner : Hashable):
+		#ranges leased to owner that it won't return, they are issued again first
+		with self.lock:
+			for (begin, (end, deadline, leased_to)) in list(self.leases.items()):
+				if leased_to == owner:
+					self.pending.appendleft((begin, end))
+					del self.leases[begin]
+
+	def add_shard(self, begin : int, end : int, rows : np.array):
+		with self.lock:
+			#a range computed twice gives the same rows, the first one is kept
+			if begin not in self.shards:
+				self.shards[begin] = rows
+			self.leases.pop(begin, None)
+			if sum([len(s) for s in self.shards.values()]) >= self.total:
+				self.finished.set()
+
+	def get_merged(self) -> np.array:
+		#shards in grid order, whatever order they came back in
+		return np.vstack([self.shards[begin] for begin in sorted(self.shards.keys())])
+
+	def handle(self, request : Dict[str, Any], owner : Hashable = None) -> Dict[str, Any]:
+		#owner identifies the worker (its connection), for release
+		if request["type"] == "get":
+			if request.get("total", self.total) != self.total:
+				return {"type" : "error", "message" : f"worker grid has {request['total']} points, expected {self.total}"}
+			return self.get_range(owner)
+		if request["type"] == "result":
+			self.add_shard(request["begin"], request["end"], np.array(request["rows"], dtype=np.float64))
+			return {"type" : "ok"}
+		return {"type" : "error", "message" : f"unknown request {request['type']}"}
+
+	def serve(self, timeout : float = None) -> np.array:
+		#blocks until every range has been computed, then returns the merged rows
+		coordinator = self
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				try:
+					for line in self.rfile:
+						answer = coordinator.handle(json.loads(line), self)
+						self.wfile.write((json.dumps(answer) + "\n").encode())
+				finally:
+					#the connection is closed (or broken), the worker won't return its ranges
+					coordinator.release(self)
+		socketserver.ThreadingTCPServer.allow_reuse_address = True
+		with socketserver.ThreadingTCPServer(self.address, Handler) as server:
+			server.daemon_threads = True
+			thread = threading.Thread(target=server.serve_forever, daemon=True)
+			thread.start()
+			if not self.finished.wait(timeout):
+				server.shutdown()
+				raise Exception("sweep didn't finish before the timeout")
+			#workers asking for work while we shut down get a closed connection, which they treat as done
+			server.shutdown()
+		return self.get_merged()
+
+def run_worker(address : Tuple[str, int], total : int, simulate_range : Callable[[int, int], np.array], wait_delay : float = 1.0, connect_retries : int = 30) -> int:
+	#asks ranges until the coordinator is done, returns the number of simulated points
+	for retry in range(connect_retries):
+		try:
+			connection = socket.create_connection(address)
+			break
+		except ConnectionRefusedError:
+			if retry == connect_retries - 1:
+				raise
+			sleep(wait_delay)
+	simulated = 0
+	with connection, connection.makefile("rwb") as stream:
+		def request(message : Dict[str, Any]) -> Dict[str, Any]:
+			stream.write((json.dumps(message) + "\n").encode())
+			stream.flush()
+			line = stream.readline()
+			if not line:
+				return {"type" : "done"}
+			return json.loads(line)
+		while True:
+			answer = request({"type" : "get", "total" : total})
+			if answer["type"] == "done":
+				return simulated
+			if answer["type"] == "wait":
+				sleep(wait_delay)
+				continue
+			if answer["type"] == "error":
+				raise Exception(answer["message"])
+			rows = simulate_range(answer["begin"], answer["end"])
+			request({"type" : "result", "begin" : answer["begin"], "end" : answer["end"], "rows" : rows.tolist()})
+			simulated += answer["end"] - answer["begin"]
+
+def simulate_grid_range(sim_params : SimParams, params : Dict[str, Any], begin : int, end : int) -> np.array:
+	arena = ScratchArena()
+	return results_to_matrix([simulate_point(sim_params, get_grid_point(params, i), arena) for i in range(begin, end)])
@@ -1,12 +1,23 @@
 from __future__ import annotations
-from datetime import datetime
+from datetime import datetime, timedelta
 import os 
 if len(__name__.split("."))==1:
 	from calc import *
+	from rolling import rolling_stats
+	from kernels import *
+	from profiling import stage
+	from arena import ScratchArena, get_buffer, get_cached
+	from dispatch import WindowLayout, dispatch_in_windows, DISPATCH_WINDOWS
 else:
 	from .calc import *
+	from .rolling import rolling_stats
+	from .kernels import *
+	from .profiling import stage
+	from .arena import ScratchArena, get_buffer, get_cached
+	from .dispatch import WindowLayout, dispatch_in_windows, DISPATCH_WINDOWS
 from typing import *
 from dataclasses import dataclass
+from copy import copy
 TOLERATED_ERROR = 1e-8
 from ctypes import *
 libsim = CDLL(os.path.dirname(os.path.realpath(__file__)) + "/cmodules/libsim.so")
@@ -43,11 +54,35 @@ class SimParams():
 	wind_curve              : PowerData
 	bioenergy_curve         : PowerData
 	consumer_curves         : Union[List[PowerData], PowerData]
+	#flexibility of every consumer class relative to the most flexible one, taken from the ratios given to the
+	#constructor when they differ (None when they don't), so that set_flexibility_ratio (the flex axis of a sweep)
+	#keeps the proportions of the classes whatever ratio it sets
+	flexibility_shares      : List[float]
+	#piloted bioenergy, with scaling piloted_bioenergy_power is the average power available over every window ("day"
+	#or "year") and piloted_bioenergy_max_power its maximum power (None for no maximum), without scaling
+	#piloted_bioenergy_power is the maximum power and there is no energy limit, see dispatch.py
+	piloted_bioenergy_max_power : float
+	piloted_bioenergy_window    : str
+	#battery model, the defaults are an ideal battery : powers in W drawn from and given to the grid (None for no limit),
+	#efficiencies of the charge and of the discharge, ratio of the stored energy lost per hour and bounds of the state
+	#of charge as ratios of battery_capacity, see calc.Battery
+	battery_max_charge_power     : float
+	battery_max_discharge_power  : float
+	battery_charge_efficiency    : float
+	battery_discharge_efficiency : float
+	battery_self_discharge       : float
+	battery_soc_min              : float
+	battery_soc_max              : float
 
 	#date params, defaults to None
 	begin                   : datetime
 	end                     : datetime
 	scale_before_slice      : bool
+	#resampling params, defaults to None (curves are only intersected)
+	time_step               : timedelta
+	#storage of the curves, "float64" (default) or "float32", see calc.POWER_DTYPES
+	#the simulation buffers follow the curves, the battery energy and the kpi sums are float64 in both cases
+	dtype                   : str
 	def __init__(self, \
 		has_solar                     : bool = False,\
 		has_wind                      : bool = False,\
@@ -72,9 +107,21 @@ class SimParams():
 		wind_curve                    : PowerData = None,\
 		bioenergy_curve               : PowerData = None,\
 		consumer_curves               : Union[List[PowerData], PowerData] = None,\
+		piloted_bioenergy_max_power   : float = None,\
+		piloted_bioenergy_window      : str = "day",\
+		battery_max_charge_power      : float = None,\
+		battery_max_discharge_power   : float = None,\
+		battery_charge_efficiency     : float = 1.0,\
+		battery_discharge_efficiency  : float = 1.0,\
+		battery_self_discharge        : float = 0.0,\
+		battery_soc_min               : float = 0.0,\
+		battery_soc_max               : float = 1.0,\
 		begin                         : datetime = None,\
 		end                           : datetime = None,\
-		scale_before_slice            : bool = False
+		scale_before_slice            : bool = False,\
+		time_step                     : timedelta = None,\
+		dtype                         : str = "float64",\
+		flexibility_shares            : List[float] = None
 	) -> None:
 		self.has_solar             : bool = has_solar
 		self.has_wind              : bool = has_wind
@@ -102,10 +149,24 @@ class SimParams():
 		self.wind_curve              : PowerData = wind_curve.get_copy()
 		self.bioenergy_curve         : PowerData = bioenergy_curve.get_copy()
 		self.consumer_curves         : Union[PowerData, List[PowerData]] = consumer_curves if isinstance(consumer_curves, PowerData) else [c.get_copy() for c in consumer_curves]
+		self.piloted_bioenergy_max_power : float = piloted_bioenergy_max_power
+		self.piloted_bioenergy_window    : str   = piloted_bioenergy_window
+		self.battery_max_charge_power     : float = battery_max_charge_power
+		self.battery_max_discharge_power  : float = battery_max_discharge_power
+		self.battery_charge_efficiency    : float = battery_charge_efficiency
+		self.battery_discharge_efficiency : float = battery_discharge_efficiency
+		self.battery_self_discharge       : float = battery_self_discharge
+		self.battery_soc_min              : float = battery_soc_min
+		self.battery_soc_max              : float = battery_soc_max
 
 		self.begin                   : datetime = begin
 		self.end                     : datetime = end
 		self.scale_before_slice      : bool     = scale_before_slice
+		self.time_step               : timedelta = time_step
+		self.dtype                   : str = dtype
+		self.flexibility_shares      : List[float] = flexibility_shares
+		if flexibility_shares is None and not isinstance(flexibility_ratio, (float, int)) and len(set(flexibility_ratio)) > 1:
+			self.flexibility_shares = [r / max(flexibility_ratio) for r in flexibility_ratio]
 		self.check_and_convert_params()
 
 	def get_clone(self) -> SimParams:
@@ -133,43 +194,110 @@ class SimParams():
 			wind_curve                    = self.wind_curve     .get_copy()  ,
 			bioenergy_curve               = self.bioenergy_curve.get_copy()  ,
 			consumer_curves               = self.consumer_curves if isinstance(self.consumer_curves, PowerData) else [c.get_copy() for c in self.consumer_curves],
+			piloted_bioenergy_max_power   = self.piloted_bioenergy_max_power,
+			piloted_bioenergy_window      = self.piloted_bioenergy_window,
+			battery_max_charge_power      = self.battery_max_charge_power,
+			battery_max_discharge_power   = self.battery_max_discharge_power,
+			battery_charge_efficiency     = self.battery_charge_efficiency,
+			battery_discharge_efficiency  = self.battery_discharge_efficiency,
+			battery_self_discharge        = self.battery_self_discharge,
+			battery_soc_min               = self.battery_soc_min,
+			battery_soc_max               = self.battery_soc_max,
 			begin                         = self.begin,
 			end                           = self.end,
-			scale_before_slice            = self.scale_before_slice
+			scale_before_slice            = self.scale_before_slice,
+			time_step                     = self.time_step,
+			dtype                         = self.dtype,
+			flexibility_shares            = self.flexibility_shares
 		)
 	def get_copy(self) -> SimParams:
 		return self.get_clone()
-	def get_wind_curve(self) -> PowerData:
+	def get_shared_clone(self) -> SimParams:
+		#the clone shares the curves (never modified in place) but has its own scalars and curve lists,
+		#so that several threads can simulate different scenarios over a single copy of the data
+		clone = copy(self)
+		clone.consumer_curves = self.consumer_curves[:]
+		for attribute in ["has_consumer_scaling", "consumer_power", "consumer_contrib", "flexibility_ratio"]:
+			value = getattr(self, attribute)
+			if isinstance(value, list):
+				setattr(clone, attribute, value[:])
+		return clone
+	def get_period_curve(self, curve : PowerData, power : float, scaling : bool, arena : ScratchArena = None, name : str = "curve") -> PowerData:
+		#curve over [begin, end[, scaled to power if scaling
+		#with an arena, the values are written in its buffer name and the dates are shared between scenarios
+		if arena is None:
+			if scaling:
+				if self.scale_before_slice == True:
+					return curve.get_scaled(power).get_slice_over_period(self.begin, self.end)
+				return curve.get_slice_over_period(self.begin, self.end).get_scaled(power)
+			return curve.get_slice_over_period(self.begin, self.end)
+		if scaling and self.scale_before_slice == True:
+			curve = curve.get_scaled(power, out=arena.get(name + " scaled", len(curve.dates), curve.power.dtype))
+		(i, j) = curve.get_period_indices(self.begin, self.end)
+		curve = curve.get_slice_over_period(self.begin, self.end, out=arena.get(name, j - i, curve.power.dtype), dates=arena.get_dates_slice(curve.dates, i, j))
+		if scaling and self.scale_before_slice != True:
+			curve = curve.get_scaled(power, out=curve.power)
+		return curve
+
+	def get_wind_curve(self, arena : ScratchArena = None) -> PowerData:
 		if (not self.has_wind):
 			raise Exception("no wind curve in this config")
-		if (self.has_wind_scaling):
-			if self.scale_before_slice == True:
-				return self.wind_curve.get_scaled(self.wind_power).get_slice_over_period(self.begin, self.end)
-			return self.wind_curve.get_slice_over_period(self.begin, self.end).get_scaled(self.wind_power)
-		return self.wind_curve.get_slice_over_period(self.begin, self.end)
+		return self.get_period_curve(self.wind_curve, self.wind_power, self.has_wind_scaling, arena, "wind")
 
-	def get_solar_curve(self) -> PowerData:
+	def get_solar_curve(self, arena : ScratchArena = None) -> PowerData:
 		if (not self.has_solar):
 			raise Exception("no solar curve in this config")
-		if (self.has_solar_scaling):
-			if self.scale_before_slice == True:
-				return self.solar_curve.get_scaled(self.solar_power).get_slice_over_period(self.begin, self.end)
-			return self.solar_curve.get_slice_over_period(self.begin, self.end).get_scaled(self.solar_power)
-		return self.solar_curve.get_slice_over_period(self.begin, self.end)
+		return self.get_period_curve(self.solar_curve, self.solar_power, self.has_solar_scaling, arena, "solar")
 
-	def get_constant_bioenergy_curve(self) -> PowerData:
+	def get_constant_bioenergy_curve(self, arena : ScratchArena = None) -> PowerData:
 		if (not self.has_bioenergy):
 			raise Exception("no non-piloted bioenergy curve in this config")
-		if (self.has_bioenergy_scaling):
-			if self.scale_before_slice == True:
-				return self.bioenergy_curve.get_scaled(self.bioenergy_power).get_slice_over_period(self.begin, self.end)
-			return self.bioenergy_curve.get_slice_over_period(self.begin, self.end).get_scaled(self.bioenergy_power)
-		return self.bioenergy_curve.get_slice_over_period(self.begin, self.end)
+		return self.get_period_curve(self.bioenergy_curve, self.bioenergy_power, self.has_bioenergy_scaling, arena, "bioenergy")
 	
-	def get_consumers_agglomerated_curves(self) -> PowerData:
+	def get_piloted_bioenergy_limits(self) -> Tuple[Optional[float], Optional[float]]:
+		#(average power over a window, maximum power) of the piloted bioenergy for dispatch_in_windows, None for no limit
+		if self.has_piloted_bioenergy_scaling:
+			return (self.piloted_bioenergy_power, self.piloted_bioenergy_max_power)
+		return (None, self.piloted_bioenergy_power if self.piloted_bioenergy_max_power is None else min(self.piloted_bioenergy_power, self.piloted_bioenergy_max_power))
+
+	def get_piloted_bioenergy_curve(self, production : PowerData, consumption : PowerData, arena : ScratchArena = None) -> PowerData:
+		#piloted bioenergy covering the highest deficits of production first, within its power and energy limits
+		if (not self.has_piloted_bioenergy):
+			raise Exception("no piloted bioenergy in this config")
+		count = len(production.dates)
+		dtype = production.power.dtype
+		deficit = np.subtract(consumption.power, production.power, out=arena.get("piloted deficit", count) if arena is not None else np.empty(count))
+		layout = get_cached(arena, "piloted " + self.piloted_bioenergy_window, production.dates, lambda : WindowLayout(production.dates, self.piloted_bioenergy_window))
+		(power, cap) = self.get_piloted_bioenergy_limits()
+		out = arena.get("piloted bioenergy", count, dtype) if arena is not None else np.empty(count, dtype=dtype)
+		return PowerData(production.dates, dispatch_in_windows(deficit, layout, power, cap, out), copy_dates=False)
+
+	def get_battery(self) -> Battery:
+		#empty battery of battery_capacity with the model of the params
+		return Battery(self.battery_capacity,
+			max_charge_power     = self.battery_max_charge_power,
+			max_discharge_power  = self.battery_max_discharge_power,
+			charge_efficiency    = self.battery_charge_efficiency,
+			discharge_efficiency = self.battery_discharge_efficiency,
+			self_discharge       = self.battery_self_discharge,
+			soc_min              = self.battery_soc_min,
+			soc_max              = self.battery_soc_max)
+
+	def get_consumers_agglomerated_curves(self, arena : ScratchArena = None) -> PowerData:
 		#usefull when there is no flexibility
+		#with an arena, consumers with different dates are agglomerated without it
 		toReturn : PowerData = None
 		for i in range(len(self.consumer_curves)):
+			if arena is not None:
+				curve = self.get_period_curve(self.consumer_curves[i], self.consumer_power[i], self.has_consumer_scaling[i], arena, "consumption" if toReturn is None else "consumer")
+				if toReturn is not None and not toReturn.check_simalarity(curve):
+					return self.get_consumers_agglomerated_curves()
+				curve *= self.consumer_contrib[i]
+				if toReturn is None:
+					toReturn = curve
+				else:
+					toReturn += curve
+				continue
 			curve = self.consumer_curves[i]
 			if (self.has_consumer_scaling[i] and self.scale_before_slice == True):
 				curve = curve.get_scaled(self.consumer_power[i])
@@ -187,6 +315,33 @@ class SimParams():
 			else:
 				toReturn += curve
 		return toReturn
+	def set_flexibility_ratio(self, ratio : float):
+		#ratio of the most flexible consumer class, the other ones keeping their share of it
+		if self.flexibility_shares is None:
+			self.flexibility_ratio = float(ratio)
+		else:
+			self.flexibility_ratio = [float(ratio) * s for s in self.flexibility_shares]
+	def get_flexibility_ratio(self) -> float:
+		#ratio of the most flexible consumer class, the one set by set_flexibility_ratio
+		return self.flexibility_ratio if isinstance(self.flexibility_ratio, (float, int)) else max(self.flexibility_ratio)
+	def has_class_flexibility(self) -> bool:
+		#consumers with different flexibility ratios are flexed class by class, equal ratios flex the agglomerated curve
+		return self.has_flexibility is True and not isinstance(self.flexibility_ratio, float) and len(set(self.flexibility_ratio)) > 1
+	def get_consumers_matrix(self, arena : ScratchArena = None) -> Tuple[List[datetime], np.array]:
+		#(consumers, dates) float64 matrix of the consumer curves weighted by their contribution,
+		#the agglomerated curve being the sum of its rows, every consumer must have the same dates
+		dates : List[datetime] = None
+		matrix : np.array = None
+		for i in range(len(self.consumer_curves)):
+			curve = self.get_period_curve(self.consumer_curves[i], self.consumer_power[i], self.has_consumer_scaling[i], arena, "consumer")
+			if matrix is None:
+				dates = curve.dates
+				length = len(self.consumer_curves) * len(dates)
+				matrix = (arena.get("consumers", length) if arena is not None else np.empty(length)).reshape((len(self.consumer_curves), len(dates)))
+			elif len(curve.dates) != len(dates) or not (curve.dates is dates or curve.dates == dates):
+				raise Exception("consumers flexed by class MUST have the same dates")
+			np.multiply(curve.power, self.consumer_contrib[i], out=matrix[i])
+		return (dates, matrix)
 	def get_consumers_curve_index(self, index : int = 0) -> PowerData:
 		if index >= len(self.consumer_curves) or index < 0:
 			raise Exception("index out of range")
@@ -205,6 +360,17 @@ class SimParams():
 			raise Exception("non pilotable bioenergy curve needed but not initialized")
 		if self.consumer_curves is None:
 			raise Exception("consumer curves are mandatory")
+		if self.has_piloted_bioenergy and self.piloted_bioenergy_window not in DISPATCH_WINDOWS:
+			raise Exception(f"piloted bioenergy window must be one of {DISPATCH_WINDOWS}")
+		if self.has_battery:
+			if not (0 < self.battery_charge_efficiency <= 1 and 0 < self.battery_discharge_efficiency <= 1):
+				raise Exception("battery efficiencies must be in ]0, 1]")
+			if not (0 <= self.battery_self_discharge < 1):
+				raise Exception("battery self discharge must be in [0, 1[")
+			if not (0 <= self.battery_soc_min < self.battery_soc_max <= 1):
+				raise Exception("battery soc bounds must verify 0 <= soc_min < soc_max <= 1")
+			if any([p is not None and p < 0 for p in [self.battery_max_charge_power, self.battery_max_discharge_power]]):
+				raise Exception("battery max powers must be positive")
 
 		if isinstance(self.consumer_curves, PowerData):
 			self.consumer_curves = [self.consumer_curves]
@@ -225,7 +391,12 @@ class SimParams():
 			raise Exception("consumer curves and their contributions MUST be the same length")
 		if self.has_flexibility is True and len(self.consumer_curves) != len(self.flexibility_ratio):
 			raise Exception("consumer curves and their flexibility ratio MUST be the same length")
+		if self.flexibility_shares is not None and len(self.consumer_curves) != len(self.flexibility_shares):
+			raise Exception("consumer curves and their flexibility shares MUST be the same length")
 		#gets all the curves to the sames date places
+		if self.time_step is not None:
+			self.resample_curves()
+		self.convert_curves()
 		curves_to_intersect = self.consumer_curves[:]
 		if (self.has_solar):
 			curves_to_intersect.append(self.solar_curve)
@@ -233,6 +404,9 @@ class SimParams():
 			curves_to_intersect.append(self.bioenergy_curve)
 		if (self.has_wind):
 			curves_to_intersect.append(self.wind_curve)
+		if all([c.dates is curves_to_intersect[0].dates for c in curves_to_intersect]):
+			#already aligned by a previous call
+			return
 		intersect = curves_to_intersect[0].get_multiple_intersect(curves_to_intersect)
 		for i in range(len(self.consumer_curves)):
 			self.consumer_curves[i] = self.consumer_curves[i].get_slice(intersect)
@@ -242,36 +416,244 @@ class SimParams():
 			self.bioenergy_curve = self.bioenergy_curve.get_slice(intersect)
 		if (self.has_wind):
 			self.wind_curve = self.wind_curve.get_slice(intersect)
+		#the aligned curves share a single list of dates, the next calls (one per simulated point) then return at once
+		#curves of disabled sources weren't sliced (and may be the caller's), they are left as they are
+		aligned = self.consumer_curves[:]
+		for (has_curve, curve) in [(self.has_solar, self.solar_curve), (self.has_bioenergy, self.bioenergy_curve), (self.has_wind, self.wind_curve)]:
+			if has_curve:
+				aligned.append(curve)
+		for curve in aligned:
+			curve.dates = intersect
 		
-@dataclass(init=True)
+	def convert_curves(self):
+		#stores every curve as dtype, curves already stored as dtype are kept (with their aligned dates)
+		dtype = get_power_dtype(self.dtype)
+		self.consumer_curves = [c.get_as_dtype(dtype) for c in self.consumer_curves]
+		for attribute in ["solar_curve", "wind_curve", "bioenergy_curve"]:
+			if getattr(self, attribute) is not None:
+				setattr(self, attribute, getattr(self, attribute).get_as_dtype(dtype))
+
+	def resample_curves(self):
+		#brings every curve to time_step (averaging power) on the common time range, gaps are interpolated
+		#so that sources with different resolutions don't lose dates to the intersection
+		curves = [c.resample(self.time_step, "mean", "interpolate") for c in self.consumer_curves]
+		if (self.has_solar):
+			curves.append(self.solar_curve.resample(self.time_step, "mean", "interpolate"))
+		if (self.has_bioenergy):
+			curves.append(self.bioenergy_curve.resample(self.time_step, "mean", "interpolate"))
+		if (self.has_wind):
+			curves.append(self.wind_curve.resample(self.time_step, "mean", "interpolate"))
+		beginning = max([c.dates[0]  for c in curves])
+		end       = min([c.dates[-1] for c in curves])
+		if end < beginning:
+			raise Exception("curves don't have any common period")
+		step = to_seconds(self.time_step)
+		axis_seconds = dates_to_seconds([beginning, end])
+		axis = seconds_to_dates(np.arange(axis_seconds[0], axis_seconds[1] + 1, step))
+		curves = [c.align_to(axis) for c in curves]
+		for i in range(len(self.consumer_curves)):
+			self.consumer_curves[i] = curves[i]
+		i = len(self.consumer_curves)
+		if (self.has_solar):
+			self.solar_curve = curves[i]
+			i += 1
+		if (self.has_bioenergy):
+			self.bioenergy_curve = curves[i]
+			i += 1
+		if (self.has_wind):
+			self.wind_curve = curves[i]
+#curves of a SimResults, in the order of get_curves
+SIM_RESULTS_CURVES = ["total_consumption", "production_before_batteries", "total_production", "imported_power", "exported_power", "battery", "flexibility_usage", "piloted_bioenergy"]
+
+def sim_results_curve(name : str) -> property:
+	return property(lambda self : self.get_curve(name), lambda self, curve : self.set_curve(name, curve))
+
 class SimResults():
-	total_consumption           : PowerData
-	production_before_batteries : PowerData
-	total_production            : PowerData
-	imported_power              : PowerData
-	exported_power              : PowerData
-	battery                     : Battery
-	flexibility_usage           : PowerData
+	#a simulation only keeps the consumption after flexibility, the production after batteries, the battery, the daily
+	#flexibility usage ratios and the piloted bioenergy (None without it, included in the production), the other curves
+	#are computed the first time they are read and kept :
+	#  production_before_batteries = total_production + battery (up to rounding)
+	#  imported_power, exported_power = positive part of consumption - production and of production - consumption
+	#  flexibility_usage = the ratios dated on the simulation dates, 1.0 everywhere without flexibility
+	#slices and rolling averages are just as lazy, each curve is transformed when it is read
+	#any curve can also be given as a keyword (as the fields of the former dataclass) or set
+	#with flexibility by consumer class, class_consumptions is the (classes, dates) matrix of the flexed consumption of
+	#every class (its rows sum to total_consumption) and class_flexibility_ratios the usage ratio of every (class, period),
+	#both None otherwise and neither sliced nor averaged with the curves
+	curves                   : Dict[str, PowerData]
+	computations             : Dict[str, Callable[[], PowerData]]
+	flexibility_ratios       : np.array
+	class_consumptions       : np.array
+	class_flexibility_ratios : np.array
+	def __init__(self, total_consumption : PowerData = None, total_production : PowerData = None, battery : Battery = None, flexibility_ratios : np.array = None, class_consumptions : np.array = None, class_flexibility_ratios : np.array = None, **curves : PowerData):
+		unknown = [name for name in curves if name not in SIM_RESULTS_CURVES]
+		if len(unknown) != 0:
+			raise Exception(f"unknown curves {unknown}, expected some of {SIM_RESULTS_CURVES}")
+		self.curves = {"total_consumption" : total_consumption, "total_production" : total_production, "battery" : battery, **curves}
+		self.computations = {
+			"production_before_batteries" : self.compute_production_before_batteries,
+			"imported_power"              : lambda : self.compute_exchange(self.total_consumption, self.total_production),
+			"exported_power"              : lambda : self.compute_exchange(self.total_production, self.total_consumption),
+			"flexibility_usage"           : self.compute_flexibility_usage,
+		}
+		self.flexibility_ratios = flexibility_ratios
+		self.class_consumptions = class_consumptions
+		self.class_flexibility_ratios = class_flexibility_ratios
+
+	total_consumption           = sim_results_curve("total_consumption")
+	production_before_batteries = sim_results_curve("production_before_batteries")
+	total_production            = sim_results_curve("total_production")
+	imported_power              = sim_results_curve("imported_power")
+	exported_power              = sim_results_curve("exported_power")
+	battery                     = sim_results_curve("battery")
+	flexibility_usage           = sim_results_curve("flexibility_usage")
+	piloted_bioenergy           = sim_results_curve("piloted_bioenergy")
+
+	def get_curve(self, name : str) -> Optional[PowerData]:
+		if name not in self.curves:
+			computation = self.computations.get(name)
+			self.curves[name] = computation() if computation is not None else None
+		return self.curves[name]
+
+	def set_curve(self, name : str, curve : Optional[PowerData]):
+		self.curves[name] = curve
+
+	def is_computed(self, name : str) -> bool:
+		return name in self.curves
+
+	def compute_production_before_batteries(self) -> Optional[PowerData]:
+		if self.total_production is None or self.battery is None or self.battery.capacity == 0:
+			return self.total_production
+		return self.total_production.get_lazy() + self.battery
+
+	def compute_exchange(self, source : PowerData, destination : PowerData) -> Optional[PowerData]:
+		#lazy, only evaluated as far as it is read
+		if source is None or destination is None:
+			return None
+		return (source.get_lazy() - destination).get_bigger_than(0.0)
+
+	def compute_flexibility_usage(self) -> Optional[PowerData]:
+		dates = self.total_consumption.dates if self.total_consumption is not None else None
+		if dates is None or len(dates) == 0:
+			return None
+		if self.flexibility_ratios is None:
+			return PowerData(dates, np.ones(len(dates)), copy_dates=False)
+		return get_flexibility_usage(dates, self.flexibility_ratios)
+
+	def get_class_consumption(self, index : int) -> PowerData:
+		#flexed consumption of one consumer class, a view of class_consumptions
+		if self.class_consumptions is None:
+			raise Exception("the consumers weren't flexed by class")
+		return PowerData(self.total_consumption.dates, self.class_consumptions[index], copy_dates=False)
+
+	def get_flexibility_use(self) -> float:
+		#average of flexibility_usage, without dating the ratios when the curve hasn't been read
+		if self.is_computed("flexibility_usage") or self.computations.get("flexibility_usage") != self.compute_flexibility_usage:
+			return self.flexibility_usage.get_average()
+		if self.flexibility_ratios is None:
+			return 1.0
+		#the dates of the ratios are distinct, get_average only skips the last one
+		return float(np.sum(self.flexibility_ratios[:-1], dtype=np.float64)) / (len(self.flexibility_ratios) - 1)
+
+	def get_transformed(self, transform : Callable[[PowerData], PowerData], kept : List[str] = []) -> SimResults:
+		#result whose curves are the transformed curves of this one, each computed when first read
+		#curves of kept are shared untransformed
+		result = SimResults()
+		result.curves = {}
+		def get_computation(name : str) -> Callable[[], PowerData]:
+			if name in kept:
+				return lambda : self.get_curve(name)
+			return lambda : transform(self.get_curve(name)) if self.get_curve(name) is not None else None
+		result.computations = {name : get_computation(name) for name in SIM_RESULTS_CURVES}
+		return result
+
 	def get_slice_over_period(self, begin : datetime, end : datetime) -> SimResults:
-		return SimResults(
-			total_consumption           = self.total_consumption          .get_slice_over_period(begin, end) if (self.total_consumption           != None) else None,
-			production_before_batteries = self.production_before_batteries.get_slice_over_period(begin, end) if (self.production_before_batteries != None) else None, 
-			total_production            = self.total_production           .get_slice_over_period(begin, end) if (self.total_production            != None) else None, 
-			imported_power              = self.imported_power             .get_slice_over_period(begin, end) if (self.imported_power              != None) else None, 
-			exported_power              = self.exported_power             .get_slice_over_period(begin, end) if (self.exported_power              != None) else None, 
-			battery                     = self.battery                    .get_slice_over_period(begin, end) if (self.battery                     != None) else None, 
-			flexibility_usage           = self.flexibility_usage          .get_slice_over_period(begin, end) if (self.flexibility_usage           != None) else None, 
-			)
-	def get_rolling_average(self, width : int) -> SimResults:
-		return SimResults(
-			total_consumption           = self.total_consumption          .get_rolling_average(width) if (self.total_consumption           != None) else None,
-			production_before_batteries = self.production_before_batteries.get_rolling_average(width) if (self.production_before_batteries != None) else None,
-			total_production            = self.total_production           .get_rolling_average(width) if (self.total_production            != None) else None,
-			imported_power              = self.imported_power             .get_rolling_average(width) if (self.imported_power              != None) else None,
-			exported_power              = self.exported_power             .get_rolling_average(width) if (self.exported_power              != None) else None,
-			battery                     = self.battery                    .get_rolling_average(width) if (self.battery                     != None) else None,
-			flexibility_usage           = self.flexibility_usage, #flexibility rolling average doesn't have any sense in this context
-			)
+		return self.get_transformed(lambda curve : curve.get_slice_over_period(begin, end))
+
+	def get_rolling_average(self, width : Union[int, timedelta]) -> SimResults:
+		#flexibility rolling average doesn't have any sense in this context
+		return self.get_transformed(lambda curve : curve.get_rolling_average(width), ["flexibility_usage"])
+
+	def get_rolling_stats(self, width : Union[int, timedelta], stats : List[str] = ["mean"], centered : bool = False) -> Dict[str, Dict[str, PowerData]]:
+		#stat name -> curve name -> rolling curve, every curve goes through the same window computation
+		curves = self.get_curves()
+		dates  = self.total_consumption.dates
+		rolled = rolling_stats(np.vstack([c.power for c in curves.values()]), dates, width, stats, centered)
+		return {stat : {name : PowerData(dates, rolled[stat][i]) for (i, name) in enumerate(curves.keys())} for stat in stats}
+	def get_curves(self) -> Dict[str, PowerData]:
+		#curves sharing the simulation time axis, the flexibility usage is daily and kept apart
+		curves = {
+			"total_consumption"           : self.total_consumption,
+			"production_before_batteries" : self.production_before_batteries,
+			"total_production"            : self.total_production,
+			"imported_power"              : self.imported_power,
+			"exported_power"              : self.exported_power,
+			"battery"                     : self.battery,
+			"piloted_bioenergy"           : self.piloted_bioenergy,
+		}
+		return {name : curve for (name, curve) in curves.items() if curve is not None}
+	def get_grouped_stats(self, grouping : str, percentiles : List[float] = [5, 95]) -> GroupedSimResults:
+		return GroupedSimResults.from_sim_results(self, grouping, percentiles)
+
+GROUPED_STATS = ["sum", "mean", "max"]
+
+@dataclass(init=True)
+class GroupedSimResults:
+	grouping    : str
+	groups      : List[str]
+	counts      : np.array
+	percentiles : List[float]
+	#curve name -> stat name -> one value per group
+	stats       : Dict[str, Dict[str, np.array]]
+	@classmethod
+	def from_sim_results(cls, result : SimResults, grouping : str, percentiles : List[float] = [5, 95]) -> GroupedSimResults:
+		curves = result.get_curves()
+		dates  = result.total_consumption.dates
+		labels = get_calendar_labels(dates, grouping)
+		#the dates are ordered once by group, every curve then gets reduced group by group
+		order  = np.argsort(labels, kind="stable")
+		sorted_labels = labels[order]
+		starts = np.concatenate(([0], np.nonzero(np.diff(sorted_labels))[0] + 1)) if len(labels) != 0 else np.array([], dtype=np.int64)
+		counts = np.diff(np.append(starts, len(labels)))
+		matrix = np.vstack([np.asarray(c.power, dtype=np.float64) for c in curves.values()])[:, order]
+		sums   = np.add.reduceat(matrix, starts, axis=1)
+		maxs   = np.maximum.reduceat(matrix, starts, axis=1)
+		stats  = {}
+		for (i, name) in enumerate(curves.keys()):
+			stats[name] = {"sum" : sums[i], "mean" : sums[i] / counts, "max" : maxs[i]}
+			#sorting by (group, value) gives every group's values in order, same convention as PowerData.get_percentile
+			by_value = matrix[i][np.lexsort((matrix[i], sorted_labels))]
+			for p in percentiles:
+				stats[name][f"p{p:g}"] = by_value[starts + (p * counts / 100).astype(np.int64).clip(0, counts - 1)]
+		return GroupedSimResults(
+			grouping    = grouping,
+			groups      = get_calendar_label_names(sorted_labels[starts], grouping),
+			counts      = counts,
+			percentiles = percentiles,
+			stats       = stats
+		)
+	def get_stat_names(self) -> List[str]:
+		return GROUPED_STATS + [f"p{p:g}" for p in self.percentiles]
+	def get_csv_titles(self) -> str:
+		result = self.grouping + ";" + "count"
+		for name in self.stats.keys():
+			for stat in self.get_stat_names():
+				result += ";" + f"{name} {stat} (W/house)"
+		return result
+	def to_csv_string(self) -> str:
+		#one line per group
+		lines = []
+		for g in range(len(self.groups)):
+			result = self.groups[g] + ";" + str(self.counts[g])
+			for name in self.stats.keys():
+				for stat in self.get_stat_names():
+					result += ";" + str(self.stats[name][stat][g])
+			lines.append(result)
+		return "\n".join(lines)
+	def to_csv(self, path : str):
+		with open(path, "w") as out_file:
+			print(self.get_csv_titles(), file=out_file)
+			print(self.to_csv_string(), file=out_file)
 
 def simulate_flexibility(prod : PowerData, cons : PowerData, flex_ratio : float) -> Tuple[PowerData, PowerData]:
 	day_indices = []
@@ -328,57 +710,153 @@ def simulate_flexibility(prod : PowerData, cons : PowerData, flex_ratio : float)
 		day_indices.append(i)
 	return (prod,cons)
 
-def simulate_flexibility_c(prod : PowerData, cons : PowerData, flex_ratio: float, deltatime : float):
-	prod = prod.get_copy()
-	cons = cons.get_copy()
-	prod_timestamps = prod.get_dates_as_timestamps()
-	flex_usage = np.array([0.0] * ceil((prod_timestamps[-1] - prod_timestamps[0]) / deltatime), dtype=np.float64)
+def get_flexibility_usage(dates : List[datetime], ratios : np.array) -> PowerData:
+	#daily usage ratios of simulate_flexibility_ratios, each dated at the simulation date of its rank
+	return PowerData([dates[int(i * len(dates)/len(ratios))] for i in range(len(ratios))], ratios)
+
+def simulate_flexibility_c(prod : PowerData, cons : PowerData, flex_ratio: float, deltatime : float, out : Tuple[np.array, np.array] = None, timestamps : np.array = None, work : Tuple[np.array, np.array] = None) -> Tuple[PowerData, PowerData, PowerData]:
+	(prod, cons, ratios) = simulate_flexibility_ratios(prod, cons, flex_ratio, deltatime, out, timestamps, work)
+	return (prod, cons, get_flexibility_usage(prod.dates, ratios))
+
+def simulate_flexibility_ratios(prod : PowerData, cons : PowerData, flex_ratio: float, deltatime : float, out : Tuple[np.array, np.array] = None, timestamps : np.array = None, work : Tuple[np.array, np.array] = None) -> Tuple[PowerData, PowerData, np.array]:
+	#same as simulate_flexibility_c, with the undated usage ratio of every period
+	#out is an optional (production, consumption) pair of buffers for the flexed curves, they can be the powers of prod and cons
+	#timestamps are the ones of prod.get_dates_as_timestamps, if already known
+	#the kernel only works in float64, float32 curves are flexed in work, an optional pair of float64 buffers of their length
+	prod = prod.get_copy(out[0] if out is not None else None)
+	cons = cons.get_copy(out[1] if out is not None else None)
+	(prod_power, cons_power) = (prod.power, cons.power)
+	if prod_power.dtype != np.float64 or cons_power.dtype != np.float64:
+		work = work if work is not None else (np.empty(len(prod_power)), np.empty(len(cons_power)))
+		np.copyto(work[0], prod_power)
+		np.copyto(work[1], cons_power)
+		(prod_power, cons_power) = work
+	prod_timestamps = timestamps if timestamps is not None else prod.get_dates_as_timestamps()
+	flex_usage = np.zeros(ceil((prod_timestamps[-1] - prod_timestamps[0]) / deltatime))
 	libsim.sim_flex(
-	prod.power.ctypes.data_as(POINTER(c_double)),
-	cons.power.ctypes.data_as(POINTER(c_double)),
+	prod_power.ctypes.data_as(POINTER(c_double)),
+	cons_power.ctypes.data_as(POINTER(c_double)),
 	prod_timestamps.ctypes.data_as(POINTER(c_double)),
 	len(prod.power),
 	c_double(deltatime),
 	c_double(flex_ratio),
 	flex_usage.ctypes.data_as(POINTER(c_double))
 	)
-	return (prod, cons, PowerData([prod.dates[int(i * len(prod.dates)/len(flex_usage))] for i in range(len(flex_usage))] ,flex_usage))
-	pass
+	if cons_power is not cons.power:
+		#production is only read by the kernel
+		np.copyto(cons.power, cons_power)
+	return (prod, cons, flex_usage)
 
-def simulate_senario(params: SimParams) -> SimResults:
+def simulate_class_flexibility(prod : PowerData, consumptions : np.array, flex_ratios : List[float], deltatime : float, out : np.array = None, timestamps : np.array = None, work : Tuple[np.array, np.array] = None) -> Tuple[PowerData, np.array, np.array]:
+	#flexibility of consumer classes having their own ratio, in a single kernel call : consumptions is the (classes, dates)
+	#float64 matrix of SimParams.get_consumers_matrix, every row is flexed in place into the shifted curve of its class
+	#returns the flexed total consumption (in out when given), the usage ratio of every period and of every (class, period)
+	#timestamps are the ones of prod.get_dates_as_timestamps, if already known
+	#the kernel only works in float64, work is an optional pair of float64 buffers for the production and the total
+	#when prod or out are float32
+	if consumptions.dtype != np.float64 or not consumptions.flags["C_CONTIGUOUS"]:
+		raise Exception("class consumptions must be a contiguous float64 matrix")
+	(class_count, count) = consumptions.shape
+	if class_count != len(flex_ratios):
+		raise Exception(f"{class_count} consumer classes but {len(flex_ratios)} flexibility ratios")
+	total = out if out is not None else np.empty(count)
+	(prod_power, total_power) = (prod.power, total)
+	if prod_power.dtype != np.float64 or total_power.dtype != np.float64:
+		(prod_power, total_power) = work if work is not None else (np.empty(count), np.empty(count))
+		np.copyto(prod_power, prod.power)
+	ratios = np.asarray(flex_ratios, dtype=np.float64)
+	prod_timestamps = timestamps if timestamps is not None else prod.get_dates_as_timestamps()
+	periods = ceil((prod_timestamps[-1] - prod_timestamps[0]) / deltatime)
+	flex_usage = np.zeros(periods)
+	class_usage = np.zeros((class_count, periods))
+	#the kernel never takes more from a class than it consumes, a class it leaves negative is an error
+	negative = bool((consumptions < 0.0).any())
+	libsim.sim_flex_classes(
+	prod_power.ctypes.data_as(POINTER(c_double)),
+	consumptions.ctypes.data_as(POINTER(c_double)),
+	c_size_t(class_count),
+	prod_timestamps.ctypes.data_as(POINTER(c_double)),
+	c_size_t(count),
+	c_double(deltatime),
+	ratios.ctypes.data_as(POINTER(c_double)),
+	total_power.ctypes.data_as(POINTER(c_double)),
+	flex_usage.ctypes.data_as(POINTER(c_double)),
+	c_size_t(periods),
+	class_usage.ctypes.data_as(POINTER(c_double))
+	)
+	if not negative and (consumptions < 0.0).any():
+		raise Exception("the flexibility of the consumer classes made a consumption negative")
+	if total_power is not total:
+		np.copyto(total, total_power)
+	return (PowerData(prod.dates, total, copy_dates=False), flex_usage, class_usage)
+
+def simulate_senario(params: SimParams, arena : ScratchArena = None) -> SimResults:
+	#every curve of the results is in the buffers of arena when given, they are only valid until its next use
+	#(so are the derived curves of the results, computed from them when read)
 	total_consumption : PowerData = None #batteries are in reciever convention but are considered a "producer"
 	battery : Battery = None
-	total_consumption = params.get_consumers_agglomerated_curves()
+	consumers : np.array = None
+	with stage("consumption"):
+		if params.has_class_flexibility():
+			#the total consumption is summed by the flexibility kernel, every class being flexed with its own ratio
+			(_, consumers) = params.get_consumers_matrix(arena)
+		else:
+			total_consumption = params.get_consumers_agglomerated_curves(arena)
 	production : PowerData = None
-	if params.has_wind:
-		production = params.get_wind_curve() + production
-	if params.has_solar:
-		production = params.get_solar_curve() + production
-	if params.has_bioenergy:
-		production = params.get_constant_bioenergy_curve() + production
-	production_before_flexibility = production.get_copy()
-	diff_before_flexibility = (production - total_consumption)
+	with stage("production"):
+		#the curves are new arrays (or buffers of the arena), production is summed in place in the first one
+		for (has_curve, get_curve) in [(params.has_wind, params.get_wind_curve), (params.has_solar, params.get_solar_curve), (params.has_bioenergy, params.get_constant_bioenergy_curve)]:
+			if has_curve:
+				curve = get_curve(arena)
+				if production is None:
+					production = curve
+				else:
+					production += curve
 
 	
-	flex_usage = PowerData(params.bioenergy_curve.dates[:], np.array([1.0] * len(params.bioenergy_curve.dates[:])))
-	if (params.has_flexibility):
-		(production, total_consumption, flex_usage) = simulate_flexibility_c(production, total_consumption, params.flexibility_ratio[0], float(24*3600))
-	production_before_batteries = production.get_copy()
-	diff_before_batteries = (production - total_consumption)
-	if params.has_battery:
-		battery = Battery(params.battery_capacity)
-		battery.from_power_data(diff_before_batteries)
-		production = production - battery
-	exported_power = (production - total_consumption).get_bigger_than(0.0)
-	imported_power = (total_consumption - production).get_bigger_than(0.0)
+	with stage("flexibility"):
+		if consumers is not None:
+			timestamps = get_cached(arena, "timestamps", production.dates, production.get_dates_as_timestamps)
+			(count, dtype) = (len(production.dates), production.power.dtype)
+			work = None
+			if arena is not None and dtype != np.float64:
+				work = (arena.get("flex production", count), arena.get("flex consumption", count))
+			out = arena.get("consumption", count, dtype) if arena is not None else np.empty(count, dtype=dtype)
+			(total_consumption, flex_usage, class_usage) = simulate_class_flexibility(production, consumers, params.flexibility_ratio, float(24*3600), out, timestamps, work)
+		elif (params.has_flexibility):
+			#production and consumption are only used here, they are flexed in place
+			timestamps = get_cached(arena, "timestamps", production.dates, production.get_dates_as_timestamps)
+			work = None
+			if arena is not None and production.power.dtype != np.float64:
+				work = (arena.get("flex production", len(production.dates)), arena.get("flex consumption", len(production.dates)))
+			(production, total_consumption, flex_usage) = simulate_flexibility_ratios(production, total_consumption, params.flexibility_ratio[0], float(24*3600), (production.power, total_consumption.power), timestamps, work)
+		else:
+			flex_usage = None
+		if consumers is None:
+			class_usage = None
+	piloted : PowerData = None
+	with stage("piloted_bioenergy"):
+		#a source without power (the default point of a sweep) is skipped
+		if params.has_piloted_bioenergy and params.piloted_bioenergy_power != 0:
+			piloted = params.get_piloted_bioenergy_curve(production, total_consumption, arena)
+			production += piloted
+	with stage("battery"):
+		count = len(production.dates)
+		dtype = production.power.dtype
+		diff_before_batteries = (production.get_lazy() - total_consumption)
+		if params.has_battery:
+			battery = params.get_battery()
+			seconds = get_cached(arena, "seconds", production.dates, lambda : dates_to_seconds(production.dates).astype(np.float64))
+			battery.from_power_data(diff_before_batteries, get_buffer(arena, "battery", count, dtype), get_buffer(arena, "battery energy", count), seconds)
+			production -= battery
 	return SimResults(\
-			total_consumption = total_consumption,\
-			production_before_batteries = production_before_batteries,\
-			total_production=production,\
-			exported_power=exported_power,\
-			imported_power=imported_power,\
-			battery=battery,\
-			flexibility_usage=flex_usage
+			total_consumption  = total_consumption,\
+			total_production   = production,\
+			battery            = battery,\
+			flexibility_ratios = flex_usage,\
+			class_consumptions = consumers,\
+			class_flexibility_ratios = class_usage,\
+			piloted_bioenergy  = piloted
 		)
 @dataclass(init=True)
 class AgglomeratedSimResults:
@@ -399,26 +877,43 @@ class AgglomeratedSimResults:
 	autoconso       : float
 	autoprod        : float
 	@classmethod
-	def from_sim_results (cls, result : SimResults) -> AgglomeratedSimResults:
+	def from_sim_results (cls, result : SimResults, arena : ScratchArena = None) -> AgglomeratedSimResults:
+		#every sum comes from a single native pass, averages skip the last point like PowerData.get_average
+		#percentiles are computed in a buffer of arena when given instead of partitioned copies
+		battery = result.battery.power if result.battery != None and result.battery.capacity != 0 else None
+		with stage("kpi_sums"):
+			sums = kpi_sums(result.total_production.power, result.total_consumption.power, battery)
+		with stage("kpi_percentiles"):
+			scratch = get_buffer(arena, "percentile", len(result.total_consumption.dates), result.total_consumption.power.dtype)
+			percentiles = (
+				result.total_consumption.get_percentile(5, scratch),
+				result.total_consumption.get_percentile(95, scratch),
+				result.imported_power.get_percentile(5, scratch),
+				result.imported_power.get_percentile(95, scratch),
+				result.get_flexibility_use()
+			)
+		count = len(result.total_consumption.power)
+		average_count = count - 1
 		return AgglomeratedSimResults(
-			storage_use     = (result.battery.get_bigger_than(0.0).get_average() / result.battery.capacity if result.battery != None and result.battery.capacity != 0 else 1),
-			imported_power  = result.imported_power.get_average(),
-			exported_power  = result.exported_power.get_average(),
-			imported_time   = (result.imported_power.count_greater_than(0.0) / len(result.imported_power.power)),
-			exported_time   = (result.exported_power.count_greater_than(0.0) / len(result.exported_power.power)),
-			low_conso_peak  = (result.total_consumption.get_percentile(5)),
-			high_conso_peak = (result.total_consumption.get_percentile(95)),
-			low_import_peak = (result.imported_power.get_percentile(5)),
-			high_import_peak= (result.imported_power.get_percentile(95)),
-			flexibility_use = (result.flexibility_usage.get_average()),
-			export_max      = (result.exported_power.power.max()),
-			import_max      = (result.imported_power.power.max()),
-			coverage        = (result.total_production.get_average() / result.total_consumption.get_average()),
-			coverage_avg    = (result.total_production / result.total_consumption).get_average(),
-			autoconso       = ((result.total_production - result.exported_power).get_average() / result.total_production.get_average()),
-			autoprod        = ((result.total_consumption - result.imported_power).get_average() / result.total_consumption.get_average())
+			storage_use     = (sums[KPI_BATTERY_CHARGE_SUM] / average_count / result.battery.capacity if battery is not None else 1),
+			imported_power  = sums[KPI_IMPORTED_SUM] / average_count,
+			exported_power  = sums[KPI_EXPORTED_SUM] / average_count,
+			imported_time   = sums[KPI_IMPORTED_COUNT] / count,
+			exported_time   = sums[KPI_EXPORTED_COUNT] / count,
+			low_conso_peak  = percentiles[0],
+			high_conso_peak = percentiles[1],
+			low_import_peak = percentiles[2],
+			high_import_peak= percentiles[3],
+			flexibility_use = percentiles[4],
+			export_max      = sums[KPI_EXPORTED_MAX],
+			import_max      = sums[KPI_IMPORTED_MAX],
+			coverage        = sums[KPI_PRODUCTION_SUM] / sums[KPI_CONSUMPTION_SUM],
+			coverage_avg    = sums[KPI_COVERAGE_SUM] / average_count,
+			autoconso       = sums[KPI_SELF_CONSUMED_SUM] / sums[KPI_PRODUCTION_SUM],
+			autoprod        = sums[KPI_SELF_PRODUCED_SUM] / sums[KPI_CONSUMPTION_SUM]
 		)
-	def get_csv_titles(self) -> str:
+	@staticmethod
+	def get_csv_titles() -> str:
 			result = ""
 			result += "storage use (ratio)" + ";"
 			result += "imported power (W/house)" + ";"
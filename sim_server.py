@@ -0,0 +1,212 @@
+from __future__ import annotations
+from typing import *
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from datetime import datetime
+from sys import argv
+import asyncio
+import json
+import os
+import socket
+import stat
+import threading
+if len(__name__.split("."))==1:
+	from sim import SimParams, AgglomeratedSimResults
+	from arena import ScratchArena
+	from sweep import simulate_point
+	from sizing import get_base_point
+	from scenario_base import load_scenario_base, get_consumer_powers
+else:
+	from .sim import SimParams, AgglomeratedSimResults
+	from .arena import ScratchArena
+	from .sweep import simulate_point
+	from .sizing import get_base_point
+	from .scenario_base import load_scenario_base, get_consumer_powers
+
+#the server and its clients exchange one json object per line over a unix domain socket,
+#the "id" of a request, if any, is sent back with its answer :
+#  {"type" : "scenario", "point" : {}}     -> {"type" : "result", "results" : [{"wind_to_sim" : ..., "agglomerated" : {}}]}
+#  {"type" : "batch", "points" : [{}, ...]} -> same, one result per point in the same order
+#  {"type" : "info"}                        -> {"type" : "info", "base" : {}, "begin" : iso date, "end" : iso date, "simulations" : n}
+#  {"type" : "shutdown"}                    -> {"type" : "ok"}, then the server stops
+#  any failing request                      -> {"type" : "error", "message" : ""}
+#points only need the keys that change, the others are taken from the base point of the server params
+#requests of a connection are handled concurrently, so answers may come back out of order
+DEFAULT_SOCKET_PATH = "/tmp/predimensionnement.sock"
+MAX_LINE_SIZE = 1 << 26
+
+def result_to_message(result : Dict[str, Any]) -> Dict[str, Any]:
+	return {**result, "agglomerated" : {k : float(v) for (k, v) in asdict(result["agglomerated"]).items()}}
+
+def message_to_result(message : Dict[str, Any]) -> Dict[str, Any]:
+	#same dict as the ones returned by sweep.simulate_point
+	return {**message, "agglomerated" : AgglomeratedSimResults(**message["agglomerated"])}
+
+class SimServer():
+	#keeps the loaded and aligned curves in memory and simulates the requested scenarios in a thread pool
+	sim_params   : SimParams
+	path         : str
+	thread_count : int
+	base         : Dict[str, float]
+	def __init__(self, sim_params : SimParams, path : str = DEFAULT_SOCKET_PATH, thread_count : int = 4):
+		self.sim_params   = sim_params
+		self.path         = path
+		self.thread_count = thread_count
+		self.base         = get_base_point(sim_params)
+		self.local        = threading.local()
+		self.executor     = None
+		self.stopped      = None
+		self.connections  = {}
+		self.simulations  = 0
+
+	def simulate(self, point : Dict[str, float]) -> Dict[str, Any]:
+		#runs in the pool, every thread gets a clone sharing the curves
+		if not hasattr(self.local, "sim_params"):
+			self.local.sim_params = self.sim_params.get_shared_clone()
+			self.local.arena = ScratchArena()
+		return result_to_message(simulate_point(self.local.sim_params, point, self.local.arena))
+
+	def get_point(self, point : Dict[str, Any]) -> Dict[str, float]:
+		unknown = [k for k in point if k not in self.base]
+		if len(unknown) != 0:
+			raise Exception(f"unknown point keys {unknown}, expected some of {list(self.base.keys())}")
+		return {**self.base, **{k : float(v) for (k, v) in point.items()}}
+
+	async def simulate_points(self, points : List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+		loop = asyncio.get_running_loop()
+		points = [self.get_point(p) for p in points]
+		results = await asyncio.gather(*[loop.run_in_executor(self.executor, self.simulate, p) for p in points])
+		self.simulations += len(results)
+		return results
+
+	async def handle(self, request : Dict[str, Any]) -> Dict[str, Any]:
+		if request["type"] == "scenario":
+			return {"type" : "result", "results" : await self.simulate_points([request.get("point", {})])}
+		if request["type"] == "batch":
+			return {"type" : "result", "results" : await self.simulate_points(request["points"])}
+		if request["type"] == "info":
+			return {
+				"type"        : "info",
+				"base"        : self.base,
+				"begin"       : self.sim_params.begin.isoformat(),
+				"end"         : self.sim_params.end.isoformat(),
+				"simulations" : self.simulations,
+			}
+		if request["type"] == "shutdown":
+			#the server stops once the answer has been sent
+			return {"type" : "ok"}
+		raise Exception(f"unknown request {request['type']}")
+
+	async def handle_connection(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+		tasks = set()
+		write_lock = asyncio.Lock()
+		self.connections[asyncio.current_task()] = writer
+		async def answer(line : bytes):
+			request = {}
+			try:
+				request = json.loads(line)
+				message = await self.handle(request)
+			except Exception as e:
+				message = {"type" : "error", "message" : str(e)}
+			if isinstance(request, dict) and "id" in request:
+				message["id"] = request["id"]
+			async with write_lock:
+				writer.write((json.dumps(message) + "\n").encode())
+				await writer.drain()
+			if isinstance(request, dict) and request.get("type") == "shutdown":
+				self.stopped.set()
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				task = asyncio.ensure_future(answer(line))
+				tasks.add(task)
+				task.add_done_callback(tasks.discard)
+			#requests sent before the client closed its side are still answered
+			await asyncio.gather(*tasks)
+		except ConnectionError:
+			pass
+		finally:
+			del self.connections[asyncio.current_task()]
+			writer.close()
+
+	async def serve_async(self):
+		if os.path.exists(self.path):
+			#a socket left by a server that was killed, anything else is not ours to remove
+			if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+				raise Exception(f"{self.path} exists and is not a socket")
+			os.remove(self.path)
+		self.stopped = asyncio.Event()
+		with ThreadPoolExecutor(self.thread_count) as self.executor:
+			server = await asyncio.start_unix_server(self.handle_connection, self.path, limit=MAX_LINE_SIZE)
+			await self.stopped.wait()
+			server.close()
+			#connections still open see the end of their stream and finish the requests they already read
+			for writer in list(self.connections.values()):
+				writer.close()
+			await asyncio.gather(*self.connections.keys())
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	def serve(self):
+		#blocks until a shutdown request
+		asyncio.run(self.serve_async())
+
+class SimClient():
+	#blocking client, one request at a time
+	path : str
+	def __init__(self, path : str = DEFAULT_SOCKET_PATH, timeout : float = None):
+		self.path = path
+		self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.connection.settimeout(timeout)
+		self.connection.connect(path)
+		self.stream = self.connection.makefile("rwb")
+		self.next_id = 0
+
+	def request(self, message : Dict[str, Any]) -> Dict[str, Any]:
+		message = {**message, "id" : self.next_id}
+		self.next_id += 1
+		self.stream.write((json.dumps(message) + "\n").encode())
+		self.stream.flush()
+		line = self.stream.readline()
+		if not line:
+			raise Exception("the server closed the connection")
+		answer = json.loads(line)
+		if answer["type"] == "error":
+			raise Exception(answer["message"])
+		return answer
+
+	def simulate(self, point : Dict[str, float] = None, **values : float) -> Dict[str, Any]:
+		#client.simulate(battery_to_sim=100) changes the battery of the base point
+		results = self.request({"type" : "scenario", "point" : {**(point if point is not None else {}), **values}})["results"]
+		return message_to_result(results[0])
+
+	def simulate_batch(self, points : List[Dict[str, float]]) -> List[Dict[str, Any]]:
+		#can be given as the evaluate function of SizingSolver or AdaptiveSweep
+		return [message_to_result(r) for r in self.request({"type" : "batch", "points" : points})["results"]]
+
+	def get_info(self) -> Dict[str, Any]:
+		return self.request({"type" : "info"})
+
+	def shutdown(self):
+		self.request({"type" : "shutdown"})
+
+	def close(self):
+		self.stream.close()
+		self.connection.close()
+
+	def __enter__(self) -> SimClient:
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+if __name__ == "__main__":
+	path = argv[1] if len(argv) > 1 else DEFAULT_SOCKET_PATH
+	thread_count = int(argv[2]) if len(argv) > 2 else 4
+	sim_params = load_scenario_base(get_consumer_powers(),
+		datetime.strptime("01/01/2021 00:00","%d/%m/%Y %H:%M"),
+		datetime.strptime("01/01/2022 00:00","%d/%m/%Y %H:%M"))
+	print("serving on", path, "with", thread_count, "threads")
+	SimServer(sim_params, path, thread_count).serve()
@@ -0,0 +1,113 @@
+from __future__ import annotations
+from typing import *
+from dataclasses import dataclass, field
+if len(__name__.split("."))==1:
+	from sim import *
+	from sweep import AXIS_KEYS, simulate_point
+else:
+	from .sim import *
+	from .sweep import AXIS_KEYS, simulate_point
+
+@dataclass(init=True)
+class SizingResult:
+	axis        : str
+	kpi         : str
+	target      : float
+	value       : float #smallest value found meeting the target, None if the target can't be reached
+	kpi_value   : float
+	simulations : int
+	converged   : bool
+	history     : List[Tuple[float, float]] = field(default_factory=list) #(value, kpi) in simulation order
+
+def get_base_point(sim_params : SimParams) -> Dict[str, float]:
+	return {
+		"wind_to_sim"    : float(sim_params.wind_power),
+		"sun_to_sim"     : float(sim_params.solar_power),
+		"bio_to_sim"     : float(sim_params.bioenergy_power),
+		"battery_to_sim" : float(sim_params.battery_capacity),
+		"flex_to_sim"    : float(sim_params.get_flexibility_ratio()),
+		"piloted_to_sim" : float(sim_params.piloted_bioenergy_power),
+	}
+
+class SizingSolver():
+	#finds the smallest value of one sweep axis (battery, flex, wind, sun, bio or piloted) for which a kpi of
+	#AgglomeratedSimResults reaches target, the kpi is assumed monotonic in the searched interval
+	#evaluate simulates a list of points, it can be a pool.map to simulate a batch in parallel
+	sim_params : SimParams
+	evaluate   : Callable[[List[Dict[str, float]]], List[Dict[str, Any]]]
+	def __init__(self, sim_params : SimParams, evaluate : Callable[[List[Dict[str, float]]], List[Dict[str, Any]]] = None, batch_size : int = 1):
+		self.sim_params = sim_params
+		self.evaluate   = evaluate if evaluate is not None else self.simulate_points
+		self.batch_size = batch_size
+
+	def simulate_points(self, points : List[Dict[str, float]]) -> List[Dict[str, Any]]:
+		#simulate_point sets the point on the params it is given, the clone keeps the base point of the next solves
+		sim_params = self.sim_params.get_shared_clone()
+		return [simulate_point(sim_params, p) for p in points]
+
+	def solve(self, axis : str, kpi : str, target : float, low : float, high : float, tolerance : float = 1e-3, max_simulations : int = 20, max_expansions : int = 4, kpi_tolerance : float = 0.0) -> SizingResult:
+		#tolerance is relative to the initial interval width, the search also stops once the kpi is within kpi_tolerance of target
+		if axis not in AXIS_KEYS:
+			raise Exception(f"unknown axis {axis}, expected one of {list(AXIS_KEYS.keys())}")
+		base = get_base_point(self.sim_params)
+		(low, high) = (float(low), float(high))
+		history : List[Tuple[float, float]] = []
+		def run(values : List[float]) -> List[float]:
+			results = self.evaluate([{**base, AXIS_KEYS[axis] : float(v)} for v in values])
+			kpis = [getattr(r["agglomerated"], kpi) for r in results]
+			history.extend(zip(values, kpis))
+			return kpis
+		def result(value : float, kpi_value : float, converged : bool) -> SizingResult:
+			return SizingResult(axis, kpi, target, value, kpi_value, len(history), converged, history)
+
+		(f_low, f_high) = run([low, high])
+		#the kpi may grow (autoprod, coverage...) or decrease (imported power...) with the axis
+		increasing = f_high >= f_low
+		def reached(f : float) -> bool:
+			return f >= target if increasing else f <= target
+		if reached(f_low):
+			return result(low, f_low, True)
+		expansions = 0
+		while not reached(f_high):
+			if expansions >= max_expansions or len(history) >= max_simulations:
+				return result(None, f_high, False)
+			#the bracket is moved up, the old high is a valid lower bound
+			(low, f_low) = (high, f_high)
+			high = high * 2 if high > 0 else 1.0
+			f_high = run([high])[0]
+			expansions += 1
+		width = (high - low) * tolerance
+		(g_low, g_high) = (f_low - target, f_high - target)
+		last_moved = None
+		while high - low > width and len(history) < max_simulations:
+			if abs(f_high - target) <= kpi_tolerance:
+				return result(high, f_high, True)
+			if self.batch_size > 1:
+				#k-section : batch_size points evenly spread in the bracket, simulated together
+				values = [low + (high - low) * (i + 1) / (self.batch_size + 1) for i in range(self.batch_size)]
+				kpis = run(values)
+				for (v, f) in zip(values, kpis):
+					if reached(f):
+						(high, f_high) = (v, f)
+						break
+					(low, f_low) = (v, f)
+				(g_low, g_high) = (f_low - target, f_high - target)
+				continue
+			#regula falsi with the illinois modification, falls back to bisection when the secant leaves the bracket
+			value = (low + high) / 2
+			if g_high != g_low:
+				value = high - g_high * (high - low) / (g_high - g_low)
+			if not (low + width / 2 < value < high - width / 2):
+				value = (low + high) / 2
+			f = run([value])[0]
+			if reached(f):
+				(high, f_high, g_high) = (value, f, f - target)
+				if last_moved == "high":
+					g_low /= 2
+				last_moved = "high"
+			else:
+				(low, f_low, g_low) = (value, f, f - target)
+				if last_moved == "low":
+					g_high /= 2
+				last_moved = "low"
+		return result(high, f_high, high - low <= width)
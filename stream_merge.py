@@ -0,0 +1,80 @@
+from __future__ import annotations
+from typing import *
+from datetime import datetime, timedelta
+import heapq
+
+DatedValue = Tuple[datetime, float]
+
+def parse_enedis_date(date : str, utc : bool = False) -> datetime:
+	#expecting yyyy-mm-ddThh:mm+hh:mm, the offset is only removed when utc is True
+	parsed = datetime.strptime(date[:16], "%Y-%m-%dT%H:%M")
+	if utc:
+		parsed -= timedelta(hours = int(date.split("+")[1][:2]))
+	return parsed
+
+def read_dated_values(path : str, date_index : int = 0, value_index : int = 1, date_parser : Callable[[str], datetime] = parse_enedis_date, separator : str = ";", skip_header : bool = False) -> Iterator[DatedValue]:
+	#reads the file lazily, one (date, value) at a time
+	with open(path) as inp:
+		for line in inp:
+			if skip_header:
+				skip_header = False
+				continue
+			if line.strip() == '':
+				continue
+			splitted_line = line.split(separator)
+			value = splitted_line[value_index].strip()
+			yield (date_parser(splitted_line[date_index]), float(value) if value != '' else 0.0)
+
+def hourly_buckets(rows : Iterable[DatedValue]) -> Iterator[DatedValue]:
+	#sums consecutive rows falling in the same hour, rows are expected in growing order
+	current_hour  : datetime = None
+	current_value : float    = 0.0
+	for (date, value) in rows:
+		hour = date.replace(minute = 0, second = 0, microsecond = 0)
+		if current_hour is not None and hour < current_hour:
+			raise Exception(f"rows should be sorted by date, got {date} after {current_hour}")
+		if hour != current_hour:
+			if current_hour is not None:
+				yield (current_hour, current_value)
+			current_hour  = hour
+			current_value = 0.0
+		current_value += value
+	if current_hour is not None:
+		yield (current_hour, current_value)
+
+def merge_sorted_sources(sources : List[Iterable[DatedValue]], intersect : bool = True) -> Iterator[Tuple[datetime, List[float]]]:
+	#k-way merge of date sorted sources, only one pending row per source is kept in memory
+	#when intersect is True, a date is only yielded if every source has it, otherwise missing values are 0.0
+	iterators = [iter(source) for source in sources]
+	heap : List[Tuple[datetime, int, float]] = []
+	def push_next(index : int, previous : datetime = None):
+		row = next(iterators[index], None)
+		if row is None:
+			return
+		if previous is not None and row[0] <= previous:
+			raise Exception(f"source {index} is not strictly sorted by date ({row[0]} after {previous})")
+		heapq.heappush(heap, (row[0], index, row[1]))
+	for i in range(len(iterators)):
+		push_next(i)
+	while len(heap) != 0:
+		if intersect and len(heap) < len(iterators):
+			#one of the sources is exhausted, no other date can be common to all of them
+			return
+		date = heap[0][0]
+		values  = [0.0] * len(iterators)
+		present = 0
+		while len(heap) != 0 and heap[0][0] == date:
+			(_, index, value) = heapq.heappop(heap)
+			values[index] = value
+			present += 1
+			push_next(index, date)
+		if present == len(iterators) or not intersect:
+			yield (date, values)
+
+def merge_summed(sources : List[Iterable[DatedValue]], intersect : bool = True) -> Iterator[DatedValue]:
+	for (date, values) in merge_sorted_sources(sources, intersect):
+		yield (date, sum(values))
+
+def merge_files_hourly(paths : List[str], date_parser : Callable[[str], datetime] = parse_enedis_date, intersect : bool = True, **kwargs) -> Iterator[DatedValue]:
+	#streams every file, buckets it by hour and sums the common hours
+	return merge_summed([hourly_buckets(read_dated_values(path, date_parser = date_parser, **kwargs)) for path in paths], intersect)
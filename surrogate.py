@@ -0,0 +1,153 @@
+from __future__ import annotations
+from typing import *
+import numpy as np
+if len(__name__.split("."))==1:
+	from sweep import read_results, results_to_matrix, get_result_columns, AXES, AXIS_KEYS
+else:
+	from .sweep import read_results, results_to_matrix, get_result_columns, AXES, AXIS_KEYS
+
+INPUT_COLUMNS = [AXIS_KEYS[axis] for axis in AXES]
+RBF_MAX_POINTS = 3000 #above this, scattered points use the nearest neighbours instead of the rbf
+NEIGHBOURS = 8
+
+class GridInterpolator():
+	#multilinear interpolation on a full cartesian grid, axes with a single value are ignored
+	axes   : List[np.array]
+	values : np.array #shape (n1, ..., nd, outputs)
+	def __init__(self, axes : List[np.array], values : np.array):
+		self.axes   = axes
+		self.values = values
+		self.active = [i for i in range(len(axes)) if len(axes[i]) > 1]
+
+	@classmethod
+	def from_points(cls, inputs : np.array, outputs : np.array) -> Optional[GridInterpolator]:
+		#None if the points don't make a full grid
+		axes = [np.unique(inputs[:, i]) for i in range(inputs.shape[1])]
+		shape = tuple([len(a) for a in axes])
+		if int(np.prod(shape)) != len(inputs):
+			return None
+		indices = tuple([np.searchsorted(axes[i], inputs[:, i]) for i in range(inputs.shape[1])])
+		filled = np.zeros(shape, dtype=bool)
+		filled[indices] = True
+		if not filled.all():
+			return None
+		values = np.empty(shape + (outputs.shape[1],))
+		values[indices] = outputs
+		return GridInterpolator(axes, values)
+
+	def __call__(self, queries : np.array) -> np.array:
+		queries = np.atleast_2d(queries)
+		low     = [np.zeros(len(queries), dtype=np.int64)] * len(self.axes)
+		weights = {}
+		for i in self.active:
+			#index of the cell and position in it, queries outside of the grid are clamped
+			cell = np.clip(np.searchsorted(self.axes[i], queries[:, i], side="right") - 1, 0, len(self.axes[i]) - 2)
+			left = self.axes[i][cell]
+			weights[i] = np.clip((queries[:, i] - left) / (self.axes[i][cell + 1] - left), 0.0, 1.0)
+			low[i] = cell
+		result = np.zeros((len(queries), self.values.shape[-1]))
+		for corner in range(2 ** len(self.active)):
+			index = list(low)
+			weight = np.ones(len(queries))
+			for (bit, i) in enumerate(self.active):
+				if corner >> bit & 1:
+					index[i] = low[i] + 1
+					weight = weight * weights[i]
+				else:
+					weight = weight * (1.0 - weights[i])
+			result += weight[:, None] * self.values[tuple(index)]
+		return result
+
+class ScatteredInterpolator():
+	#linear rbf with a linear polynomial term, or inverse distance weighting of the nearest points for big sets
+	#inputs are normalized on each axis so that every parameter has the same weight
+	def __init__(self, inputs : np.array, outputs : np.array):
+		self.offset = inputs.min(axis=0)
+		span = inputs.max(axis=0) - self.offset
+		self.scale  = np.where(span == 0, 1.0, span)
+		self.points = (inputs - self.offset) / self.scale
+		self.outputs = outputs
+		self.weights = None
+		if len(inputs) <= RBF_MAX_POINTS:
+			count = len(self.points)
+			polynomial = np.hstack((np.ones((count, 1)), self.points))
+			system = np.zeros((count + polynomial.shape[1], count + polynomial.shape[1]))
+			system[:count, :count] = self.get_distances(self.points)
+			system[:count, count:] = polynomial
+			system[count:, :count] = polynomial.T
+			rhs = np.vstack((outputs, np.zeros((polynomial.shape[1], outputs.shape[1]))))
+			self.weights = np.linalg.lstsq(system, rhs, rcond=None)[0]
+
+	def get_distances(self, queries : np.array) -> np.array:
+		return np.sqrt(np.maximum(((queries[:, None, :] - self.points[None, :, :]) ** 2).sum(axis=2), 0.0))
+
+	def __call__(self, queries : np.array, chunk_size : int = 1024) -> np.array:
+		queries = (np.atleast_2d(queries) - self.offset) / self.scale
+		result = np.empty((len(queries), self.outputs.shape[1]))
+		for start in range(0, len(queries), chunk_size):
+			chunk = queries[start:start + chunk_size]
+			distances = self.get_distances(chunk)
+			if self.weights is not None:
+				count = len(self.points)
+				result[start:start + chunk_size] = distances @ self.weights[:count] + np.hstack((np.ones((len(chunk), 1)), chunk)) @ self.weights[count:]
+				continue
+			neighbours = np.argsort(distances, axis=1)[:, :NEIGHBOURS]
+			near = np.take_along_axis(distances, neighbours, axis=1)
+			weights = 1.0 / np.maximum(near, 1e-12) ** 2
+			result[start:start + chunk_size] = (weights[:, :, None] * self.outputs[neighbours]).sum(axis=1) / weights.sum(axis=1)[:, None]
+		return result
+
+class Surrogate():
+	#kpis at any (wind, sun, bio, battery, flex, piloted) point from already simulated sweep points
+	columns : List[str]
+	outputs : List[str]
+	def __init__(self, columns : List[str], matrix : np.array):
+		self.columns = columns
+		self.outputs = [c for c in columns if c not in INPUT_COLUMNS]
+		self.inputs_matrix  = matrix[:, [columns.index(c) for c in INPUT_COLUMNS]]
+		self.outputs_matrix = matrix[:, [columns.index(c) for c in self.outputs]]
+		self.interpolator = GridInterpolator.from_points(self.inputs_matrix, self.outputs_matrix)
+		if self.interpolator is None:
+			self.interpolator = ScatteredInterpolator(self.inputs_matrix, self.outputs_matrix)
+
+	@classmethod
+	def from_file(cls, path : str) -> Surrogate:
+		return Surrogate(*read_results(path))
+
+	@classmethod
+	def from_results(cls, results : Iterable[Dict[str, Any]]) -> Surrogate:
+		return Surrogate(get_result_columns(), results_to_matrix(results))
+
+	def is_grid(self) -> bool:
+		return isinstance(self.interpolator, GridInterpolator)
+
+	def predict(self, queries : Union[np.array, Dict[str, Any]], kpis : List[str] = None) -> Dict[str, np.array]:
+		#queries is a (n, 6) array in the INPUT_COLUMNS order, or a dict of arrays keyed by those columns
+		if isinstance(queries, dict):
+			queries = np.column_stack(np.broadcast_arrays(*[np.asarray(queries[c], dtype=np.float64) for c in INPUT_COLUMNS]))
+		predicted = self.interpolator(np.asarray(queries, dtype=np.float64))
+		kpis = kpis if kpis is not None else self.outputs
+		return {k : predicted[:, self.outputs.index(k)] for k in kpis}
+
+	def estimate_error(self, fraction : float = 0.1, seed : int = 0) -> Dict[str, Tuple[float, float]]:
+		#(mean, max) absolute error per kpi on held out simulated points
+		#on a grid, every other point of each axis is held out so that the rest still makes a (coarser) grid
+		#the error is then the one of a grid twice as coarse, an upper bound of the real one
+		#a grid without any axis of more than 2 points can't be coarsened, its points are then held out as scattered ones
+		#nan when no point can be held out
+		model = None
+		if self.is_grid():
+			axes = self.interpolator.axes
+			kept_axes = [a[::2] if len(a) > 2 else a for a in axes]
+			if any([len(a) > 2 and a[-1] != k[-1] for (a, k) in zip(axes, kept_axes)]):
+				kept_axes = [np.union1d(k, a[-1:]) for (a, k) in zip(axes, kept_axes)]
+			kept = np.all([np.isin(self.inputs_matrix[:, i], kept_axes[i]) for i in range(len(axes))], axis=0)
+			if not kept.all():
+				model = GridInterpolator.from_points(self.inputs_matrix[kept], self.outputs_matrix[kept])
+		if model is None:
+			kept = np.random.default_rng(seed).random(len(self.inputs_matrix)) >= fraction
+			if kept.all() or not kept.any():
+				return {k : (float("nan"), float("nan")) for k in self.outputs}
+			model = ScatteredInterpolator(self.inputs_matrix[kept], self.outputs_matrix[kept])
+		errors = np.abs(model(self.inputs_matrix[~kept]) - self.outputs_matrix[~kept])
+		return {k : (float(errors[:, i].mean()), float(errors[:, i].max())) for (i, k) in enumerate(self.outputs)}
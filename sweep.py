@@ -0,0 +1,256 @@
+from __future__ import annotations
+from typing import *
+from dataclasses import fields
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+import heapq
+import threading
+import numpy as np
+if len(__name__.split("."))==1:
+	from sim import *
+	from profiling import stage, get_profiler, enable_profiling
+	from arena import ScratchArena
+else:
+	from .sim import *
+	from .profiling import stage, get_profiler, enable_profiling
+	from .arena import ScratchArena
+
+#sweep axes, in the order used by the grid and the result files
+#piloted bioenergy came last, files written before it have one column less (see read_results)
+AXES = ["wind", "sun", "bio", "battery", "flex", "piloted"]
+AXIS_KEYS = {
+	"wind"    : "wind_to_sim",
+	"sun"     : "sun_to_sim",
+	"bio"     : "bio_to_sim",
+	"battery" : "battery_to_sim",
+	"flex"    : "flex_to_sim",
+	"piloted" : "piloted_to_sim",
+}
+#flexibility is a ratio, every other axis is scaled to the population
+UNSCALED_AXES = ["flex"]
+
+def get_axis_value(params : Dict[str, Any], axis : str, ratio : float) -> float:
+	#ratio goes from 0.0 (axis min) to 1.0 (axis max)
+	value = params[axis + "_min"] + (params[axis + "_max"] - params[axis + "_min"]) * ratio
+	if axis in UNSCALED_AXES:
+		return value
+	return value * params["scaling_factor_for_pop"]
+
+def get_point(params : Dict[str, Any], ratios : Sequence[float]) -> Dict[str, float]:
+	return {AXIS_KEYS[axis] : get_axis_value(params, axis, ratios[i]) for (i, axis) in enumerate(AXES)}
+
+def get_grid_ratios(params : Dict[str, Any]) -> List[Tuple[float, ...]]:
+	#same order as the nested loops of the original sweep, flexibility varying fastest
+	axes_ratios = [[i / max(1, params[axis + "_nb_points"] - 1) for i in range(params[axis + "_nb_points"])] for axis in AXES]
+	ratios = [()]
+	for axis_ratios in axes_ratios:
+		ratios = [r + (a,) for r in ratios for a in axis_ratios]
+	return ratios
+
+def get_grid_size(params : Dict[str, Any]) -> int:
+	return int(np.prod([params[axis + "_nb_points"] for axis in AXES]))
+
+def get_grid_point(params : Dict[str, Any], index : int) -> Dict[str, float]:
+	#point number index of the grid, without building the whole grid
+	coordinates = np.unravel_index(index, tuple([params[axis + "_nb_points"] for axis in AXES]))
+	return get_point(params, [int(c) / max(1, params[axis + "_nb_points"] - 1) for (c, axis) in zip(coordinates, AXES)])
+
+def get_grid_points(params : Dict[str, Any]) -> List[Dict[str, float]]:
+	return [get_point(params, ratios) for ratios in get_grid_ratios(params)]
+
+def set_point(sim_param : SimParams, point : Dict[str, float]):
+	sim_param.solar_power       = point["sun_to_sim"]
+	sim_param.wind_power        = point["wind_to_sim"]
+	sim_param.bioenergy_power   = point["bio_to_sim"]
+	sim_param.battery_capacity  = point["battery_to_sim"]
+	sim_param.set_flexibility_ratio(point["flex_to_sim"])
+	sim_param.piloted_bioenergy_power = point["piloted_to_sim"]
+
+def simulate_point(sim_param : SimParams, point : Dict[str, float], arena : ScratchArena = None) -> Dict[str, Any]:
+	#a worker simulating several points should give the same arena to every call, its buffers are then reused
+	set_point(sim_param, point)
+	with stage("scenario"):
+		sim_param.check_and_convert_params()
+		with stage("simulate_senario"):
+			result = simulate_senario(sim_param, arena)
+		with stage("from_sim_results"):
+			agglomerated = AgglomeratedSimResults.from_sim_results(result, arena)
+	return {**point,
+		"agglomerated" : agglomerated
+	}
+
+def run_threaded(sim_params : SimParams, points : List[Dict[str, float]], thread_count : int) -> List[Dict[str, Any]]:
+	#threads share one copy of the curves, the native kernels and most numpy operations run without the GIL
+	local = threading.local()
+	def simulate(point : Dict[str, float]) -> Dict[str, Any]:
+		if not hasattr(local, "sim_params"):
+			local.sim_params = sim_params.get_shared_clone()
+			local.arena = ScratchArena()
+		return simulate_point(local.sim_params, point, local.arena)
+	with ThreadPoolExecutor(thread_count) as executor:
+		return list(executor.map(simulate, points))
+
+def simulate_in_process(point : Dict[str, float]) -> Tuple[Dict[str, Any], list]:
+	#the profiling events of the point go back to the parent with the result
+	result = simulate_point(process_sim_params, point, process_arena)
+	profiler = get_profiler()
+	return (result, profiler.drain_events() if profiler is not None else [])
+
+def set_process_sim_params(sim_params : SimParams, profile_memory : Optional[bool] = None):
+	#profile_memory is None when the parent doesn't profile
+	global process_sim_params, process_arena
+	process_sim_params = sim_params
+	process_arena = ScratchArena()
+	if profile_memory is not None:
+		enable_profiling(profile_memory)
+
+def run_processes(sim_params : SimParams, points : List[Dict[str, float]], process_count : int, chunk_size : int = 8) -> List[Dict[str, Any]]:
+	#every process gets its own copy of the params, pickled once when the pool starts
+	profiler = get_profiler()
+	with Pool(process_count, initializer=set_process_sim_params, initargs=(sim_params, profiler.memory if profiler is not None else None)) as pool:
+		return collect_process_outputs(pool.map(simulate_in_process, points, chunk_size))
+
+def collect_process_outputs(outputs : List[Tuple[Dict[str, Any], list]]) -> List[Dict[str, Any]]:
+	#results of simulate_in_process, their profiling events are added to the profiler of this process
+	profiler = get_profiler()
+	if profiler is not None:
+		for (result, events) in outputs:
+			profiler.add_events(events)
+	return [result for (result, events) in outputs]
+
+def get_csv_titles() -> str:
+	return ";".join(["wind turbines(W/house)", "solar pannels(W/house)", "bioenergy(W/house)", "battery(Wh/house)", "flexibility (raw ratio)", "piloted bioenergy(W/house)"])
+
+def write_csv_titles(out_file):
+	#first line of a result file, the axes then the kpis
+	print(get_csv_titles(), AgglomeratedSimResults.get_csv_titles(), sep=";", file=out_file)
+
+def write_results(path : str, results : Iterable[Dict[str, Any]]):
+	with open(path, "w") as out_file:
+		write_csv_titles(out_file)
+		for result in results:
+			print(result["wind_to_sim"],
+				result["sun_to_sim"],
+				result["bio_to_sim"],
+				result["battery_to_sim"],
+				result["flex_to_sim"],
+				result["piloted_to_sim"],
+				result["agglomerated"].to_csv_string(),
+				sep=";",
+				file=out_file)
+
+def get_result_columns() -> List[str]:
+	#column names of a result file, the axes keys followed by the AgglomeratedSimResults fields
+	return [AXIS_KEYS[axis] for axis in AXES] + [f.name for f in fields(AgglomeratedSimResults)]
+
+def results_to_matrix(results : Iterable[Dict[str, Any]]) -> np.array:
+	#one row per result, columns as in get_result_columns
+	keys = get_result_columns()[:len(AXIS_KEYS)]
+	agglomerated = [f.name for f in fields(AgglomeratedSimResults)]
+	rows = [[r[k] for k in keys] + [getattr(r["agglomerated"], f) for f in agglomerated] for r in results]
+	return np.array(rows, dtype=np.float64).reshape((len(rows), len(keys) + len(agglomerated)))
+
+def read_results(path : str) -> Tuple[List[str], np.array]:
+	matrix = np.loadtxt(path, delimiter=";", skiprows=1, ndmin=2)
+	columns = get_result_columns()
+	if matrix.shape[1] == len(columns) - 1:
+		#written before the piloted bioenergy axis, which was then 0
+		matrix = np.insert(matrix, len(AXES) - 1, 0.0, axis=1)
+	return (columns, matrix)
+
+def write_results_matrix(path : str, matrix : np.array):
+	#same file as write_results, from rows laid out as in get_result_columns
+	with open(path, "w") as out_file:
+		write_csv_titles(out_file)
+		for row in matrix:
+			print(*[str(v) for v in row], sep=";", file=out_file)
+
+class AdaptiveSweep():
+	#starts from the coarse grid of the params and bisects the cells where kpi varies more than tolerance
+	#cells are refined largest variation first, until budget simulations have been run or max_depth is reached
+	params    : Dict[str, Any]
+	kpi       : str
+	tolerance : float
+	budget    : int
+	max_depth : int
+	evaluate  : Callable[[List[Dict[str, float]]], List[Dict[str, Any]]]
+	results   : Dict[Tuple[float, ...], Dict[str, Any]]
+	def __init__(self, params : Dict[str, Any], evaluate : Callable[[List[Dict[str, float]]], List[Dict[str, Any]]], kpi : str = "autoprod", tolerance : float = 0.02, budget : int = 1000, max_depth : int = 6, batch_size : int = 16):
+		self.params     = params
+		self.evaluate   = evaluate
+		self.kpi        = kpi
+		self.tolerance  = tolerance
+		self.budget     = budget
+		self.max_depth  = max_depth
+		self.batch_size = batch_size
+		self.results    = {}
+		#axes with a single point or an empty range are never refined
+		self.active_axes = [i for (i, axis) in enumerate(AXES) if params[axis + "_nb_points"] > 1 and params[axis + "_max"] != params[axis + "_min"]]
+
+	def get_kpi(self, ratios : Tuple[float, ...]) -> float:
+		return getattr(self.results[ratios]["agglomerated"], self.kpi)
+
+	def simulate(self, ratios_list : List[Tuple[float, ...]]):
+		#shared corners are only simulated once
+		to_simulate = list(dict.fromkeys([r for r in ratios_list if r not in self.results]))
+		if len(to_simulate) == 0:
+			return
+		results = self.evaluate([get_point(self.params, r) for r in to_simulate])
+		for (ratios, result) in zip(to_simulate, results):
+			self.results[ratios] = result
+
+	def get_corners(self, low : Tuple[float, ...], high : Tuple[float, ...]) -> List[Tuple[float, ...]]:
+		corners = [low]
+		for i in self.active_axes:
+			corners = corners + [c[:i] + (high[i],) + c[i + 1:] for c in corners]
+		return corners
+
+	def get_split(self, low : Tuple[float, ...], high : Tuple[float, ...]) -> Tuple[float, int]:
+		#variation of the kpi over the cell, and the axis along which it varies the most
+		corners = self.get_corners(low, high)
+		values = [self.get_kpi(c) for c in corners]
+		best_axis = -1
+		best_variation = -1.0
+		for i in self.active_axes:
+			variation = max([abs(self.get_kpi(c) - self.get_kpi(c[:i] + (high[i],) + c[i + 1:])) for c in corners if c[i] == low[i]])
+			if variation > best_variation:
+				best_axis = i
+				best_variation = variation
+		return (max(values) - min(values), best_axis)
+
+	def run(self) -> List[Dict[str, Any]]:
+		grid = get_grid_ratios(self.params)
+		self.simulate(grid)
+		#initial cells are the ones of the coarse grid
+		steps = [1.0 / max(1, self.params[axis + "_nb_points"] - 1) for axis in AXES]
+		cells : List[Tuple[float, int, Tuple[float, ...], Tuple[float, ...], int]] = []
+		for low in grid:
+			if all([low[i] + steps[i] <= 1.0 + 1e-12 for i in self.active_axes]):
+				high = tuple([min(1.0, low[i] + steps[i]) if i in self.active_axes else low[i] for i in range(len(low))])
+				self.push_cell(cells, low, high, 0)
+		while len(cells) != 0 and len(self.results) < self.budget:
+			batch = []
+			while len(cells) != 0 and len(batch) < self.batch_size:
+				batch.append(heapq.heappop(cells))
+			children = []
+			planned = set()
+			for (_, axis, low, high, depth) in batch:
+				middle = (low[axis] + high[axis]) / 2
+				halves = [(low, high[:axis] + (middle,) + high[axis + 1:], depth + 1), (low[:axis] + (middle,) + low[axis + 1:], high, depth + 1)]
+				corners = set([c for (l, h, _) in halves for c in self.get_corners(l, h)]) - set(self.results.keys())
+				#a cell going over the budget is dropped, smaller cells further in the heap may still fit
+				if len(planned | corners) + len(self.results) > self.budget:
+					continue
+				planned |= corners
+				children += halves
+			self.simulate([c for (low, high, _) in children for c in self.get_corners(low, high)])
+			for (low, high, depth) in children:
+				self.push_cell(cells, low, high, depth)
+		return [self.results[r] for r in sorted(self.results.keys())]
+
+	def push_cell(self, cells : list, low : Tuple[float, ...], high : Tuple[float, ...], depth : int):
+		if depth >= self.max_depth or len(self.active_axes) == 0:
+			return
+		(variation, axis) = self.get_split(low, high)
+		if variation > self.tolerance:
+			heapq.heappush(cells, (-variation, axis, low, high, depth))